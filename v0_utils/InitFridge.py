@@ -1,176 +1,323 @@
+"""
+This module contains functions for bringing up the station of a fridge.
+
+The instruments of each fridge are described in a table of `InstrumentSpec`
+entries. Drivers are imported only when the instrument is used, and
+instruments that do not depend on each other are connected at the same time
+on a thread pool. An instrument that fails to connect is reported and
+skipped (together with the instruments that depend on it) instead of
+aborting the whole bring-up.
+"""
+
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from importlib import import_module, reload
+from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple
+
 from v0_utils.qcodes_tools import \
     instrument_factory, init_or_create_database, load_or_create_experiment, \
     add_parameter_to_instrument, \
     DelegateParameter, VirtualInstrument
 
-from importlib import reload
 from pytopo.qctools import instruments as instools; reload(instools)
 from pytopo.qctools.instruments import create_inst, add2station
 import qcodes as qc
 
-def QT4_init(**kwargs):
-    station = qc.Station()
-    inst_list = []
-    
-    if 'DMM1' in kwargs and kwargs['DMM1'] is True:
-        from qcodes.instrument_drivers.Keysight.Keysight_34465A import Keysight_34465A
-        DMM1 = instools.create_inst(Keysight_34465A, 'DMM1', address="TCPIP::169.254.26.27")
-        inst_list.append(DMM1)
-    
-    if 'DMM2' in kwargs and kwargs['DMM2'] is True:
-        from qcodes.instrument_drivers.Keysight.Keysight_34465A import Keysight_34465A
-        DMM2 = instools.create_inst(Keysight_34465A, 'DMM2', address="TCPIP::169.254.88.178")
-        inst_list.append(DMM2)
-            
-    if 'DMM3' in kwargs and kwargs['DMM3'] is True:
-        from qcodes.instrument_drivers.Keysight.Keysight_34465A import Keysight_34465A
-        DMM3 = instools.create_inst(Keysight_34465A, 'DMM3', address="TCPIP::169.254.4.61")
-        inst_list.append(DMM1)
-    
-    if 'lockin1' in kwargs and kwargs['lockin1'] is True:
-        from qcodes.instrument_drivers.stanford_research.SR860 import SR860
-        lockin1 = instools.create_inst(SR860, "lockin1", "TCPIP::169.254.88.181")
-        inst_list.append(lockin1)
-            
-    if 'lockin2' in kwargs and kwargs['lockin2'] is True:
-        from qcodes.instrument_drivers.stanford_research.SR860 import SR860
-        lockin2 = instools.create_inst(SR860, "lockin2", "TCPIP::169.254.88.179")
-        inst_list.append(lockin2)
-            
-    if 'yokogawa' in kwargs and kwargs['yokogawa'] is True:
-        from qcodes.instrument_drivers.yokogawa.GS200 import GS200
-        yokogawa = instools.create_inst(GS200, "yokogawa", "USB0::0x0B21::0x0039::91U100329::INSTR")
-        inst_list.append(yokogawa)
-            
-    if 'mdac' in kwargs and kwargs['mdac'] is True:
-        from MDAC.Driver.MDAC import MDAC
-        mdac = instools.create_inst(MDAC, "mdac", address='ASRL4::INSTR', force_new_instance=True)
-        inst_list.append(mdac)
-    
-    if 'SGS1' in kwargs and kwargs['SGS1'] is True:
-        from qcodes.instrument_drivers.rohde_schwarz.SGS100A import RohdeSchwarz_SGS100A
-        SGS1 = instools.create_inst(RohdeSchwarz_SGS100A, "SGS1", "TCPIP::169.254.90.38")
-        inst_list.append(SGS1)
-            
-    if 'SGS2' in kwargs and kwargs['SGS2'] is True:
-        from qcodes.instrument_drivers.rohde_schwarz.SGS100A import RohdeSchwarz_SGS100A
-        SGS2 = instools.create_inst(RohdeSchwarz_SGS100A, "SGS2", "TCPIP::169.254.2.20")
-        inst_list.append(SGS2)
-    
-    if 'scope' in kwargs and kwargs['scope'] is True:
-        from qcodes.instrument_drivers.Keysight.Infiniium import Infiniium
-        #import qcodes.instrument_drivers.Keysight.Infiniium as MSO
-        scope = instools.create_inst(Infiniium, 'scope', 'TCPIP::169.254.159.151')
-        inst_list.append(scope)
-        
-    if 'rigol' in kwargs and kwargs['rigol'] is True:
-        from qcodes.instrument_drivers.rigol.DG1062 import DG1062
-        rigol = instools.create_inst(DG1062, 'rigol', 'TCPIP::169.254.32.101')
-        inst_list.append(rigol)
-    
-    if 'awg_5208' in kwargs and kwargs['awg_5208'] is True:
-        from qcodes.instrument_drivers.tektronix.AWG5208 import AWG5208
-        awg = instools.create_inst(AWG5208, "awg", address='TCPIP0::169.254.121.32::inst0::INSTR')
-        inst_list.append(awg_5208)
-    
-    if 'magnet' in kwargs and kwargs['magnet'] is True:
-        from qcodes.instrument_drivers.american_magnetics.AMI430 import AMI430,AMI430_3D
-        ami_x = instools.create_inst(AMI430, "AMI430_x", "169.254.237.94", port = 7180, has_current_rating=True)
-        ami_y = instools.create_inst(AMI430, "AMI430_y", "169.254.250.157", port = 7180, has_current_rating=True)
-        ami_z = instools.create_inst(AMI430, "AMI430_z", "169.254.70.33", port = 7180, has_current_rating=True)
-        magnet = instools.create_inst(AMI430_3D, "AMI430", ami_x, ami_y, ami_z, 1)
-        inst_list.append(magnet)
-        
-    if 'alazar' in kwargs and kwargs['alazar'] is True:
-        from qcodes.instrument_drivers.AlazarTech import utils; reload(utils)
-        from qcodes.instrument_drivers.AlazarTech import ATS9360; reload(ATS9360)
-        from qcodes.instrument_drivers.AlazarTech.ATS9360 import AlazarTech_ATS9360
-        alazar = instools.create_inst(AlazarTech_ATS9360, 'alazar', force_new_instance=True)
-        inst_list.append(alazar)
-    
-    station = qc.Station(*inst_list)
-    return station
 
-def QT5_init(**kwargs):
-    station = qc.Station()
-    inst_list = []
-    
-    if 'DMM1' in kwargs and kwargs['DMM1'] is True:
-        from qcodes.instrument_drivers.Keysight.Keysight_34465A import Keysight_34465A
-        DMM1 = instools.create_inst(Keysight_34465A, 'DMM1', address="TCPIP::169.254.26.27")
-        inst_list.append(DMM1)
-    
-    if 'DMM2' in kwargs and kwargs['DMM2'] is True:
-        from qcodes.instrument_drivers.Keysight.Keysight_34465A import Keysight_34465A
-        DMM2 = instools.create_inst(Keysight_34465A, 'DMM2', address="TCPIP::169.254.88.178")
-        inst_list.append(DMM2)
-            
-    if 'DMM3' in kwargs and kwargs['DMM3'] is True:
-        from qcodes.instrument_drivers.Keysight.Keysight_34465A import Keysight_34465A
-        DMM3 = instools.create_inst(Keysight_34465A, 'DMM3', address="TCPIP::169.254.4.61")
-        inst_list.append(DMM3)
-    
-    if 'lockin1' in kwargs and kwargs['lockin1'] is True:
-        from qcodes.instrument_drivers.stanford_research.SR860 import SR860
-        lockin1 = instools.create_inst(SR860, "lockin1", "TCPIP::169.254.88.181")
-        inst_list.append(lockin1)
-            
-    if 'lockin2' in kwargs and kwargs['lockin2'] is True:
-        from qcodes.instrument_drivers.stanford_research.SR860 import SR860
-        lockin2 = instools.create_inst(SR860, "lockin2", "TCPIP::169.254.88.179")
-        inst_list.append(lockin2)
-            
-    if 'yokogawa' in kwargs and kwargs['yokogawa'] is True:
-        from qcodes.instrument_drivers.yokogawa.GS200 import GS200
-        yokogawa = instools.create_inst(GS200, "yokogawa", "USB0::0x0B21::0x0039::91U100329::INSTR")
-        inst_list.append(yokogawa)
-            
-    if 'mdac' in kwargs and kwargs['mdac'] is True:
-        from MDAC.Driver.MDAC import MDAC
-        mdac = instools.create_inst(MDAC, "mdac", address='ASRL4::INSTR', force_new_instance=True)
-        inst_list.append(mdac)
-    
-    if 'SGS1' in kwargs and kwargs['SGS1'] is True:
-        from qcodes.instrument_drivers.rohde_schwarz.SGS100A import RohdeSchwarz_SGS100A
-        SGS1 = instools.create_inst(RohdeSchwarz_SGS100A, "SGS1", "TCPIP::169.254.90.38")
-        inst_list.append(SGS1)
-            
-    if 'SGS2' in kwargs and kwargs['SGS2'] is True:
-        from qcodes.instrument_drivers.rohde_schwarz.SGS100A import RohdeSchwarz_SGS100A
-        SGS2 = instools.create_inst(RohdeSchwarz_SGS100A, "SGS2", "TCPIP::169.254.2.20")
-        inst_list.append(SGS2)
-    
-    if 'scope' in kwargs and kwargs['scope'] is True:
-        from qcodes.instrument_drivers.Keysight.Infiniium import Infiniium
-        #import qcodes.instrument_drivers.Keysight.Infiniium as MSO
-        scope = instools.create_inst(Infiniium, 'scope', 'TCPIP::169.254.159.151')
-        inst_list.append(scope)
-        
-    if 'rigol' in kwargs and kwargs['rigol'] is True:
-        from qcodes.instrument_drivers.rigol.DG1062 import DG1062
-        rigol = instools.create_inst(DG1062, 'rigol', 'TCPIP::169.254.32.101')
-        inst_list.append(rigol)
-    
-    if 'awg_5208' in kwargs and kwargs['awg_5208'] is True:
-        from qcodes.instrument_drivers.tektronix.AWG5208 import AWG5208
-        awg = instools.create_inst(AWG5208, "awg", address='TCPIP0::169.254.121.32::inst0::INSTR')
-        inst_list.append(awg_5208)
-    
-    if 'magnet' in kwargs and kwargs['magnet'] is True:
-        from qcodes.instrument_drivers.american_magnetics.AMI430 import AMI430,AMI430_3D
-        ami_x = instools.create_inst(AMI430, "AMI430_x", "169.254.237.94", port = 7180, has_current_rating=True)
-        ami_y = instools.create_inst(AMI430, "AMI430_y", "169.254.250.157", port = 7180, has_current_rating=True)
-        ami_z = instools.create_inst(AMI430, "AMI430_z", "169.254.70.33", port = 7180, has_current_rating=True)
-        magnet = instools.create_inst(AMI430_3D, "AMI430", ami_x, ami_y, ami_z, 1)
-        inst_list.append(magnet)
-        
-    if 'alazar' in kwargs and kwargs['alazar'] is True:
-        from qcodes.instrument_drivers.AlazarTech import utils; reload(utils)
-        from qcodes.instrument_drivers.AlazarTech import ATS9360; reload(ATS9360)
-        from qcodes.instrument_drivers.AlazarTech.ATS9360 import AlazarTech_ATS9360
-        alazar = instools.create_inst(AlazarTech_ATS9360, 'alazar', force_new_instance=True)
-        inst_list.append(alazar)
-    
+class InstrumentRef(NamedTuple):
+    """
+    Reference to another instrument of the same table, to be used in `args`
+    or `kwargs` of an `InstrumentSpec`. The referenced instrument is
+    connected first, and the reference is replaced by the instrument object.
+    """
+    name: str
+
+
+class InstrumentSpec(NamedTuple):
+    """
+    Description of how to connect to an instrument.
+
+    Attributes:
+        name
+            Name of the instrument
+        driver
+            Driver class given as "module.path:ClassName"; the module is
+            imported only when the instrument is connected
+        flag
+            Name of the keyword argument of the init function (e.g.
+            `QT5_init`) that enables this instrument
+        args
+            Positional arguments for the driver (after the name)
+        kwargs
+            Keyword arguments for the driver
+        add_to_station
+            Whether the instrument is added to the station
+    """
+    name: str
+    driver: str
+    flag: str
+    args: Tuple = ()
+    kwargs: Dict[str, Any] = {}
+    add_to_station: bool = True
+
+    @property
+    def depends_on(self) -> Tuple[str, ...]:
+        all_args = tuple(self.args) + tuple(self.kwargs.values())
+        return tuple(arg.name for arg in all_args
+                     if isinstance(arg, InstrumentRef))
+
+
+class ConnectionResult(NamedTuple):
+    """
+    Result of connecting to an instrument: the instrument object (None if
+    the connection failed), the time it took in seconds, and the exception
+    that occurred (None if the connection succeeded).
+    """
+    instrument: Any
+    duration: float
+    error: Optional[BaseException]
+
+
+_KEYSIGHT_DMM = 'qcodes.instrument_drivers.Keysight.Keysight_34465A:' \
+                'Keysight_34465A'
+_SR860 = 'qcodes.instrument_drivers.stanford_research.SR860:SR860'
+_SGS100A = 'qcodes.instrument_drivers.rohde_schwarz.SGS100A:' \
+           'RohdeSchwarz_SGS100A'
+_AMI430 = 'qcodes.instrument_drivers.american_magnetics.AMI430:AMI430'
+_AMI430_3D = 'qcodes.instrument_drivers.american_magnetics.AMI430:AMI430_3D'
+
+_QT_INSTRUMENTS = (
+    InstrumentSpec('DMM1', _KEYSIGHT_DMM, 'DMM1',
+                   kwargs={'address': "TCPIP::169.254.26.27"}),
+    InstrumentSpec('DMM2', _KEYSIGHT_DMM, 'DMM2',
+                   kwargs={'address': "TCPIP::169.254.88.178"}),
+    InstrumentSpec('DMM3', _KEYSIGHT_DMM, 'DMM3',
+                   kwargs={'address': "TCPIP::169.254.4.61"}),
+    InstrumentSpec('lockin1', _SR860, 'lockin1',
+                   args=("TCPIP::169.254.88.181",)),
+    InstrumentSpec('lockin2', _SR860, 'lockin2',
+                   args=("TCPIP::169.254.88.179",)),
+    InstrumentSpec('yokogawa',
+                   'qcodes.instrument_drivers.yokogawa.GS200:GS200',
+                   'yokogawa',
+                   args=("USB0::0x0B21::0x0039::91U100329::INSTR",)),
+    InstrumentSpec('mdac', 'MDAC.Driver.MDAC:MDAC', 'mdac',
+                   kwargs={'address': 'ASRL4::INSTR',
+                           'force_new_instance': True}),
+    InstrumentSpec('SGS1', _SGS100A, 'SGS1',
+                   args=("TCPIP::169.254.90.38",)),
+    InstrumentSpec('SGS2', _SGS100A, 'SGS2',
+                   args=("TCPIP::169.254.2.20",)),
+    InstrumentSpec('scope',
+                   'qcodes.instrument_drivers.Keysight.Infiniium:Infiniium',
+                   'scope',
+                   args=('TCPIP::169.254.159.151',)),
+    InstrumentSpec('rigol', 'qcodes.instrument_drivers.rigol.DG1062:DG1062',
+                   'rigol',
+                   args=('TCPIP::169.254.32.101',)),
+    InstrumentSpec('awg',
+                   'qcodes.instrument_drivers.tektronix.AWG5208:AWG5208',
+                   'awg_5208',
+                   kwargs={'address': 'TCPIP0::169.254.121.32::inst0::INSTR'}),
+    InstrumentSpec('AMI430_x', _AMI430, 'magnet',
+                   args=("169.254.237.94",),
+                   kwargs={'port': 7180, 'has_current_rating': True},
+                   add_to_station=False),
+    InstrumentSpec('AMI430_y', _AMI430, 'magnet',
+                   args=("169.254.250.157",),
+                   kwargs={'port': 7180, 'has_current_rating': True},
+                   add_to_station=False),
+    InstrumentSpec('AMI430_z', _AMI430, 'magnet',
+                   args=("169.254.70.33",),
+                   kwargs={'port': 7180, 'has_current_rating': True},
+                   add_to_station=False),
+    InstrumentSpec('AMI430', _AMI430_3D, 'magnet',
+                   args=(InstrumentRef('AMI430_x'),
+                         InstrumentRef('AMI430_y'),
+                         InstrumentRef('AMI430_z'),
+                         1)),
+    InstrumentSpec('alazar',
+                   'qcodes.instrument_drivers.AlazarTech.ATS9360:'
+                   'AlazarTech_ATS9360',
+                   'alazar',
+                   kwargs={'force_new_instance': True}),
+)
+
+FRIDGE_INSTRUMENTS = {
+    'QT4': _QT_INSTRUMENTS,
+    'QT5': _QT_INSTRUMENTS,
+}
+
+
+def _import_driver(driver: str) -> type:
+    module_name, class_name = driver.split(':')
+    return getattr(import_module(module_name), class_name)
+
+
+def _resolve_refs(value, instruments: Dict[str, Any]):
+    if isinstance(value, InstrumentRef):
+        return instruments[value.name]
+    return value
+
+
+def _connect_instrument(spec: InstrumentSpec,
+                        instruments: Dict[str, Any]) -> ConnectionResult:
+    t_start = time.perf_counter()
+    try:
+        driver_class = _import_driver(spec.driver)
+        args = [_resolve_refs(arg, instruments) for arg in spec.args]
+        kwargs = {key: _resolve_refs(value, instruments)
+                  for key, value in spec.kwargs.items()}
+        instrument = instools.create_inst(driver_class, spec.name,
+                                          *args, **kwargs)
+    except Exception as exception:
+        return ConnectionResult(None, time.perf_counter() - t_start,
+                                exception)
+    return ConnectionResult(instrument, time.perf_counter() - t_start, None)
+
+
+def _check_cycles(specs_by_name: Dict[str, InstrumentSpec]) -> None:
+    """
+    Raise a ValueError if instruments depend on each other in a circle.
+    """
+    # depth-first search; instruments on the current path are 'visiting'
+    state = {}
+
+    def visit(name, path):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            cycle = path[path.index(name):] + [name]
+            raise ValueError(f"Instruments {cycle} have circular "
+                             f"dependencies.")
+        state[name] = 'visiting'
+        for dep in specs_by_name[name].depends_on:
+            visit(dep, path + [name])
+        state[name] = 'done'
+
+    for name in specs_by_name:
+        visit(name, [])
+
+
+def connect_instruments(specs: Sequence[InstrumentSpec],
+                        max_workers: Optional[int] = None
+                        ) -> Dict[str, ConnectionResult]:
+    """
+    Connect to the given instruments, connecting the instruments that do
+    not depend on each other at the same time on a thread pool. An instrument
+    is connected only after all the instruments it refers to (via
+    `InstrumentRef`) are connected successfully. Failures do not abort the
+    process: a failed instrument (and all the instruments that depend on it)
+    get a result with the error.
+
+    Args:
+        specs
+            Specifications of the instruments to connect
+        max_workers
+            Maximal number of instruments that are connected at the same time;
+            by default, all the independent instruments are connected at once
+
+    Returns:
+        Connection results per instrument name, in the order of `specs`
+    """
+    specs_by_name = OrderedDict((spec.name, spec) for spec in specs)
+    for spec in specs:
+        missing = [name for name in spec.depends_on
+                   if name not in specs_by_name]
+        if missing:
+            raise ValueError(f"Instrument {spec.name} depends on {missing} "
+                             f"which are not going to be connected.")
+    _check_cycles(specs_by_name)
+
+    results = {}
+    instruments = {}
+    pending = OrderedDict(specs_by_name)
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(specs) or 1) \
+            as executor:
+        running = {}
+        while pending or running:
+            # a failure is passed on to the dependents of the dependents as
+            # well, whatever their order in `pending`, hence the scan is
+            # repeated until nothing changes
+            changed = True
+            while changed:
+                changed = False
+                for name, spec in list(pending.items()):
+                    failed = [dep for dep in spec.depends_on
+                              if dep in results and results[dep].error]
+                    if failed:
+                        error = RuntimeError(f"Not connected because "
+                                             f"{failed} failed to connect.")
+                        results[name] = ConnectionResult(None, 0, error)
+                        del pending[name]
+                        changed = True
+                    elif all(dep in instruments for dep in spec.depends_on):
+                        future = executor.submit(_connect_instrument, spec,
+                                                 dict(instruments))
+                        running[future] = name
+                        del pending[name]
+
+            if not running:
+                # without circular dependencies, nothing can be left pending
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                if results[name].error is None:
+                    instruments[name] = results[name].instrument
+
+    return OrderedDict((name, results[name]) for name in specs_by_name)
+
+
+def print_connection_report(results: Dict[str, ConnectionResult]) -> None:
+    """
+    Print the time it took to connect to each instrument, and the errors of
+    those that failed to connect.
+    """
+    for name, result in results.items():
+        if result.error is None:
+            print(f"{name}: connected in {result.duration:.2f} s")
+        else:
+            print(f"{name}: FAILED after {result.duration:.2f} s "
+                  f"({type(result.error).__name__}: {result.error})")
+
+
+def init_station(fridge: str,
+                 max_workers: Optional[int] = None,
+                 **kwargs) -> qc.Station:
+    """
+    Connect to the instruments of the given fridge that are enabled via
+    keyword arguments (for example, `DMM1=True`), print the connection
+    report, and create a station with the successfully connected instruments.
+
+    Args:
+        fridge
+            Name of the fridge, a key of `FRIDGE_INSTRUMENTS`
+        max_workers
+            Maximal number of instruments that are connected at the same time
+
+    Returns:
+        The station
+    """
+    specs = [spec for spec in FRIDGE_INSTRUMENTS[fridge]
+             if kwargs.get(spec.flag) is True]
+
+    results = connect_instruments(specs, max_workers=max_workers)
+    print_connection_report(results)
+
+    inst_list = [results[spec.name].instrument for spec in specs
+                 if spec.add_to_station and results[spec.name].error is None]
     station = qc.Station(*inst_list)
     return station
 
+
+def QT4_init(**kwargs):
+    return init_station('QT4', **kwargs)
+
+
+def QT5_init(**kwargs):
+    return init_station('QT5', **kwargs)
@@ -0,0 +1,408 @@
+"""
+This module contains storage of large array results (e.g. the data of the
+detectors of a `HardwareSweep`, or Alazar records) in binary sidecar files
+next to the QCoDeS database.
+
+Each array result is appended as one contiguous chunk to an append-only
+binary file per parameter, and the run in the database stores only the
+index of the chunk (next to the values of the other setpoints) and, as
+metadata, where the sidecar files are. The shape and the data type of the
+chunks are stored in a small header file next to each binary file. All
+the chunks of a parameter have the same shape and data type, hence any
+range of chunks can be read as a memory-mapped array without copying.
+`export_to_dataset` converts the arrays into a standard QCoDeS run where
+every element is a row, for tools that expect that format.
+"""
+
+import json
+import os
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+from qcodes import Parameter
+from qcodes.dataset.data_set import load_by_id
+from qcodes.dataset.experiment_container import load_experiment
+from qcodes.dataset.measurements import Measurement
+
+from .hwsweep import HardwareSweep
+from .qcodes_tools import VirtualInstrument
+
+METADATA_TAG = 'sidecar_arrays'
+
+
+class ArrayFile:
+    """
+    Append-only binary file of chunks of the same shape and data type.
+
+    The chunks are stored as raw bytes one after another in "<path>.bin",
+    and the shape and data type of a chunk and the number of chunks are
+    stored in "<path>.json". The header is created on the first append,
+    and updated on `flush`. When an existing file is opened, the number of
+    chunks is derived from the size of the binary file, so that the chunks
+    of a run that has not been closed properly (e.g. after a crash) can be
+    read as well.
+
+    Args:
+        path
+            Path of the files without the extension
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.dtype = None
+        self.chunk_shape = None
+        self.n_chunks = 0
+        self._file = None
+
+        if os.path.exists(self.header_path):
+            with open(self.header_path) as header_file:
+                header = json.load(header_file)
+            self.dtype = np.dtype(header['dtype'])
+            self.chunk_shape = tuple(header['chunk_shape'])
+            # the header is not updated on every append; a partly written
+            # chunk at the end is ignored
+            if os.path.exists(self.data_path) and self.chunk_nbytes:
+                self.n_chunks = \
+                    os.path.getsize(self.data_path) // self.chunk_nbytes
+
+    @property
+    def data_path(self) -> str:
+        return self.path + '.bin'
+
+    @property
+    def header_path(self) -> str:
+        return self.path + '.json'
+
+    @property
+    def chunk_nbytes(self) -> int:
+        return int(np.prod(self.chunk_shape)) * self.dtype.itemsize
+
+    def append(self, array: np.ndarray) -> int:
+        """
+        Append an array as a chunk, and return the index of the chunk.
+        """
+        array = np.ascontiguousarray(array)
+        if self.dtype is None:
+            self.dtype = array.dtype
+            self.chunk_shape = array.shape
+            self.flush()
+        elif array.shape != self.chunk_shape or array.dtype != self.dtype:
+            raise ValueError(f"Chunks of {self.path} should be of shape "
+                             f"{self.chunk_shape} and type {self.dtype}, "
+                             f"not {array.shape} and {array.dtype}.")
+
+        if self._file is None:
+            self._file = open(self.data_path, 'ab')
+            # drop a partly written chunk that a crash may have left
+            self._file.truncate(self.n_chunks * self.chunk_nbytes)
+        self._file.write(array.tobytes())
+        self.n_chunks += 1
+        return self.n_chunks - 1
+
+    def flush_data(self) -> None:
+        """
+        Pass the buffered chunks to the operating system, without updating
+        the header.
+        """
+        if self._file is not None:
+            self._file.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered data to disk, and update the header.
+        """
+        self.flush_data()
+        header = {'dtype': self.dtype.str,
+                  'chunk_shape': list(self.chunk_shape),
+                  'n_chunks': self.n_chunks}
+        temporary_path = self.header_path + '.tmp'
+        with open(temporary_path, 'w') as header_file:
+            json.dump(header, header_file)
+        os.replace(temporary_path, self.header_path)
+
+    def close(self) -> None:
+        if self.dtype is not None:
+            self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def read(self,
+             start: int = 0,
+             stop: Optional[int] = None) -> np.ndarray:
+        """
+        Return the chunks from `start` to `stop` (exclusive) as a read-only
+        memory-mapped array of shape (number of chunks,) + chunk shape.
+        """
+        start, stop, _ = slice(start, stop).indices(self.n_chunks)
+        n_chunks = max(0, stop - start)
+        if n_chunks == 0:
+            return np.empty((0,) + tuple(self.chunk_shape or ()),
+                            dtype=self.dtype or float)
+        return np.memmap(self.data_path, dtype=self.dtype, mode='r',
+                         offset=start * self.chunk_nbytes,
+                         shape=(n_chunks,) + self.chunk_shape)
+
+
+def _sidecar_dir(path_to_db: str, run_id: int) -> str:
+    db_base = os.path.splitext(os.path.abspath(path_to_db))[0]
+    return os.path.join(db_base + '_arrays', f'run_{run_id}')
+
+
+class SidecarArrays(VirtualInstrument):
+    """
+    Storage of the data of the detectors of a hardware sweep in sidecar
+    files. For each detector, a `<detector name>_chunk` parameter is
+    added, which holds the index of the last stored chunk and is what is
+    saved in the database.
+
+    Example:
+        arrays = SidecarArrays('arrays', hwsweeper)
+        meas.register_parameter(v_g_param)
+        arrays.register_parameters(meas, setpoints=(v_g_param,))
+        with meas.run() as datasaver, arrays.open(datasaver):
+            for v_g in gate_values:
+                v_g_param(v_g)
+                arrays.save(datasaver, hwsweeper.run(), (v_g_param, v_g))
+
+    `open` returns the storage itself, which closes the files at the end
+    of the `with` block (also on errors). Every `save` writes the chunks
+    through to the operating system, hence a crashed or interrupted run
+    can still be read.
+
+    The data is read back with `load_sidecar_array` and converted to a
+    standard run with `export_to_dataset`.
+
+    Args:
+        name
+            Name of the storage instrument
+        sweep
+            Hardware sweep whose detectors' data is stored
+        detector_names
+            Names of the detectors to store; by default, all the detectors
+            of the sweep
+    """
+
+    def __init__(self,
+                 name: str,
+                 sweep: HardwareSweep,
+                 detector_names: Optional[Sequence[str]] = None,
+                 **kwargs):
+        super().__init__(name, **kwargs)
+
+        self._sweep = sweep
+        self._detector_names = list(detector_names or sweep.detectors)
+        self._files = OrderedDict()
+        self._last_chunks = {}
+
+        for detector_name in self._detector_names:
+            self.add_parameter(
+                name=f'{detector_name}_chunk',
+                label=f'Chunk of {detector_name}',
+                unit='#',
+                get_cmd=lambda detector_name=detector_name:
+                    self._last_chunks.get(detector_name),
+                set_cmd=False,
+                docstring="Index of the chunk in the sidecar file that "
+                          "holds the last stored data of the detector"
+            )
+
+    @property
+    def chunk_parameters(self) -> Dict[str, Parameter]:
+        return OrderedDict((detector_name,
+                            self.parameters[f'{detector_name}_chunk'])
+                           for detector_name in self._detector_names)
+
+    def register_parameters(self,
+                            measurement,
+                            setpoints: Sequence[Parameter] = ()) -> None:
+        """
+        Register the chunk parameters in the given `Measurement`, with the
+        given (already registered) setpoints.
+        """
+        for parameter in self.chunk_parameters.values():
+            measurement.register_parameter(parameter, setpoints=setpoints)
+
+    def open(self, datasaver) -> 'SidecarArrays':
+        """
+        Create the sidecar files for the run of the datasaver, and record
+        their location in the metadata of the run. Returns the storage
+        itself, for use as a context manager.
+        """
+        dataset = datasaver.dataset
+        directory = _sidecar_dir(dataset.path_to_db, dataset.run_id)
+        os.makedirs(directory, exist_ok=True)
+
+        self._files = OrderedDict(
+            (detector_name, ArrayFile(os.path.join(directory, detector_name)))
+            for detector_name in self._detector_names)
+        self._last_chunks = {}
+
+        metadata = {'directory': os.path.relpath(
+                        directory,
+                        os.path.dirname(os.path.abspath(dataset.path_to_db))),
+                    'arrays': {parameter.full_name: detector_name
+                               for detector_name, parameter
+                               in self.chunk_parameters.items()}}
+        dataset.add_metadata(METADATA_TAG, json.dumps(metadata))
+        return self
+
+    def __enter__(self) -> 'SidecarArrays':
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback) -> None:
+        self.close()
+
+    def save(self,
+             datasaver,
+             data: Dict[str, np.ndarray],
+             *outer_results: Tuple[Parameter, float]) -> None:
+        """
+        Append the data of the detectors to the sidecar files, and add the
+        chunk indices with the given (parameter, value) pairs of the
+        setpoints to the datasaver.
+
+        Args:
+            datasaver
+                DataSaver of the run that the storage has been opened for
+            data
+                Data per detector name, e.g. as returned by `acquire` or
+                `run` of the hardware sweep
+            outer_results
+                (parameter, value) pairs of the setpoints
+        """
+        if not self._files:
+            raise RuntimeError(f"{self.name} has not been opened for a run.")
+        for detector_name, array_file in self._files.items():
+            self._last_chunks[detector_name] = \
+                array_file.append(np.asarray(data[detector_name]))
+            # the chunks must be in the files before the rows that refer to
+            # them can be in the database
+            array_file.flush_data()
+        datasaver.add_result(
+            *outer_results,
+            *[(parameter, self._last_chunks[detector_name])
+              for detector_name, parameter
+              in self.chunk_parameters.items()])
+
+    def flush(self) -> None:
+        for array_file in self._files.values():
+            array_file.flush()
+
+    def close(self) -> None:
+        for array_file in self._files.values():
+            array_file.close()
+        self._files = OrderedDict()
+
+
+def _sidecar_metadata(run_id: int) -> Tuple[str, Dict[str, str]]:
+    """
+    Return the directory of the sidecar files of a run, and the names of
+    the array files per chunk parameter.
+    """
+    dataset = load_by_id(run_id)
+    metadata = json.loads(dataset.get_metadata(METADATA_TAG))
+    directory = os.path.join(
+        os.path.dirname(os.path.abspath(dataset.path_to_db)),
+        metadata['directory'])
+    return directory, metadata['arrays']
+
+
+def load_sidecar_array(run_id: int,
+                       chunk_parameter: str,
+                       start: int = 0,
+                       stop: Optional[int] = None) -> np.ndarray:
+    """
+    Read chunks of an array stored in sidecar files as a read-only
+    memory-mapped array, without copying.
+
+    Args:
+        run_id
+            ID of the run in the database that QCoDeS refers to
+        chunk_parameter
+            Name of the chunk parameter in the run, e.g.
+            "arrays_lockin_chunk"
+        start
+            Index of the first chunk to read
+        stop
+            Index after the last chunk to read; by default, all the chunks
+            until the end are read
+
+    Returns:
+        Array of shape (number of chunks,) + shape of one chunk
+    """
+    directory, arrays = _sidecar_metadata(run_id)
+    return ArrayFile(os.path.join(directory, arrays[chunk_parameter])).read(
+        start, stop)
+
+
+def export_to_dataset(run_id: int,
+                      chunk_parameter: str,
+                      name: Optional[str] = None,
+                      axis_name: str = 'sample_index',
+                      axis_values: Optional[np.ndarray] = None,
+                      chunks_per_write: int = 100) -> int:
+    """
+    Export an array stored in sidecar files into a new standard QCoDeS run
+    (in the same experiment), where each element of each chunk is one row
+    with the values of the setpoints of its chunk and its position in the
+    chunk.
+
+    Args:
+        run_id
+            ID of the run with the sidecar array
+        chunk_parameter
+            Name of the chunk parameter in the run
+        name
+            Name of the exported parameter; by default, the name of the
+            chunk parameter without the "_chunk" suffix
+        axis_name
+            Name of the parameter of the position in a (1D) chunk
+        axis_values
+            Values of the position in a chunk, e.g. the values of the fast
+            ramp; by default, the indices of the elements
+        chunks_per_write
+            Number of chunks that are written to the database at once
+
+    Returns:
+        ID of the new run
+    """
+    dataset = load_by_id(run_id)
+    chunks = load_sidecar_array(run_id, chunk_parameter)
+    if name is None:
+        name = chunk_parameter[:-len('_chunk')] \
+            if chunk_parameter.endswith('_chunk') else chunk_parameter
+    if chunks.ndim != 2:
+        chunks = chunks.reshape(len(chunks), -1)
+    if axis_values is None:
+        axis_values = np.arange(chunks.shape[1])
+    # elements of float arrays are python floats, which SQLite stores as
+    # numbers (unlike other numpy scalar types)
+    axis_values = np.asarray(axis_values, dtype=float)
+
+    setpoint_names = dataset.paramspecs[chunk_parameter].depends_on
+    setpoint_names = [setpoint_name.strip() for setpoint_name
+                      in setpoint_names.split(',') if setpoint_name.strip()]
+    columns = dataset.get_data(*setpoint_names, chunk_parameter)
+    rows = [row for row in columns if row[-1] is not None]
+
+    measurement = Measurement(exp=load_experiment(dataset.exp_id))
+    for setpoint_name in setpoint_names:
+        spec = dataset.paramspecs[setpoint_name]
+        measurement.register_custom_parameter(setpoint_name,
+                                              label=spec.label,
+                                              unit=spec.unit)
+    measurement.register_custom_parameter(axis_name)
+    measurement.register_custom_parameter(
+        name, setpoints=setpoint_names + [axis_name])
+
+    with measurement.run() as datasaver:
+        for i, row in enumerate(rows):
+            datasaver.add_result(
+                *zip(setpoint_names, row[:-1]),
+                (axis_name, axis_values),
+                (name, np.asarray(chunks[int(row[-1])], dtype=float)))
+            if (i + 1) % chunks_per_write == 0:
+                datasaver.flush_data_to_database()
+    return datasaver.run_id
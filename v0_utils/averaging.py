@@ -0,0 +1,309 @@
+"""
+This module contains on-the-fly averaging over the repetitions of a
+repeating staircase ramp.
+
+Instead of saving every repetition of the fast ramp as raw rows and
+averaging in the analysis, the data buffers are reduced while they arrive
+into a running mean, variance and count per step of the ramp. Only these
+reduced arrays (and, optionally, a few raw repetitions as a sample) are
+saved, hence the size of the dataset and the time to write it do not grow
+with the number of repetitions.
+"""
+
+from typing import List, Sequence, Tuple
+
+import numpy as np
+from qcodes import Parameter
+from qcodes.utils.validators import Enum, Numbers
+
+from .qcodes_tools import VirtualInstrument
+from .ramps import RepeatingStaircaseRamp
+
+
+class RepetitionAverager(VirtualInstrument):
+    """
+    Streaming reducer of the data of a repeating staircase ramp.
+
+    Data buffers are passed to `add` in the order of
+    `values_with_repetitions_vector` of the ramp, in chunks of any length
+    (e.g. per trigger, per detector fetch, or as produced by
+    `iter_setpoint_chunks`). The running mean, variance and count per step
+    are updated for a whole chunk at once with the parallel form of
+    Welford's algorithm, in arrays that are allocated once per measurement.
+
+    The `mode` parameter chooses what is saved for a measurement:
+    'reduced' saves the mean, variance, standard error and count per step,
+    and the first `n_raw_repetitions` repetitions as a raw sample; 'raw'
+    keeps all the repetitions as raw data, the same as saving the buffers
+    directly.
+
+    Example:
+        averager = RepetitionAverager('averager', ramp, n_raw_repetitions=2)
+        averager.register_parameters(meas, setpoints=(f_acq_param,))
+        with meas.run() as datasaver:
+            for f in frequencies:
+                f_acq_param.set(f)
+                averager.reset()
+                for chunk in detector_chunks():
+                    averager.add(chunk)
+                averager.save(datasaver, (f_acq_param, f))
+
+    Args:
+        name
+            Name of the averager
+        ramp
+            Repeating staircase ramp whose repetitions are averaged
+        n_raw_repetitions
+            Number of the first repetitions to keep as a raw sample in the
+            'reduced' mode
+    """
+
+    def __init__(self,
+                 name: str,
+                 ramp: RepeatingStaircaseRamp,
+                 n_raw_repetitions: int = 0,
+                 **kwargs):
+        super().__init__(name, **kwargs)
+
+        self._ramp = ramp
+
+        self.add_parameter(name='mode',
+                           label='Saving mode',
+                           get_cmd=None,
+                           set_cmd=None,
+                           initial_value='reduced',
+                           vals=Enum('reduced', 'raw'),
+                           docstring="'reduced' to save the statistics per "
+                                     "step and a raw sample, 'raw' to save "
+                                     "all the repetitions"
+                           )
+        self.add_parameter(name='n_raw_repetitions',
+                           label='Number of raw repetitions to keep',
+                           unit='#',
+                           get_cmd=None,
+                           set_cmd=None,
+                           get_parser=int,
+                           initial_value=n_raw_repetitions,
+                           vals=Numbers(min_value=0),
+                           docstring="Number of the first repetitions that "
+                                     "are kept as a raw sample in the "
+                                     "'reduced' mode"
+                           )
+
+        self.add_parameter(name='mean',
+                           label='Mean',
+                           get_cmd=lambda: self._mean.copy(),
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Mean over the repetitions per step"
+                           )
+        self.add_parameter(name='variance',
+                           label='Variance',
+                           get_cmd=self._get_variance,
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Sample variance over the repetitions "
+                                     "per step"
+                           )
+        self.add_parameter(name='std_error',
+                           label='Standard error of the mean',
+                           get_cmd=self._get_std_error,
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Standard error of the mean per step"
+                           )
+        self.add_parameter(name='count',
+                           label='Number of repetitions',
+                           unit='#',
+                           get_cmd=lambda: self._count.copy(),
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Number of values averaged per step"
+                           )
+        self.add_parameter(name='raw_data',
+                           label='Raw data',
+                           get_cmd=self._get_raw_data,
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Raw data of the kept repetitions, "
+                                     "flattened in the order of "
+                                     "`raw_values_vector`"
+                           )
+        self.add_parameter(name='raw_values_vector',
+                           label='Voltage',
+                           unit='V',
+                           get_cmd=lambda: np.tile(self._ramp.values_vector(),
+                                                   self._n_raw_kept()),
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Ramp values of the points of "
+                                     "`raw_data`"
+                           )
+        self.add_parameter(name='raw_repetitions_vector',
+                           label='Vector of repetition indices',
+                           unit='',
+                           get_cmd=lambda: np.repeat(
+                               np.arange(self._n_raw_kept()),
+                               len(self._mean)),
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Repetition indices of the points of "
+                                     "`raw_data`"
+                           )
+
+        self.reset()
+
+    @property
+    def ramp(self) -> RepeatingStaircaseRamp:
+        return self._ramp
+
+    @property
+    def n_points_added(self) -> int:
+        return self._position
+
+    def reset(self) -> None:
+        """
+        Allocate (or clear) the arrays for a new measurement, according to
+        the current settings of the ramp and of the averager.
+        """
+        n_steps = self._ramp.n_steps()
+        if self.mode() == 'raw':
+            n_raw = self._ramp.n_repetitions()
+        else:
+            n_raw = min(self.n_raw_repetitions(), self._ramp.n_repetitions())
+
+        self._count = np.zeros(n_steps, dtype=int)
+        self._mean = np.zeros(n_steps)
+        self._m2 = np.zeros(n_steps)
+        self._raw = np.full((n_raw, n_steps), np.nan)
+        self._position = 0
+
+    def add(self, buffer: Sequence[float]) -> None:
+        """
+        Add a chunk of data that follows the previously added data in the
+        order of `values_with_repetitions_vector` of the ramp.
+        """
+        buffer = np.asarray(buffer, dtype=float).reshape(-1)
+        n_steps = len(self._mean)
+        positions = np.arange(self._position, self._position + len(buffer))
+        repetitions, steps = np.divmod(positions, n_steps)
+        self._position += len(buffer)
+
+        kept = repetitions < len(self._raw)
+        self._raw[repetitions[kept], steps[kept]] = buffer[kept]
+
+        # Statistics of the chunk per step, merged into the running ones
+        # (Chan et al. form of Welford's algorithm)
+        chunk_count = np.bincount(steps, minlength=n_steps)
+        in_chunk = chunk_count > 0
+        chunk_sum = np.bincount(steps, weights=buffer, minlength=n_steps)
+        chunk_mean = np.zeros(n_steps)
+        chunk_mean[in_chunk] = chunk_sum[in_chunk] / chunk_count[in_chunk]
+        chunk_m2 = np.bincount(steps,
+                               weights=(buffer - chunk_mean[steps]) ** 2,
+                               minlength=n_steps)
+
+        count = self._count + chunk_count
+        delta = chunk_mean - self._mean
+        weight = np.zeros(n_steps)
+        weight[in_chunk] = chunk_count[in_chunk] / count[in_chunk]
+        self._mean += delta * weight
+        self._m2 += chunk_m2 + delta ** 2 * self._count * weight
+        self._count = count
+
+    def _get_variance(self) -> np.ndarray:
+        variance = np.full(len(self._m2), np.nan)
+        enough = self._count > 1
+        variance[enough] = self._m2[enough] / (self._count[enough] - 1)
+        return variance
+
+    def _get_std_error(self) -> np.ndarray:
+        std_error = np.full(len(self._m2), np.nan)
+        enough = self._count > 1
+        std_error[enough] = np.sqrt(self._get_variance()[enough]
+                                    / self._count[enough])
+        return std_error
+
+    def _n_raw_kept(self) -> int:
+        """Number of raw repetitions that have been (partly) filled"""
+        n_steps = len(self._mean)
+        return min(len(self._raw), -(-self._position // n_steps))
+
+    def _get_raw_data(self) -> np.ndarray:
+        return self._raw[:self._n_raw_kept()].reshape(-1)
+
+    def _parameter_groups(self) -> List[Tuple[List[Parameter], Parameter]]:
+        """
+        Parameters that are saved in the current mode, each with the
+        parameters that are its setpoints within the ramp
+        """
+        if self.mode() == 'raw':
+            return [([self.raw_repetitions_vector, self.raw_values_vector],
+                     self.raw_data)]
+
+        groups = [([self._ramp.values_vector], parameter)
+                  for parameter in (self.mean, self.variance, self.std_error,
+                                    self.count)]
+        if self.n_raw_repetitions() > 0:
+            groups.append(([self.raw_repetitions_vector,
+                            self.raw_values_vector], self.raw_data))
+        return groups
+
+    def register_parameters(self,
+                            measurement,
+                            setpoints: Sequence[Parameter] = ()) -> None:
+        """
+        Register the parameters that are saved in the current mode in the
+        given `Measurement`.
+
+        Args:
+            measurement
+                The `Measurement` object
+            setpoints
+                Parameters of outer (slow) sweeps that are setpoints of
+                every saved parameter; they have to be registered already
+        """
+        for ramp_setpoints, parameter in self._parameter_groups():
+            for setpoint in ramp_setpoints:
+                if setpoint.full_name not in measurement.parameters:
+                    measurement.register_parameter(setpoint)
+            measurement.register_parameter(
+                parameter, setpoints=tuple(setpoints) + tuple(ramp_setpoints))
+
+    def result_groups(self) -> List[List[Tuple[Parameter, np.ndarray]]]:
+        """
+        Return the values of the parameters that are saved in the current
+        mode as groups of (parameter, value) pairs. The arrays within a
+        group have the same length, hence each group can be passed to one
+        `add_result` call of a datasaver (together with the scalar values
+        of the outer setpoints).
+        """
+        groups = []
+        previous_ramp_setpoints = None
+        for ramp_setpoints, parameter in self._parameter_groups():
+            if ramp_setpoints == previous_ramp_setpoints:
+                groups[-1].append((parameter, parameter.get()))
+            else:
+                groups.append([(setpoint, setpoint.get())
+                               for setpoint in ramp_setpoints]
+                              + [(parameter, parameter.get())])
+            previous_ramp_setpoints = ramp_setpoints
+        return groups
+
+    def save(self,
+             datasaver,
+             *outer_results: Tuple[Parameter, float]) -> None:
+        """
+        Add the results of the current mode to the datasaver.
+
+        Every group of `result_groups` is added with its own `add_result`
+        call, together with the given (parameter, value) pairs of the outer
+        setpoints. Groups have different columns, while QCoDeS writes the
+        buffered results of a datasaver with one set of columns, hence the
+        datasaver is flushed after each group if there is more than one.
+        """
+        groups = self.result_groups()
+        for group in groups:
+            datasaver.add_result(*outer_results, *group)
+            if len(groups) > 1:
+                datasaver.flush_data_to_database()
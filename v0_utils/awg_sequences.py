@@ -0,0 +1,492 @@
+"""
+This module contains a content-addressed cache for the AWG sequences that
+play the fast ramps of hardware sweeps.
+
+Building a sequence of a `RepeatingStaircaseRamp` with broadbean, forging
+it, writing the sequence file, uploading it to the AWG and assigning it to
+the channels takes seconds to tens of seconds. A sequencer keys every
+sequence by a hash of the ramp and channel settings, keeps the forged
+sequences on the local disk (evicting the least recently used ones), and
+remembers which sequences are loaded on the instrument, so that going back
+to settings that have been used before only re-assigns the channels (or
+does nothing, if the sequence is already assigned).
+
+Example:
+    sequencer = AWG5208RampSequencer(
+        awg, ramp, SequenceCache('awg_cache'),
+        settings={'channel': 1, 'amplitude': 1.0, 'sample_rate': 1e9,
+                  'step_duration': 10e-6})
+    sequencer.prepare()  # the first time: forge, upload, assign
+    ramp.n_steps(101)
+    sequencer.prepare()  # new settings: forge, upload, assign
+    ramp.n_steps(51)
+    sequencer.prepare()  # back to known settings: assign only
+"""
+
+import hashlib
+import io
+import json
+import os
+import pickle
+import posixpath
+import time
+import zipfile
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .ramps import StaircaseRamp
+
+
+def ramp_settings(ramp: StaircaseRamp) -> Dict[str, Any]:
+    """
+    Settings of a ramp that define its sequence: the values of all its
+    parameters that are included in snapshots (which leaves out the
+    setpoint vectors). The values are got rather than taken from the latest
+    ones, so that they have gone through the parsers of the parameters
+    (e.g. 1 and 1.0 give the same settings).
+    """
+    return OrderedDict(
+        (name, parameter.get())
+        for name, parameter in sorted(ramp.parameters.items())
+        if parameter._snapshot_value and name != 'IDN')
+
+
+def sequence_key(ramp: StaircaseRamp, settings: Dict[str, Any]) -> str:
+    """
+    Hash of the class and the settings of the ramp, and of the given channel
+    settings, which identifies a sequence.
+    """
+    description = {'ramp_class': type(ramp).__name__,
+                   'ramp': ramp_settings(ramp),
+                   'settings': settings}
+    return hashlib.sha1(json.dumps(description, sort_keys=True,
+                                   default=repr).encode()).hexdigest()
+
+
+class SequenceCache:
+    """
+    Cache of forged sequences on the local disk, with one pickle file per
+    key. When the total size exceeds `max_size` bytes, the least recently
+    used files are deleted (the modification time of a file is updated on
+    every hit).
+
+    Args:
+        directory
+            Directory of the cache files; it is created if necessary
+        max_size
+            Maximal total size of the cache files in bytes
+    """
+
+    def __init__(self, directory: str, max_size: int = 2 ** 30) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        The forged sequence stored under the key, or None if there is none
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                forged = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        os.utime(path)  # mark as recently used
+        self.hits += 1
+        return forged
+
+    def put(self, key: str, forged: Any) -> None:
+        """
+        Store a forged sequence under the key, and evict the least recently
+        used sequences if the cache is too large.
+        """
+        tmp_path = self._path(key) + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(forged, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+        self._evict(keep=key)
+
+    def _entries(self) -> List[os.DirEntry]:
+        return [entry for entry in os.scandir(self.directory)
+                if entry.name.endswith('.pkl')]
+
+    @property
+    def size(self) -> int:
+        """Total size of the cache files in bytes"""
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _evict(self, keep: str) -> None:
+        entries = sorted(self._entries(),
+                         key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_size:
+                break
+            if entry.name == f'{keep}.pkl':
+                continue
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+
+    def clear(self) -> None:
+        for entry in self._entries():
+            os.remove(entry.path)
+
+
+class CachedSequencer:
+    """
+    This is a base class for sequencers that prepare the AWG to play the
+    sequence of a ramp, using a `SequenceCache` and the knowledge of which
+    sequences are loaded on the instrument.
+
+    `prepare` does only the steps that are needed for the current settings:
+    if the sequence is assigned to the channels already, nothing; if it is
+    loaded on the instrument, assigning it; if it is in the cache, uploading
+    and assigning it; otherwise, also building and forging it.
+
+    Subclasses shall implement `build_and_forge`, `upload`, `assign` and
+    `remove`.
+
+    Args:
+        awg
+            The AWG instrument
+        ramp
+            Ramp whose sequence is played
+        cache
+            Cache of forged sequences
+        settings
+            Channel settings of the sequence (e.g. channel, amplitude,
+            sample rate, step duration), as a JSON-serializable dictionary
+        max_loaded_sequences
+            Maximal number of sequences that are kept on the instrument;
+            the least recently used ones are removed
+    """
+
+    def __init__(self,
+                 awg,
+                 ramp: StaircaseRamp,
+                 cache: SequenceCache,
+                 settings: Optional[Dict[str, Any]] = None,
+                 max_loaded_sequences: int = 20) -> None:
+        self.awg = awg
+        self.ramp = ramp
+        self.cache = cache
+        self.settings = dict(settings or {})
+        self.max_loaded_sequences = max_loaded_sequences
+
+        self._loaded = OrderedDict()  # sequence names on the instrument
+        self._assigned = None
+
+        self.n_forged = 0
+        self.n_uploads = 0
+        self.n_assignments = 0
+        self.timings = OrderedDict()
+
+    def key(self) -> str:
+        return sequence_key(self.ramp, self.settings)
+
+    @staticmethod
+    def sequence_name(key: str) -> str:
+        return f'ramp_{key[:12]}'
+
+    @property
+    def loaded_sequences(self) -> List[str]:
+        """Names of the sequences on the instrument, most recent last"""
+        return list(self._loaded)
+
+    def forget_instrument_state(self) -> None:
+        """
+        Forget which sequences are on the instrument, e.g. after the
+        sequence list of the AWG has been cleared by other code.
+        """
+        self._loaded.clear()
+        self._assigned = None
+
+    def prepare(self) -> str:
+        """
+        Make the AWG ready to play the sequence of the current settings.
+
+        Returns:
+            The step that was needed: 'assigned already', 'assigned',
+            'uploaded' (from the cache) or 'forged'
+        """
+        self.timings.clear()
+        key = self.key()
+        name = self.sequence_name(key)
+        if name == self._assigned:
+            return 'assigned already'
+
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+            step = 'assigned'
+        else:
+            t_start = time.perf_counter()
+            forged = self.cache.get(key)
+            step = 'uploaded'
+            if forged is None:
+                forged = self.build_and_forge()
+                self.cache.put(key, forged)
+                self.n_forged += 1
+                step = 'forged'
+            t_upload = time.perf_counter()
+            self.timings['forge'] = t_upload - t_start
+
+            while len(self._loaded) >= self.max_loaded_sequences:
+                old_name, _ = self._loaded.popitem(last=False)
+                self.remove(old_name)
+            self.upload(name, forged)
+            self._loaded[name] = True
+            self.n_uploads += 1
+            self.timings['upload'] = time.perf_counter() - t_upload
+
+        t_assign = time.perf_counter()
+        self.assign(name)
+        self._assigned = name
+        self.n_assignments += 1
+        self.timings['assign'] = time.perf_counter() - t_assign
+        return step
+
+    def build_and_forge(self) -> Any:
+        """
+        Build the sequence of the current settings and return it forged
+        (in a picklable form)
+        """
+        raise NotImplementedError("Subclasses of CachedSequencer should "
+                                  "implement build_and_forge method")
+
+    def upload(self, name: str, forged: Any) -> None:
+        """Upload the forged sequence to the instrument under the name"""
+        raise NotImplementedError("Subclasses of CachedSequencer should "
+                                  "implement upload method")
+
+    def assign(self, name: str) -> None:
+        """Assign the uploaded sequence of the name to the channels"""
+        raise NotImplementedError("Subclasses of CachedSequencer should "
+                                  "implement assign method")
+
+    def remove(self, name: str) -> None:
+        """Remove the sequence of the name from the instrument"""
+        raise NotImplementedError("Subclasses of CachedSequencer should "
+                                  "implement remove method")
+
+
+class AWG5208RampSequencer(CachedSequencer):
+    """
+    Sequencer of a `RepeatingStaircaseRamp` on a Tektronix AWG5208 (or
+    another AWG70000A-series instrument), built with broadbean.
+
+    The sequence has one element with a staircase of `n_steps` steps of
+    `step_duration` each, with a marker pulse of `marker_duration` at the
+    start of every step (to trigger the detectors), which is repeated
+    `n_repetitions` times.
+
+    The settings are: 'channel' (number of the AWG channel), 'amplitude'
+    (peak-to-peak voltage of the channel), 'sample_rate', 'step_duration',
+    'marker_duration' (optional, by default 100 ns), and 'marker'
+    (number of the marker of the channel, by default 1).
+
+    This sequencer requires broadbean.
+    """
+
+    def build_and_forge(self) -> Dict:
+        import broadbean as bb
+
+        sample_rate = self.settings['sample_rate']
+        step_duration = self.settings['step_duration']
+        marker_duration = self.settings.get('marker_duration', 100e-9)
+        marker = self.settings.get('marker', 1)
+
+        blueprint = bb.BluePrint()
+        blueprint.setSR(sample_rate)
+        for i, value in enumerate(self.ramp.values_vector()):
+            blueprint.insertSegment(-1, bb.PulseAtoms.ramp, (value, value),
+                                    dur=step_duration,
+                                    # broadbean refuses segment names that
+                                    # end in a number
+                                    name=f'step{i}_')
+        setattr(blueprint, f'marker{marker}',
+                [(i * step_duration, marker_duration)
+                 for i in range(self.ramp.n_steps())])
+
+        element = bb.Element()
+        element.addBluePrint(self.settings['channel'], blueprint)
+
+        sequence = bb.Sequence()
+        sequence.addElement(1, element)
+        sequence.setSR(sample_rate)
+        sequence.setChannelAmplitude(self.settings['channel'],
+                                     self.settings['amplitude'])
+        sequence.setChannelOffset(self.settings['channel'], 0)
+        sequence.setSequencingTriggerWait(1, 0)
+        sequence.setSequencingNumberOfRepetitions(
+            1, self.ramp.n_repetitions())
+        sequence.setSequencingGoto(1, 0)
+        if not sequence.checkConsistency():
+            raise ValueError("The broadbean sequence of the ramp is not "
+                             "consistent.")
+
+        forged = sequence.forge(apply_delays=False, apply_filters=False)
+        waveform = forged[1]['content'][1]['data'][
+            self.settings['channel']]['wfm']
+        n_samples = int(round(self.ramp.n_steps() * step_duration
+                              * sample_rate))
+        if len(waveform) != n_samples:
+            raise ValueError(f"The forged staircase has {len(waveform)} "
+                             f"samples instead of {n_samples}.")
+        return forged
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # names of the waveforms of the loaded sequences
+        self._waveforms = {}
+
+    def upload(self, name: str, forged: Dict) -> None:
+        seqx = self.awg.make_SEQX_from_forged_sequence(
+            forged, [self.settings['amplitude']], name)
+        seqx, self._waveforms[name] = _rename_seqx_waveforms(seqx, name)
+        filename = f'{name}.seqx'
+        self.awg.sendSEQXFile(seqx, filename)
+        self.awg.loadSEQXFile(filename)
+
+    def assign(self, name: str) -> None:
+        channel = self.awg.channels[self.settings['channel'] - 1]
+        channel.setSequenceTrack(name, 1)
+
+    def remove(self, name: str) -> None:
+        self.awg.write(f'SLISt:SEQuence:DELete "{name}"')
+        for waveform_name in self._waveforms.pop(name, ()):
+            self.awg.write(f'WLISt:WAVeform:DELete "{waveform_name}"')
+
+    def forget_instrument_state(self) -> None:
+        super().forget_instrument_state()
+        self._waveforms.clear()
+
+
+def _waveform_name(sequence_name: str, name: str) -> str:
+    """
+    Name of a waveform of a sequence in the waveform list of the AWG
+    """
+    return f'{sequence_name}_{name}'
+
+
+def _rename_seqx_waveforms(seqx: bytes,
+                           sequence_name: str) -> Tuple[bytes, List[str]]:
+    """
+    Prefix the names of the waveforms in a SEQX file with the name of the
+    sequence. The waveforms of SEQX files are named after their position in
+    the sequence only, hence loading a sequence would overwrite the
+    waveforms of the sequences that are loaded already.
+
+    Returns:
+        The SEQX file, and the new names of its waveforms
+    """
+    names = {}
+    files = []
+    with zipfile.ZipFile(io.BytesIO(seqx)) as seqx_file:
+        for info in seqx_file.infolist():
+            files.append((info.filename, seqx_file.read(info)))
+            folder, filename = posixpath.split(info.filename)
+            if folder == 'Waveforms':
+                name = posixpath.splitext(filename)[0]
+                names[name] = _waveform_name(sequence_name, name)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, mode='w') as seqx_file:
+        for filename, content in files:
+            folder, basename = posixpath.split(filename)
+            if folder == 'Waveforms':
+                name = posixpath.splitext(basename)[0]
+                filename = f'Waveforms/{names[name]}.wfmx'
+            elif folder == 'Sequences':
+                for name, new_name in names.items():
+                    content = content.replace(
+                        f'<AssetName>{name}</AssetName>'.encode(),
+                        f'<AssetName>{new_name}</AssetName>'.encode())
+            seqx_file.writestr(filename, content)
+    return buffer.getvalue(), list(names.values())
+
+
+class FakeAWG:
+    """
+    Stand-in for an AWG that counts the uploads and assignments, and takes
+    `upload_latency` seconds per upload; useful for testing sequencers
+    without hardware.
+
+    As on the instrument, the waveforms of the sequences are kept in one
+    waveform list, by name: uploading a sequence whose waveform has the
+    name of the waveform of another sequence replaces what that sequence
+    plays.
+    """
+
+    def __init__(self, upload_latency: float = 0.) -> None:
+        self.upload_latency = upload_latency
+        self.sequences = OrderedDict()  # waveform names per sequence
+        self.waveforms = OrderedDict()
+        self.assigned = None
+        self.n_uploads = 0
+        self.n_assignments = 0
+
+    def upload(self, name: str, waveform: np.ndarray,
+               waveform_name: str = 'wfm_1_1_1') -> None:
+        time.sleep(self.upload_latency)
+        self.waveforms[waveform_name] = waveform
+        self.sequences[name] = waveform_name
+        self.n_uploads += 1
+
+    def assign(self, name: str) -> None:
+        if name not in self.sequences:
+            raise KeyError(f"Sequence {name} is not loaded.")
+        self.assigned = name
+        self.n_assignments += 1
+
+    @property
+    def played(self) -> Optional[np.ndarray]:
+        """Waveform of the assigned sequence"""
+        if self.assigned is None:
+            return None
+        return self.waveforms[self.sequences[self.assigned]]
+
+    def remove(self, name: str) -> None:
+        del self.sequences[name]
+
+    def remove_waveform(self, waveform_name: str) -> None:
+        del self.waveforms[waveform_name]
+
+
+class MockRampSequencer(CachedSequencer):
+    """
+    Sequencer for a `FakeAWG`: the forged sequence is the staircase
+    waveform of the ramp with `samples_per_step` samples per step, and
+    forging it takes `forge_latency` seconds.
+    """
+
+    def __init__(self, *args, forge_latency: float = 0.,
+                 samples_per_step: int = 100, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.forge_latency = forge_latency
+        self.samples_per_step = samples_per_step
+
+    def build_and_forge(self) -> np.ndarray:
+        time.sleep(self.forge_latency)
+        return np.repeat(self.ramp.values_vector(), self.samples_per_step)
+
+    def upload(self, name: str, forged: np.ndarray) -> None:
+        self.awg.upload(name, forged, _waveform_name(name, 'wfm_1_1_1'))
+
+    def assign(self, name: str) -> None:
+        self.awg.assign(name)
+
+    def remove(self, name: str) -> None:
+        self.awg.remove(name)
+        self.awg.remove_waveform(_waveform_name(name, 'wfm_1_1_1'))
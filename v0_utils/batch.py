@@ -0,0 +1,372 @@
+"""
+This module contains a pipeline for processing many runs in batch on a pool
+of processes.
+
+A pipeline is a chain of stages, each of which takes the gridded data of a
+run (a dictionary of `GriddedParameter`s per parameter name) and returns the
+processed data. The first stage is usually `LoadGrid`, and the last ones are
+exports (`ExportArrays`, `ExportImages`). Runs are spread over a process
+pool, and runs whose outputs are up to date are skipped.
+
+Stages are sent to the worker processes, hence they have to be picklable
+(i.e. objects of classes defined in a module, not lambdas).
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+import qcodes
+from qcodes.dataset.data_set import load_by_id
+
+from .gridded_data import GriddedParameter, load_gridded_run, _last_row_id
+from .rf_calibration import RFConductanceCalibration
+from .smoothing import smooth
+
+GriddedRun = Dict[str, GriddedParameter]
+
+
+class Stage:
+    """
+    Base class for stages of a batch pipeline. Subclasses shall implement
+    `process` method.
+
+    Args:
+        parameters
+            Names of the parameters that the stage processes; by default,
+            all the parameters of the run
+    """
+
+    def __init__(self, parameters: Optional[Sequence[str]] = None) -> None:
+        self.parameters = parameters
+
+    def _selected(self, run: GriddedRun) -> List[str]:
+        if self.parameters is None:
+            return list(run)
+        return list(self.parameters)
+
+    def process(self, run_id: int, run: GriddedRun) -> GriddedRun:
+        raise NotImplementedError("Subclasses of Stage should implement "
+                                  "process method")
+
+
+class LoadGrid(Stage):
+    """
+    Load the run as gridded data (see
+    `v0_utils.gridded_data.load_gridded_run`); any data coming from previous
+    stages is kept.
+    """
+
+    def __init__(self,
+                 parameters: Optional[Sequence[str]] = None,
+                 decimals: Optional[int] = None) -> None:
+        super().__init__(parameters)
+        self.decimals = decimals
+
+    def process(self, run_id: int, run: GriddedRun) -> GriddedRun:
+        run = dict(run)
+        run.update(load_gridded_run(run_id, self.parameters,
+                                    decimals=self.decimals))
+        return run
+
+
+class ApplyRFCalibration(Stage):
+    """
+    Convert RF magnitude parameters into conductance with the given
+    calibration. The converted parameter gets the name of the original one
+    with the given suffix.
+    """
+
+    def __init__(self,
+                 calibration: RFConductanceCalibration,
+                 parameters: Sequence[str],
+                 suffix: str = '_g',
+                 method: str = 'linear') -> None:
+        super().__init__(parameters)
+        self.calibration = calibration
+        self.suffix = suffix
+        self.method = method
+
+    def process(self, run_id: int, run: GriddedRun) -> GriddedRun:
+        run = dict(run)
+        for name in self._selected(run):
+            converted = self.calibration.convert(run[name].data, self.method)
+            run[name + self.suffix] = run[name]._replace(
+                name=name + self.suffix, data=converted)
+        return run
+
+
+class Smooth(Stage):
+    """
+    Smooth parameters along one of the grid axes with a Savitzky-Golay
+    filter (see `v0_utils.smoothing.smooth`), in place of the original data.
+    """
+
+    def __init__(self,
+                 window_size: int,
+                 order: int,
+                 axis: int = -1,
+                 parameters: Optional[Sequence[str]] = None) -> None:
+        super().__init__(parameters)
+        self.window_size = window_size
+        self.order = order
+        self.axis = axis
+
+    def process(self, run_id: int, run: GriddedRun) -> GriddedRun:
+        run = dict(run)
+        for name in self._selected(run):
+            smoothed = smooth(run[name].data, self.window_size, self.order,
+                              axis=self.axis)
+            run[name] = run[name]._replace(data=smoothed)
+        return run
+
+
+class Derivative(Stage):
+    """
+    Take the numerical derivative of parameters along one of the grid axes,
+    with respect to the values of that axis. The derivative gets the name of
+    the original parameter with the given suffix.
+    """
+
+    def __init__(self,
+                 axis: int = -1,
+                 suffix: str = '_deriv',
+                 parameters: Optional[Sequence[str]] = None) -> None:
+        super().__init__(parameters)
+        self.axis = axis
+        self.suffix = suffix
+
+    def process(self, run_id: int, run: GriddedRun) -> GriddedRun:
+        run = dict(run)
+        for name in self._selected(run):
+            parameter = run[name]
+            coordinates = parameter.axes[self.axis]
+            derivative = np.gradient(np.asarray(parameter.data),
+                                     coordinates, axis=self.axis)
+            run[name + self.suffix] = parameter._replace(
+                name=name + self.suffix, data=derivative)
+        return run
+
+
+class ExportArrays(Stage):
+    """
+    Save parameters as `.npy` files into "run_<run_id>" subdirectory of the
+    given directory: "<name>.npy" for the data, and "<name>_axis_<i>.npy"
+    for the axes.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 parameters: Optional[Sequence[str]] = None) -> None:
+        super().__init__(parameters)
+        self.directory = directory
+
+    def process(self, run_id: int, run: GriddedRun) -> GriddedRun:
+        run_dir = os.path.join(self.directory, f'run_{run_id}')
+        os.makedirs(run_dir, exist_ok=True)
+        for name in self._selected(run):
+            np.save(os.path.join(run_dir, f'{name}.npy'), run[name].data)
+            for i, axis in enumerate(run[name].axes):
+                np.save(os.path.join(run_dir, f'{name}_axis_{i}.npy'), axis)
+        return run
+
+
+class ExportImages(Stage):
+    """
+    Save 2D parameters as colour-mapped `.png` images into "run_<run_id>"
+    subdirectory of the given directory. The first axis of the data runs
+    along the image height. Parameters that are not 2D are skipped.
+
+    This stage requires matplotlib.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 cmap: str = 'viridis',
+                 vmin: Optional[float] = None,
+                 vmax: Optional[float] = None,
+                 parameters: Optional[Sequence[str]] = None) -> None:
+        super().__init__(parameters)
+        self.directory = directory
+        self.cmap = cmap
+        self.vmin = vmin
+        self.vmax = vmax
+
+    def process(self, run_id: int, run: GriddedRun) -> GriddedRun:
+        import matplotlib.pyplot as plt
+
+        run_dir = os.path.join(self.directory, f'run_{run_id}')
+        os.makedirs(run_dir, exist_ok=True)
+        for name in self._selected(run):
+            if np.ndim(run[name].data) != 2:
+                continue
+            plt.imsave(os.path.join(run_dir, f'{name}.png'),
+                       np.asarray(run[name].data), cmap=self.cmap,
+                       vmin=self.vmin, vmax=self.vmax, origin='lower')
+        return run
+
+
+class RunResult(NamedTuple):
+    """
+    Outcome of processing one run: its status ('processed', 'skipped' or
+    'failed'), the time it took in seconds, and the error message if it
+    failed.
+    """
+    run_id: int
+    status: str
+    duration: float
+    error: Optional[str] = None
+
+
+class BatchReport(NamedTuple):
+    """
+    Outcome of processing a batch of runs.
+    """
+    results: List[RunResult]
+    duration: float
+
+    @property
+    def n_processed(self) -> int:
+        return sum(result.status == 'processed' for result in self.results)
+
+    @property
+    def throughput(self) -> float:
+        """Number of processed runs per second of wall time"""
+        return self.n_processed / self.duration if self.duration else 0.
+
+    def __str__(self) -> str:
+        counts = {status: sum(result.status == status
+                              for result in self.results)
+                  for status in ('processed', 'skipped', 'failed')}
+        lines = [f"{counts['processed']} processed, "
+                 f"{counts['skipped']} skipped, {counts['failed']} failed "
+                 f"in {self.duration:.1f} s "
+                 f"({self.throughput:.2f} runs/s)"]
+        lines += [f"run {result.run_id} failed: {result.error}"
+                  for result in self.results if result.status == 'failed']
+        return '\n'.join(lines)
+
+
+def _set_up_worker(db_location: str, memory_limit: Optional[int]) -> None:
+    qcodes.config.core.db_location = db_location
+    if memory_limit is not None:
+        try:
+            import resource
+        except ImportError:  # not available on Windows
+            return
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def _stamp_path(stamp_dir: str, run_id: int) -> str:
+    return os.path.join(stamp_dir, f'run_{run_id}.done.json')
+
+
+def _stamp(run_id: int, signature: str) -> Dict:
+    dataset = load_by_id(run_id)
+    return {'signature': signature, 'last_row_id': _last_row_id(dataset)}
+
+
+def _process_run(run_id: int,
+                 stages: Sequence[Stage],
+                 signature: str,
+                 stamp_dir: str,
+                 force: bool,
+                 db_location: str,
+                 memory_limit: Optional[int]) -> RunResult:
+    t_start = time.perf_counter()
+    try:
+        _set_up_worker(db_location, memory_limit)
+        stamp = _stamp(run_id, signature)
+        stamp_path = _stamp_path(stamp_dir, run_id)
+        if not force and os.path.exists(stamp_path):
+            with open(stamp_path) as stamp_file:
+                if json.load(stamp_file) == stamp:
+                    return RunResult(run_id, 'skipped',
+                                     time.perf_counter() - t_start)
+
+        run = {}
+        for stage in stages:
+            run = stage.process(run_id, run)
+
+        os.makedirs(stamp_dir, exist_ok=True)
+        with open(stamp_path, 'w') as stamp_file:
+            json.dump(stamp, stamp_file)
+    except Exception as exception:
+        return RunResult(run_id, 'failed', time.perf_counter() - t_start,
+                         f"{type(exception).__name__}: {exception}")
+    return RunResult(run_id, 'processed', time.perf_counter() - t_start)
+
+
+class BatchPipeline:
+    """
+    Chain of stages that is applied to many runs on a process pool.
+
+    After a run has been processed, a stamp file is written into
+    `stamp_dir`. The stamp records the stages (their pickled form) and the
+    number of rows of the run, and a run whose stamp matches is skipped the
+    next time, since its outputs are up to date.
+
+    Args:
+        stages
+            Stages to apply to each run, in order
+        stamp_dir
+            Directory for the stamp files, usually the directory where the
+            outputs are exported to
+    """
+
+    def __init__(self, stages: Sequence[Stage], stamp_dir: str) -> None:
+        self.stages = list(stages)
+        self.stamp_dir = stamp_dir
+
+    @property
+    def signature(self) -> str:
+        return hashlib.sha1(pickle.dumps(self.stages)).hexdigest()
+
+    def run(self,
+            run_ids: Sequence[int],
+            max_workers: Optional[int] = None,
+            memory_limit: Optional[int] = None,
+            force: bool = False,
+            verbose: bool = True) -> BatchReport:
+        """
+        Process the given runs of the database that QCoDeS refers to.
+
+        Args:
+            run_ids
+                IDs of the runs to process
+            max_workers
+                Number of worker processes; by default, the number of CPUs
+            memory_limit
+                Maximal size of the address space of each worker process in
+                bytes; a run that needs more fails with MemoryError instead
+                of exhausting the memory of the computer (not enforced on
+                Windows)
+            force
+                If True, runs are processed even if their outputs are up to
+                date
+            verbose
+                Whether to print the report
+
+        Returns:
+            The report with the outcome per run and the throughput
+        """
+        signature = self.signature
+        db_location = qcodes.config.core.db_location
+
+        t_start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_process_run, run_id, self.stages,
+                                       signature, self.stamp_dir, force,
+                                       db_location, memory_limit)
+                       for run_id in run_ids]
+            results = [future.result() for future in futures]
+
+        report = BatchReport(results, time.perf_counter() - t_start)
+        if verbose:
+            print(report)
+        return report
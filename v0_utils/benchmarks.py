@@ -0,0 +1,531 @@
+"""
+This module contains benchmarks of the sweep code of `v0_utils` against
+simulated instruments with configurable latencies, so that the throughput
+of the hot paths can be measured without a cold fridge.
+
+Each benchmark reports the number of points per second, the time spent in
+its stages and (optionally) the peak memory allocated by Python and numpy.
+The results can be saved to a file together with the current git commit,
+and compared with earlier results to spot regressions:
+
+    results = run_benchmarks()
+    print_benchmark_results(results)
+    save_benchmark_results(results, 'benchmarks.jsonl')
+    compare_benchmark_results(
+        load_benchmark_results('benchmarks.jsonl')[-2]['results'], results)
+"""
+
+import json
+import os
+import subprocess
+import time
+import tracemalloc
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import numpy as np
+from qcodes import Parameter
+from qcodes.dataset.measurements import Measurement
+from qcodes.utils.validators import Numbers
+
+from .hwsweep import HardwareSweep, MockDetector
+from .qcodes_tools import (DelegateParameter, VirtualInstrument,
+                           load_or_create_experiment, temporary_database)
+from .ramps import RepeatingStaircaseRamp
+from .software_sweep import SoftwareSweep
+
+
+class BenchmarkResult(NamedTuple):
+    """
+    Result of a benchmark: the number of points processed, the total
+    duration and the durations of the stages in seconds, and the peak memory
+    allocated during the benchmark in bytes (None if it was not tracked).
+    """
+    name: str
+    n_points: int
+    duration: float
+    stage_times: Dict[str, float]
+    peak_memory: Optional[int] = None
+
+    @property
+    def points_per_second(self) -> float:
+        return self.n_points / self.duration if self.duration else 0.
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name,
+                'n_points': self.n_points,
+                'duration': self.duration,
+                'points_per_second': self.points_per_second,
+                'stage_times': dict(self.stage_times),
+                'peak_memory': self.peak_memory}
+
+
+class SimulatedInstrument(VirtualInstrument):
+    """
+    Instrument that does not talk to any hardware: setting its `level`
+    takes `set_latency` seconds, and getting its `reading` takes
+    `get_latency` seconds (during which the thread sleeps, as it would wait
+    for the reply of a real instrument).
+
+    Args:
+        name
+            Name of the instrument
+        get_latency
+            Latency of getting `reading` in seconds
+        set_latency
+            Latency of setting `level` in seconds
+        response
+            Function without arguments that returns the value of `reading`;
+            by default, the level plus normally distributed noise
+    """
+
+    def __init__(self,
+                 name: str,
+                 get_latency: float = 0.,
+                 set_latency: float = 0.,
+                 response: Optional[Callable[[], float]] = None,
+                 **kwargs):
+        super().__init__(name, **kwargs)
+
+        self._level = 0.
+        self._response = response \
+            or (lambda: self._level + 1e-3 * np.random.standard_normal())
+
+        self.add_parameter(name='get_latency',
+                           label='Get latency',
+                           unit='s',
+                           get_cmd=None,
+                           set_cmd=None,
+                           initial_value=get_latency,
+                           vals=Numbers(min_value=0),
+                           docstring="Time that getting the reading takes"
+                           )
+        self.add_parameter(name='set_latency',
+                           label='Set latency',
+                           unit='s',
+                           get_cmd=None,
+                           set_cmd=None,
+                           initial_value=set_latency,
+                           vals=Numbers(min_value=0),
+                           docstring="Time that setting the level takes"
+                           )
+        self.add_parameter(name='level',
+                           label='Level',
+                           unit='V',
+                           get_cmd=lambda: self._level,
+                           set_cmd=self._set_level,
+                           vals=Numbers(),
+                           docstring="Output level"
+                           )
+        self.add_parameter(name='reading',
+                           label='Reading',
+                           unit='V',
+                           get_cmd=self._get_reading,
+                           set_cmd=False,
+                           docstring="Measured value"
+                           )
+
+    def _set_level(self, value: float) -> None:
+        # time.sleep(0) still takes tens of microseconds, hence it is skipped
+        if self.set_latency():
+            time.sleep(self.set_latency())
+        self._level = value
+
+    def _get_reading(self) -> float:
+        if self.get_latency():
+            time.sleep(self.get_latency())
+        return float(self._response())
+
+
+class SimulatedLockInSweep(HardwareSweep):
+    """
+    Hardware sweep of a repeating staircase ramp with lock-ins whose data
+    buffers are simulated by `MockDetector`s. Triggering takes
+    `trigger_latency` seconds (e.g. starting the AWG), and each lock-in
+    takes `fetch_latency` seconds to deliver its buffer.
+
+    Args:
+        name
+            Name of the hardware sweep
+        ramp
+            Ramp whose `n_all_steps` points are acquired per run
+        n_lockins
+            Number of simulated lock-ins
+        fetch_latency
+            Time that fetching a buffer from a lock-in takes, in seconds
+        trigger_latency
+            Time that triggering the sweep takes, in seconds
+    """
+
+    def __init__(self,
+                 name: str,
+                 ramp: RepeatingStaircaseRamp,
+                 n_lockins: int = 2,
+                 fetch_latency: float = 0.,
+                 trigger_latency: float = 0.,
+                 **kwargs):
+        super().__init__(name, **kwargs)
+
+        self.ramp = ramp
+        self.trigger_latency = trigger_latency
+        for i in range(n_lockins):
+            detector = MockDetector(f'{name}_lockin{i + 1}')
+            detector.fetch_latency(fetch_latency)
+            self.add_detector(f'lockin{i + 1}', detector)
+
+    def trigger(self) -> None:
+        time.sleep(self.trigger_latency)
+
+    def run(self):
+        return self.acquire(self.ramp.n_all_steps())
+
+
+def _make_ramp(name: str, n_steps: int,
+               n_repetitions: int) -> RepeatingStaircaseRamp:
+    ramp = RepeatingStaircaseRamp(name)
+    ramp.start_ramp_voltage(-0.1)
+    ramp.finish_ramp_voltage(0.1)
+    ramp.n_steps(n_steps)
+    ramp.n_repetitions(n_repetitions)
+    return ramp
+
+
+def benchmark_ramp_vectors(n_steps: int = 1000,
+                           n_repetitions: int = 100,
+                           n_iterations: int = 100) -> BenchmarkResult:
+    """
+    Time building the setpoint vectors of a repeating staircase ramp after
+    its settings change, reading them from the cache, and iterating over
+    them in chunks. The points are the points of the repeated ramp that
+    each stage produces.
+    """
+    ramp = _make_ramp('benchmark_ramp', n_steps, n_repetitions)
+    stage_times = OrderedDict()
+    n_points = 0
+
+    t_start = time.perf_counter()
+    for i in range(n_iterations):
+        ramp.n_steps(n_steps + i % 2)  # drops the cache
+        n_points += len(ramp.values_with_repetitions_vector())
+        ramp.all_repetitions_vector()
+    stage_times['build'] = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    for _ in range(n_iterations):
+        n_points += len(ramp.values_with_repetitions_vector())
+        ramp.all_repetitions_vector()
+    stage_times['cached_read'] = time.perf_counter() - t_start
+
+    # the chunks walk the ramp once
+    t_start = time.perf_counter()
+    for values, _ in ramp.iter_setpoint_chunks(
+            max(1, n_steps * n_repetitions // n_iterations)):
+        n_points += len(values)
+    stage_times['chunks'] = time.perf_counter() - t_start
+
+    return BenchmarkResult('ramp_vectors', n_points,
+                           sum(stage_times.values()), stage_times)
+
+
+def benchmark_delegate_parameter(n_calls: int = 100000) -> BenchmarkResult:
+    """
+    Time getting and setting a parameter without latency directly and via a
+    `DelegateParameter`, which shows the overhead of the Python layers per
+    call. The points are the calls.
+    """
+    instrument = SimulatedInstrument('benchmark_delegate_instrument')
+    delegate = DelegateParameter('benchmark_delegate', instrument.level)
+    stage_times = OrderedDict()
+
+    for stage, function in (('source_get', instrument.level.get),
+                            ('delegate_get', delegate.get)):
+        t_start = time.perf_counter()
+        for _ in range(n_calls):
+            function()
+        stage_times[stage] = time.perf_counter() - t_start
+
+    for stage, function in (('source_set', instrument.level.set),
+                            ('delegate_set', delegate.set)):
+        t_start = time.perf_counter()
+        for i in range(n_calls):
+            function(0.5)
+        stage_times[stage] = time.perf_counter() - t_start
+
+    return BenchmarkResult('delegate_parameter', 4 * n_calls,
+                           sum(stage_times.values()), stage_times)
+
+
+def benchmark_hardware_sweep(n_steps: int = 1000,
+                             n_repetitions: int = 10,
+                             n_lockins: int = 2,
+                             fetch_latency: float = 0.01,
+                             trigger_latency: float = 0.001,
+                             n_sweeps: int = 20) -> BenchmarkResult:
+    """
+    Time hardware sweeps with simulated lock-ins, and saving their buffers
+    against the setpoints of the ramp into a temporary database. The points
+    are the points of the repeated ramp of all the sweeps.
+    """
+    ramp = _make_ramp('benchmark_hwsweep_ramp', n_steps, n_repetitions)
+    sweep = SimulatedLockInSweep('benchmark_hwsweep', ramp,
+                                 n_lockins=n_lockins,
+                                 fetch_latency=fetch_latency,
+                                 trigger_latency=trigger_latency)
+    sweep_index = Parameter('sweep_index', set_cmd=None, get_cmd=None)
+    readouts = [Parameter(f'lockin{i + 1}', set_cmd=None, get_cmd=None)
+                for i in range(n_lockins)]
+    stage_times = OrderedDict([('acquire', 0.), ('setpoints', 0.),
+                               ('add_result', 0.), ('flush', 0.)])
+
+    with temporary_database():
+        experiment = load_or_create_experiment('benchmark', 'no sample')
+        measurement = Measurement(exp=experiment)
+        measurement.register_parameter(sweep_index)
+        measurement.register_parameter(ramp.values_with_repetitions_vector)
+        for readout in readouts:
+            measurement.register_parameter(
+                readout, setpoints=(sweep_index,
+                                    ramp.values_with_repetitions_vector))
+
+        with measurement.run() as datasaver:
+            for i in range(n_sweeps):
+                t_start = time.perf_counter()
+                data = sweep.run()
+                t_setpoints = time.perf_counter()
+                setpoints = ramp.values_with_repetitions_vector()
+                t_add = time.perf_counter()
+                datasaver.add_result(
+                    (sweep_index, i),
+                    (ramp.values_with_repetitions_vector, setpoints),
+                    *zip(readouts, data.values()))
+                t_done = time.perf_counter()
+                stage_times['acquire'] += t_setpoints - t_start
+                stage_times['setpoints'] += t_add - t_setpoints
+                stage_times['add_result'] += t_done - t_add
+            t_flush = time.perf_counter()
+            datasaver.flush_data_to_database()
+            stage_times['flush'] += time.perf_counter() - t_flush
+
+    return BenchmarkResult('hardware_sweep',
+                           n_sweeps * n_steps * n_repetitions,
+                           sum(stage_times.values()), stage_times)
+
+
+def benchmark_dc_iv_sweep(n_points: int = 200,
+                          set_latency: float = 0.002,
+                          get_latency: float = 0.005,
+                          settle_time: float = 0.) -> BenchmarkResult:
+    """
+    Time a DC IV-style software sweep with `SoftwareSweep`: a simulated
+    voltage source and two simulated meters (current and voltage) read
+    through `DelegateParameter`s, saved into a temporary database. The
+    points are the setpoints of the sweep.
+    """
+    resistance = 1e5
+    source = SimulatedInstrument('benchmark_iv_source',
+                                 set_latency=set_latency)
+    current_meter = SimulatedInstrument(
+        'benchmark_iv_current_meter', get_latency=get_latency,
+        response=lambda: source.level() / resistance)
+    voltage_meter = SimulatedInstrument(
+        'benchmark_iv_voltage_meter', get_latency=get_latency,
+        response=lambda: source.level())
+    bias = DelegateParameter('benchmark_bias', source.level)
+    current = DelegateParameter('benchmark_current', current_meter.reading,
+                                unit='A')
+    voltage = DelegateParameter('benchmark_voltage', voltage_meter.reading)
+
+    sweep = SoftwareSweep(bias, [current, voltage], settle_time=settle_time)
+    with temporary_database():
+        experiment = load_or_create_experiment('benchmark', 'no sample')
+        measurement = Measurement(exp=experiment)
+        sweep.register_parameters(measurement)
+        t_start = time.perf_counter()
+        with measurement.run() as datasaver:
+            report = sweep.run(np.linspace(-1e-3, 1e-3, n_points),
+                               datasaver)
+            t_flush = time.perf_counter()
+        t_done = time.perf_counter()
+
+    stage_times = OrderedDict(
+        [('set', report.set_time * n_points),
+         ('settle', report.settle_time * n_points),
+         ('read', report.read_time * n_points),
+         ('add_result', report.duration - n_points * (report.set_time
+                                                      + report.settle_time
+                                                      + report.read_time)),
+         ('flush', t_done - t_flush)])
+    return BenchmarkResult('dc_iv_sweep', n_points, t_done - t_start,
+                           stage_times)
+
+
+def benchmark_dataset_writes(n_rows: int = 10000,
+                             rows_per_result: int = 100,
+                             write_period: float = 1.) -> BenchmarkResult:
+    """
+    Time saving results into a temporary database: scalar results (one row
+    per `add_result`) and array results (`rows_per_result` rows per
+    `add_result`). The points are the rows.
+    """
+    setter = Parameter('setter', set_cmd=None, get_cmd=None)
+    readout = Parameter('readout', set_cmd=None, get_cmd=None)
+    values = np.random.standard_normal(n_rows)
+    stage_times = OrderedDict()
+
+    with temporary_database():
+        experiment = load_or_create_experiment('benchmark', 'no sample')
+        measurement = Measurement(exp=experiment)
+        measurement.write_period = write_period
+        measurement.register_parameter(setter)
+        measurement.register_parameter(readout, setpoints=(setter,))
+
+        t_start = time.perf_counter()
+        with measurement.run() as datasaver:
+            for i in range(n_rows):
+                datasaver.add_result((setter, i), (readout, values[i]))
+        stage_times['scalar_results'] = time.perf_counter() - t_start
+
+        setpoints = np.arange(n_rows)
+        t_start = time.perf_counter()
+        with measurement.run() as datasaver:
+            for start in range(0, n_rows, rows_per_result):
+                stop = start + rows_per_result
+                datasaver.add_result((setter, setpoints[start:stop]),
+                                     (readout, values[start:stop]))
+        stage_times['array_results'] = time.perf_counter() - t_start
+
+    return BenchmarkResult('dataset_writes', 2 * n_rows,
+                           sum(stage_times.values()), stage_times)
+
+
+BENCHMARKS = OrderedDict([('ramp_vectors', benchmark_ramp_vectors),
+                          ('delegate_parameter',
+                           benchmark_delegate_parameter),
+                          ('hardware_sweep', benchmark_hardware_sweep),
+                          ('dc_iv_sweep', benchmark_dc_iv_sweep),
+                          ('dataset_writes', benchmark_dataset_writes)])
+
+
+def run_benchmarks(names: Optional[List[str]] = None,
+                   track_memory: bool = True,
+                   **kwargs: Dict) -> Dict[str, BenchmarkResult]:
+    """
+    Run the benchmarks.
+
+    Args:
+        names
+            Names of the benchmarks to run (see `BENCHMARKS`); all of them
+            by default
+        track_memory
+            Whether to measure the peak memory; since tracing allocations
+            slows Python down, each benchmark is then run a second time for
+            the memory, and the timings are taken from the first run
+        **kwargs
+            Keyword arguments per benchmark name, e.g.
+            `hardware_sweep={'fetch_latency': 0.05}`
+
+    Returns:
+        Results per benchmark name
+    """
+    results = OrderedDict()
+    for name in names or BENCHMARKS:
+        benchmark = BENCHMARKS[name]
+        benchmark_kwargs = kwargs.get(name, {})
+        result = benchmark(**benchmark_kwargs)
+        if track_memory:
+            tracemalloc.start()
+            try:
+                benchmark(**benchmark_kwargs)
+                _, peak_memory = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            result = result._replace(peak_memory=peak_memory)
+        results[name] = result
+    return results
+
+
+def print_benchmark_results(results: Dict[str, BenchmarkResult]) -> None:
+    for name, result in results.items():
+        memory = '' if result.peak_memory is None \
+            else f", peak memory {result.peak_memory / 2 ** 20:.1f} MiB"
+        print(f"{name}: {result.points_per_second:.4g} points/s "
+              f"({result.n_points} points in {result.duration:.3f} s"
+              f"{memory})")
+        for stage, duration in result.stage_times.items():
+            print(f"    {stage}: {duration:.4f} s")
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_benchmark_results(results: Dict[str, BenchmarkResult],
+                           path: str,
+                           label: Optional[str] = None) -> None:
+    """
+    Append the results as one JSON line to the given file, together with
+    the time, the git commit of `v0_utils` (if available) and a label.
+    """
+    record = {'time': datetime.now().isoformat(),
+              'commit': _git_commit(),
+              'label': label,
+              'results': {name: result.to_dict()
+                          for name, result in results.items()}}
+    with open(path, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+
+
+def load_benchmark_results(path: str) -> List[Dict]:
+    """
+    Load all the records saved with `save_benchmark_results`, oldest first.
+    """
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def compare_benchmark_results(baseline: Dict,
+                              results: Dict,
+                              tolerance: float = 0.1) -> Dict[str, float]:
+    """
+    Compare the throughput of benchmark results with a baseline, and print
+    the benchmarks that got slower by more than the tolerance.
+
+    Args:
+        baseline
+            Results per benchmark name, either `BenchmarkResult`s or their
+            dictionaries as in the 'results' of a loaded record
+        results
+            Results to compare, in the same form
+        tolerance
+            Relative decrease of points per second that counts as a
+            regression
+
+    Returns:
+        Ratio of the points per second of the results to those of the
+        baseline, per benchmark that is in both
+    """
+    def points_per_second(result):
+        if isinstance(result, BenchmarkResult):
+            return result.points_per_second
+        return result['points_per_second']
+
+    ratios = OrderedDict()
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        baseline_rate = points_per_second(baseline[name])
+        ratio = points_per_second(result) / baseline_rate \
+            if baseline_rate else float('nan')
+        ratios[name] = ratio
+        if ratio < 1 - tolerance:
+            print(f"Regression in {name}: {ratio:.2f} times the baseline "
+                  f"throughput")
+    return ratios
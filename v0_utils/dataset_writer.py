@@ -0,0 +1,382 @@
+"""
+This module contains a writer that moves saving of measurement results out
+of the measurement loop.
+
+Results are put into a bounded queue by the measurement loop, and a
+background thread takes them from the queue in batches, unravels them into
+rows, and inserts each batch into the database in one transaction. When the
+queue is full, the measurement loop waits for the writer (backpressure),
+hence the memory use stays bounded if the database cannot keep up.
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+import numpy as np
+from qcodes import Parameter
+from qcodes.dataset.measurements import Measurement
+from qcodes.dataset.sqlite_base import connect, insert_many_values
+
+from .qcodes_tools import load_or_create_experiment, temporary_database
+
+_STOP = object()
+
+
+class WriterStats(NamedTuple):
+    """
+    Statistics of a background writer: the number of results (calls of
+    `add_result`) and rows written, the number of batches (transactions),
+    the time spent writing in seconds, the current and the maximal queue
+    depth, and the time the measurement loop waited for a full queue.
+    """
+    n_results: int
+    n_rows: int
+    n_batches: int
+    write_time: float
+    queue_depth: int
+    max_queue_depth: int
+    blocked_time: float
+
+    @property
+    def rows_per_second(self) -> float:
+        """Write throughput of the background thread"""
+        return self.n_rows / self.write_time if self.write_time else 0.
+
+
+class BackgroundDataWriter:
+    """
+    Writer of the results of a running measurement from a background
+    thread, in batched transactions.
+
+    Use it within the run of a measurement, and call its `add_result`
+    instead of the one of the datasaver (with the same arguments):
+
+        with meas.run() as datasaver:
+            with BackgroundDataWriter(datasaver) as writer:
+                for b in bias_values:
+                    dc_setup.DC_didv_bias(b)
+                    writer.add_result(
+                        (dc_setup.DC_didv_bias, b),
+                        (dc_setup.i_measurement, dc_setup.i_measurement()))
+            print(writer.stats())
+
+    On leaving the `with` block, also due to an exception or a
+    KeyboardInterrupt, all the queued results are written before the
+    exception propagates. Subscribers of the dataset (e.g. live plots) keep
+    receiving the new rows.
+
+    The writer uses its own connection to the database file of the
+    dataset, because SQLite connections cannot be shared between threads.
+    Array values are copied when they are queued, hence the measurement
+    loop may reuse its buffers.
+
+    Args:
+        datasaver
+            DataSaver of the running measurement
+        max_queue_size
+            Maximal number of queued results; `add_result` blocks while the
+            queue is full
+        batch_size
+            Maximal number of results written in one transaction
+    """
+
+    def __init__(self,
+                 datasaver,
+                 max_queue_size: int = 10000,
+                 batch_size: int = 1000) -> None:
+        self._datasaver = datasaver
+        self._dataset = datasaver.dataset
+        # these are read from the database of the dataset, hence they are
+        # looked up here and not in the background thread
+        parameters = self._dataset.get_parameters()
+        self._parameter_names = {parameter.name for parameter in parameters}
+        self._array_parameters = {parameter.name for parameter in parameters
+                                  if parameter.type == 'array'}
+        self._table_name = self._dataset.table_name
+        self._path_to_db = self._dataset.path_to_db
+        self.batch_size = batch_size
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._error = None
+
+        self._n_results = 0
+        self._n_rows = 0
+        self._n_batches = 0
+        self._write_time = 0.
+        self._max_queue_depth = 0
+        self._blocked_time = 0.
+
+    def __enter__(self) -> 'BackgroundDataWriter':
+        self.start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback) -> None:
+        # flush also on exceptions and KeyboardInterrupt; an error of the
+        # writer itself is raised only if nothing else is being raised
+        self.close(raise_error=exception_type is None)
+
+    def start(self) -> None:
+        """
+        Start the background thread. Results that the datasaver holds in
+        memory are written first, to keep the order of the rows.
+        """
+        if self._thread is not None:
+            raise RuntimeError("The writer has already been started.")
+        self._datasaver.flush_data_to_database()
+        self._thread = threading.Thread(target=self._run,
+                                        name='BackgroundDataWriter',
+                                        daemon=True)
+        self._thread.start()
+
+    def add_result(self, *res_tuple: Tuple[Any, Any]) -> None:
+        """
+        Queue a result for writing; the arguments are the same as of
+        `add_result` of a datasaver. Blocks while the queue is full.
+        """
+        self._raise_error()
+        if self._thread is None:
+            raise RuntimeError("The writer has not been started.")
+
+        result = [(str(parameter), np.array(value)
+                   if isinstance(value, np.ndarray) else value)
+                  for parameter, value in res_tuple]
+
+        try:
+            self._queue.put_nowait(result)
+        except queue.Full:
+            t_start = time.perf_counter()
+            self._put(result)
+            self._blocked_time += time.perf_counter() - t_start
+        self._max_queue_depth = max(self._max_queue_depth,
+                                    self._queue.qsize())
+
+    def close(self, raise_error: bool = True) -> None:
+        """
+        Write all the queued results and stop the background thread.
+        """
+        if self._thread is None:
+            return
+        try:
+            self._put(_STOP)
+        except RuntimeError:
+            # the thread has stopped already; its error is raised below
+            pass
+        self._thread.join()
+        self._thread = None
+        if raise_error:
+            self._raise_error()
+
+    def _put(self, item: Any) -> None:
+        """
+        Put an item into the queue, waiting while the queue is full as long
+        as the background thread is alive
+        """
+        while True:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                self._raise_error()
+                if not self._thread.is_alive():
+                    raise RuntimeError("The background thread of the writer "
+                                       "has stopped.")
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> WriterStats:
+        return WriterStats(self._n_results, self._n_rows, self._n_batches,
+                           self._write_time, self.queue_depth,
+                           self._max_queue_depth, self._blocked_time)
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise RuntimeError(f"Writing to the database failed: "
+                               f"{self._error!r}") from self._error
+
+    def _unravel(self, result: List[Tuple[str, Any]]
+                 ) -> Tuple[Tuple[str, ...], List[List[Any]]]:
+        """
+        Turn a result into rows, the same way `add_result` of a datasaver
+        does: arrays (of the same length) are unravelled into one row per
+        element, and scalars are duplicated into each row. Values of
+        parameters with paramtype 'array' are stored as single values, and
+        0-d arrays as scalars.
+
+        Returns:
+            Tuple of the column names and the list of rows
+        """
+        # number of rows of the arrays, None as long as no array is seen
+        n_rows = None
+        columns, values, unravelled = [], [], []
+        for name, value in result:
+            if name not in self._parameter_names:
+                raise ValueError(f"Can not add a result for {name}, no such "
+                                 f"parameter registered in this "
+                                 f"measurement.")
+            columns.append(name)
+            if isinstance(value, np.ndarray) \
+                    and name not in self._array_parameters:
+                if value.ndim == 0:
+                    value = value.item()
+                else:
+                    if n_rows is not None and len(value) != n_rows:
+                        raise ValueError(f"Incompatible array dimensions. "
+                                         f"Trying to add arrays of "
+                                         f"dimension {n_rows} and "
+                                         f"{len(value)}")
+                    n_rows = len(value)
+                    values.append(value.tolist())
+                    unravelled.append(True)
+                    continue
+            values.append(value)
+            unravelled.append(False)
+
+        n_rows = 1 if n_rows is None else n_rows
+        values = [value if is_unravelled else [value] * n_rows
+                  for value, is_unravelled in zip(values, unravelled)]
+        return tuple(columns), [list(row) for row in zip(*values)]
+
+    def _write_batch(self,
+                     connection: sqlite3.Connection,
+                     batch: List[List[Tuple[str, Any]]]) -> None:
+        t_start = time.perf_counter()
+
+        # rows of consecutive results with the same columns are inserted
+        # together
+        n_rows = 0
+        columns, rows = None, []
+        for result in batch:
+            result_columns, result_rows = self._unravel(result)
+            if result_columns != columns and rows:
+                insert_many_values(connection, self._table_name,
+                                   list(columns), rows)
+                n_rows += len(rows)
+                rows = []
+            columns = result_columns
+            rows += result_rows
+        if rows:
+            insert_many_values(connection, self._table_name, list(columns),
+                               rows)
+            n_rows += len(rows)
+        connection.commit()
+
+        self._n_results += len(batch)
+        self._n_rows += n_rows
+        self._n_batches += 1
+        self._write_time += time.perf_counter() - t_start
+
+    def _run(self) -> None:
+        connection = None
+        try:
+            connection = connect(self._path_to_db)
+            # the triggers of the subscribers of the dataset call functions
+            # that have to be registered on every connection that inserts
+            # rows
+            for subscriber in self._dataset.subscribers.values():
+                connection.create_function(subscriber.callbackid, -1,
+                                           subscriber.cache)
+        except Exception as exception:
+            self._error = exception
+            if connection is not None:
+                connection.close()
+            return
+
+        try:
+            stopping = False
+            while not stopping:
+                batch = [self._queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch[-1] is _STOP:
+                    stopping = True
+                    batch.pop()
+                if batch and self._error is None:
+                    try:
+                        self._write_batch(connection, batch)
+                    except Exception as exception:
+                        # keep consuming the queue, so that the measurement
+                        # loop is not blocked, and report the error there
+                        self._error = exception
+        finally:
+            connection.close()
+
+
+def benchmark_background_writer(n_points: int = 200,
+                                n_values: int = 1000,
+                                read_time: float = 0.005,
+                                write_period: float = 1.
+                                ) -> Dict[str, float]:
+    """
+    Compare the rate of a measurement loop that saves each point with
+    `add_result` of the datasaver with one that saves via the
+    `BackgroundDataWriter`, on a temporary database.
+
+    Each point of the loop waits for `read_time` seconds, as it would wait
+    for the reply of an instrument, and saves an array of `n_values`
+    values (e.g. a buffer of a lock-in) against a setpoint. The rates
+    include writing all the results to the database at the end.
+
+    The database that QCoDeS refers to is restored afterwards.
+
+    Returns:
+        Points per second of the measurement loop for 'datasaver' and
+        'background_writer', their ratio as 'speedup', and the write
+        throughput of the background thread in rows per second
+    """
+    rates = {}
+    with temporary_database():
+        experiment = load_or_create_experiment('writer_benchmark', 'no sample')
+        setter = Parameter('setter', set_cmd=None, get_cmd=None)
+        index = Parameter('sample_index', set_cmd=None, get_cmd=None)
+        readout = Parameter('readout', set_cmd=None, get_cmd=None)
+
+        measurement = Measurement(exp=experiment)
+        measurement.write_period = write_period
+        measurement.register_parameter(setter)
+        measurement.register_parameter(index)
+        measurement.register_parameter(readout, setpoints=[setter, index])
+
+        indices = np.arange(n_values)
+        values = np.random.standard_normal((n_points, n_values))
+
+        t_start = time.perf_counter()
+        with measurement.run() as datasaver:
+            for i in range(n_points):
+                time.sleep(read_time)
+                datasaver.add_result((setter, i), (index, indices),
+                                     (readout, values[i]))
+        rates['datasaver'] = n_points / (time.perf_counter() - t_start)
+
+        t_start = time.perf_counter()
+        with measurement.run() as datasaver:
+            with BackgroundDataWriter(datasaver) as writer:
+                for i in range(n_points):
+                    time.sleep(read_time)
+                    writer.add_result((setter, i), (index, indices),
+                                      (readout, values[i]))
+        rates['background_writer'] = \
+            n_points / (time.perf_counter() - t_start)
+
+        rates['speedup'] = rates['background_writer'] / rates['datasaver']
+        rates['writer_rows_per_second'] = writer.stats().rows_per_second
+
+        # arrays of different lengths are refused, also if the first one
+        # has a single element
+        try:
+            writer._unravel([('sample_index', indices[:1]),
+                             ('readout', values[0])])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Arrays of different lengths were "
+                                 "unravelled.")
+    return rates
@@ -0,0 +1,414 @@
+"""
+This module contains a hardware-sweep detector that demodulates the records
+of a digitizer (e.g. an Alazar card triggered by the AWG) on the host.
+
+Instead of demodulating, averaging and taking magnitude and phase record by
+record in Python, the records of a whole buffer are demodulated at once as
+a matrix product with a precomputed reference table, and are accumulated
+into preallocated per-point averages. Reading the next buffer from the
+digitizer overlaps with processing the current one (double buffering).
+"""
+
+import queue
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import numpy as np
+from qcodes.utils.validators import Numbers
+
+from .hwsweep import HardwareSweepDetector
+
+
+class SyntheticRecordSource:
+    """
+    Stand-in for a digitizer that produces records of an IF tone, for
+    testing the demodulation without hardware. The complex amplitude of the
+    tone in a record is given by the response function of the index of the
+    sweep point of the record (records go through the points of the sweep
+    and then repeat), and Gaussian noise is added.
+
+    Args:
+        sample_rate
+            Sample rate in Hz
+        samples_per_record
+            Number of samples per record
+        if_frequency
+            Frequency of the tone in Hz
+        response
+            Function that takes an array of point indices and returns the
+            complex amplitudes of the tone; by default, 1
+        noise
+            Standard deviation of the noise
+        buffer_latency
+            Time that reading a buffer takes, in seconds (the thread sleeps,
+            as it would wait for the digitizer)
+    """
+
+    def __init__(self,
+                 sample_rate: float = 500e6,
+                 samples_per_record: int = 1024,
+                 if_frequency: float = 50e6,
+                 response: Optional[Callable[[np.ndarray],
+                                             np.ndarray]] = None,
+                 noise: float = 0.1,
+                 buffer_latency: float = 0.) -> None:
+        self.sample_rate = sample_rate
+        self.samples_per_record = samples_per_record
+        self.if_frequency = if_frequency
+        self.response = response or (lambda points: np.ones(len(points)))
+        self.buffer_latency = buffer_latency
+
+        phase = 2 * np.pi * if_frequency \
+            * np.arange(samples_per_record) / sample_rate
+        self._cos = np.cos(phase).astype(np.float32)
+        self._sin = np.sin(phase).astype(np.float32)
+        # generating noise is slower than demodulating it, hence the records
+        # take their noise from a pool
+        self._noise = (noise * np.random.standard_normal(
+            (64, samples_per_record))).astype(np.float32)
+
+        self._n_points = 1
+        self._position = 0
+
+    def start(self, n_points: int) -> None:
+        """Start the acquisition of a sweep of the given number of points"""
+        self._n_points = n_points
+        self._position = 0
+
+    def read_buffer(self, out: np.ndarray) -> None:
+        """
+        Fill the given array of shape (number of records, samples per
+        record) with the next records.
+        """
+        time.sleep(self.buffer_latency)
+        n_records = len(out)
+        records = np.arange(self._position, self._position + n_records)
+        self._position += n_records
+        amplitudes = np.asarray(self.response(records % self._n_points),
+                                dtype=complex)
+        np.multiply(amplitudes.real[:, np.newaxis].astype(np.float32),
+                    self._cos, out=out)
+        out -= amplitudes.imag[:, np.newaxis].astype(np.float32) * self._sin
+        out += self._noise[records % len(self._noise)]
+
+
+class BatchDemodulator:
+    """
+    Demodulator of blocks of records with a precomputed reference table.
+
+    Every record is split into blocks of `samples_per_output` samples; each
+    block is multiplied with the reference (cosine and sine of the IF,
+    weighted with the window) and summed, which filters and decimates the
+    record into one complex amplitude per block. For all the records of a
+    buffer this is one matrix product, and the phase of the IF at the start
+    of each block is corrected afterwards. For a tone A cos(wt + phi) the
+    result is A exp(i phi).
+
+    Args:
+        sample_rate
+            Sample rate in Hz
+        samples_per_record
+            Number of samples per record
+        if_frequency
+            Frequency of the IF signal in Hz
+        samples_per_output
+            Number of samples per output value; by default, the whole
+            record (one value per record)
+        window
+            Name of a numpy window function applied to each block
+            ('hanning', 'hamming', 'blackman', 'bartlett'), or 'boxcar'
+    """
+
+    def __init__(self,
+                 sample_rate: float,
+                 samples_per_record: int,
+                 if_frequency: float,
+                 samples_per_output: Optional[int] = None,
+                 window: str = 'boxcar') -> None:
+        samples_per_output = samples_per_output or samples_per_record
+        if samples_per_record % samples_per_output:
+            raise ValueError(f"The number of samples per record "
+                             f"({samples_per_record}) should be a multiple "
+                             f"of the number of samples per output "
+                             f"({samples_per_output}).")
+        self.samples_per_record = samples_per_record
+        self.samples_per_output = samples_per_output
+        self.n_outputs = samples_per_record // samples_per_output
+
+        if window == 'boxcar':
+            weights = np.ones(samples_per_output)
+        else:
+            weights = getattr(np, window)(samples_per_output)
+        omega = 2 * np.pi * if_frequency / sample_rate
+        phase = omega * np.arange(samples_per_output)
+        self._reference = (2 / weights.sum() * np.stack(
+            (weights * np.cos(phase), -weights * np.sin(phase)),
+            axis=1)).astype(np.float32)
+        self._block_phase = np.exp(
+            -1j * omega * samples_per_output * np.arange(self.n_outputs))
+
+    def demodulate(self,
+                   records: np.ndarray,
+                   out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Demodulate records of shape (number of records, samples per record)
+        into complex amplitudes of shape (number of records, number of
+        outputs per record).
+        """
+        n_records = len(records)
+        blocks = np.asarray(records, dtype=np.float32).reshape(
+            n_records * self.n_outputs, self.samples_per_output)
+        quadratures = blocks @ self._reference
+        if out is None:
+            out = np.empty((n_records, self.n_outputs), dtype=complex)
+        out.real = quadratures[:, 0].reshape(n_records, self.n_outputs)
+        out.imag = quadratures[:, 1].reshape(n_records, self.n_outputs)
+        out *= self._block_phase
+        return out
+
+
+class DemodulationDetector(HardwareSweepDetector):
+    """
+    Hardware-sweep detector that reads records from a digitizer and
+    demodulates them on the host.
+
+    For an acquisition of `n_points` points, `n_repetitions` records per
+    point are read (the records go through all the points, and then repeat,
+    as for a `RepeatingStaircaseRamp`), in buffers of `records_per_buffer`
+    records. A background thread reads the next buffer into one of two
+    preallocated buffers while the current one is demodulated with a
+    `BatchDemodulator` and added to the preallocated per-point sums.
+
+    The `data` is the complex amplitude averaged over the repetitions, of
+    shape (n_points,), or (n_points, outputs per record) if the records are
+    decimated into several values; `magnitude` and `phase` are derived from
+    it.
+
+    The digitizer is represented by a source object with the methods
+    `start(n_points)` and `read_buffer(out)` (see `SyntheticRecordSource`),
+    and with the attributes `sample_rate` and `samples_per_record`.
+
+    Args:
+        name
+            Name of the detector
+        source
+            The record source
+        if_frequency
+            Frequency of the IF signal in Hz
+        records_per_buffer
+            Number of records per buffer
+        samples_per_output
+            Number of samples per output value (see `BatchDemodulator`)
+        window
+            Window of the demodulation (see `BatchDemodulator`)
+    """
+
+    def __init__(self,
+                 name: str,
+                 source,
+                 if_frequency: float,
+                 records_per_buffer: int = 128,
+                 samples_per_output: Optional[int] = None,
+                 window: str = 'boxcar',
+                 **kwargs):
+        super().__init__(name, **kwargs)
+
+        self._source = source
+        self.demodulator = BatchDemodulator(
+            source.sample_rate, source.samples_per_record, if_frequency,
+            samples_per_output, window)
+        self._buffers = np.empty((2, records_per_buffer,
+                                  source.samples_per_record),
+                                 dtype=np.float32)
+        self._demodulated = np.empty(
+            (records_per_buffer, self.demodulator.n_outputs), dtype=complex)
+        self._sums = None
+        self._n_records = 0
+        self.timings = {}
+
+        self.add_parameter(name='n_repetitions',
+                           label='Number of repetitions',
+                           unit='#',
+                           get_cmd=None,
+                           set_cmd=None,
+                           get_parser=int,
+                           initial_value=1,
+                           vals=Numbers(min_value=1),
+                           docstring="Number of records that are averaged "
+                                     "per point"
+                           )
+        self.add_parameter(name='magnitude',
+                           label='Magnitude',
+                           get_cmd=lambda: np.abs(self._data),
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Magnitude of the averaged data"
+                           )
+        self.add_parameter(name='phase',
+                           label='Phase',
+                           unit='rad',
+                           get_cmd=lambda: np.angle(self._data),
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Phase of the averaged data"
+                           )
+
+    @property
+    def records_per_buffer(self) -> int:
+        return self._buffers.shape[1]
+
+    def arm(self, n_points: int) -> None:
+        shape = (n_points, self.demodulator.n_outputs)
+        if self._sums is None or self._sums.shape != shape:
+            self._sums = np.zeros(shape, dtype=complex)
+        else:
+            self._sums[...] = 0
+        self._n_records = n_points * self.n_repetitions()
+        self._source.start(n_points)
+
+    def _read_buffers(self,
+                      free: queue.Queue,
+                      filled: queue.Queue,
+                      stop: threading.Event) -> None:
+        try:
+            for start in range(0, self._n_records, self.records_per_buffer):
+                index = free.get()
+                if stop.is_set():
+                    return
+                n_records = min(self.records_per_buffer,
+                                self._n_records - start)
+                t_start = time.perf_counter()
+                self._source.read_buffer(self._buffers[index, :n_records])
+                self.timings['read'] += time.perf_counter() - t_start
+                filled.put((index, start, n_records))
+            filled.put(None)
+        except Exception as exception:
+            filled.put(exception)
+
+    def _accumulate(self, demodulated: np.ndarray, start: int) -> None:
+        """
+        Add demodulated records, the first of which is the record number
+        `start` of the acquisition, to the sums of their points.
+        """
+        n_points = len(self._sums)
+        offset = 0
+        while offset < len(demodulated):
+            point = (start + offset) % n_points
+            n_records = min(len(demodulated) - offset, n_points - point)
+            self._sums[point:point + n_records] += \
+                demodulated[offset:offset + n_records]
+            offset += n_records
+
+    def fetch(self, n_points: int) -> np.ndarray:
+        if self._sums is None or len(self._sums) != n_points:
+            raise RuntimeError(f"Detector {self.name} has not been armed for "
+                               f"{n_points} points.")
+        self.timings = {'read': 0., 'demodulate': 0., 'accumulate': 0.}
+        t_start = time.perf_counter()
+
+        free = queue.Queue()
+        free.put(0)
+        free.put(1)
+        filled = queue.Queue()
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read_buffers,
+                                  args=(free, filled, stop),
+                                  name=f'{self.name}_reader', daemon=True)
+        reader.start()
+        try:
+            while True:
+                item = filled.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                index, start, n_records = item
+                demodulated = self._demodulated[:n_records]
+                t_demodulate = time.perf_counter()
+                self.demodulator.demodulate(self._buffers[index, :n_records],
+                                            out=demodulated)
+                t_accumulate = time.perf_counter()
+                self._accumulate(demodulated, start)
+                free.put(index)
+                self.timings['demodulate'] += t_accumulate - t_demodulate
+                self.timings['accumulate'] += \
+                    time.perf_counter() - t_accumulate
+        finally:
+            stop.set()
+            free.put(0)  # unblocks the reader if it waits for a buffer
+            reader.join()
+
+        self.timings['total'] = time.perf_counter() - t_start
+        data = self._sums / self.n_repetitions()
+        return data[:, 0] if self.demodulator.n_outputs == 1 else data
+
+    @property
+    def records_per_second(self) -> float:
+        """Throughput of the last acquisition"""
+        total = self.timings.get('total')
+        return self._n_records / total if total else 0.
+
+
+def _demodulate_per_record(records: np.ndarray,
+                           sample_rate: float,
+                           if_frequency: float) -> np.ndarray:
+    """
+    Demodulation record by record, the way it is done in the acquisition
+    controllers; used as the reference in `benchmark_demodulation`.
+    """
+    t = np.arange(records.shape[1]) / sample_rate
+    values = []
+    for record in records:
+        i = 2 * np.mean(record * np.cos(2 * np.pi * if_frequency * t))
+        q = -2 * np.mean(record * np.sin(2 * np.pi * if_frequency * t))
+        values.append(i + 1j * q)
+    return np.array(values)
+
+
+def benchmark_demodulation(n_points: int = 500,
+                           n_repetitions: int = 20,
+                           samples_per_record: int = 1024,
+                           records_per_buffer: int = 250
+                           ) -> Dict[str, float]:
+    """
+    Compare the throughput of demodulating synthetic records one by one
+    with that of the `DemodulationDetector`.
+
+    Returns:
+        Records per second of the 'per_record' and the 'detector'
+        demodulation, their ratio as 'speedup', and the largest deviation of
+        the averaged amplitudes of the detector from the true ones
+    """
+    def response(points):
+        return np.exp(1j * points / n_points * 2 * np.pi) \
+            * (1 + points / n_points)
+
+    source = SyntheticRecordSource(samples_per_record=samples_per_record,
+                                   response=response)
+    n_records = n_points * n_repetitions
+    rates = {}
+
+    source.start(n_points)
+    records = np.empty((records_per_buffer, samples_per_record),
+                       dtype=np.float32)
+    t_start = time.perf_counter()
+    for _ in range(0, n_records, records_per_buffer):
+        source.read_buffer(records)
+        _demodulate_per_record(records, source.sample_rate,
+                               source.if_frequency)
+    rates['per_record'] = n_records / (time.perf_counter() - t_start)
+
+    detector = DemodulationDetector('benchmark_demodulation', source,
+                                    source.if_frequency,
+                                    records_per_buffer=records_per_buffer)
+    detector.n_repetitions(n_repetitions)
+    detector.arm(n_points)
+    t_start = time.perf_counter()
+    data = detector.acquire(n_points)
+    rates['detector'] = n_records / (time.perf_counter() - t_start)
+
+    rates['speedup'] = rates['detector'] / rates['per_record']
+    rates['max_error'] = float(np.max(np.abs(
+        data - response(np.arange(n_points)))))
+    return rates
@@ -0,0 +1,264 @@
+"""
+This module contains functions for loading data of QCoDeS runs that have
+been measured on a regular grid of setpoints as dense N-D numpy arrays.
+
+The gridded arrays are cached as `.npy` files in a directory next to the
+database file, so that loading the same run again only memory-maps the
+cached files instead of reading and regridding the data from the database.
+"""
+
+import json
+import os
+import shutil
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from qcodes.dataset.data_set import load_by_id, DataSet
+
+
+class GriddedParameter(NamedTuple):
+    """
+    Values of a dependent parameter on a regular grid of its setpoints.
+
+    Attributes:
+        name
+            Name of the dependent parameter
+        data
+            N-D array of values where the n-th dimension corresponds to the
+            n-th setpoint (and possible trailing dimensions are those of
+            array-valued results); points of the grid that have not been
+            measured are NaN
+        setpoint_names
+            Names of the setpoint parameters, one per grid dimension
+        axes
+            Sorted values of the setpoints, one vector per grid dimension
+    """
+    name: str
+    data: np.ndarray
+    setpoint_names: Tuple[str, ...]
+    axes: Tuple[np.ndarray, ...]
+
+
+def grid_indices(setpoints: Sequence[np.ndarray],
+                 decimals: Optional[int] = None
+                 ) -> Tuple[Tuple[np.ndarray, ...], np.ndarray]:
+    """
+    Infer the grid from the setpoint values of the measured points in one
+    vectorized pass.
+
+    Args:
+        setpoints
+            Vectors of values of each of the setpoints, one value per
+            measured point
+        decimals
+            If given, setpoint values are rounded to this number of decimals
+            before inferring the grid, which is useful when the setpoint
+            values have been read back from an instrument and carry noise
+
+    Returns:
+        Tuple of sorted axis vectors (one per setpoint), and the flat
+        (C-order) index in the grid of each measured point
+    """
+    axes = []
+    indices = []
+    for setpoint in setpoints:
+        setpoint = np.asarray(setpoint, dtype=float)
+        if decimals is not None:
+            setpoint = np.round(setpoint, decimals)
+        axis, index = np.unique(setpoint, return_inverse=True)
+        axes.append(axis)
+        indices.append(index.reshape(-1))
+
+    shape = tuple(len(axis) for axis in axes)
+    flat_index = np.ravel_multi_index(indices, shape)
+    return tuple(axes), flat_index
+
+
+def grid_values(values: np.ndarray,
+                grid_shape: Tuple[int, ...],
+                flat_index: np.ndarray,
+                out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Place the values of the measured points into a dense grid.
+
+    Args:
+        values
+            Values of the measured points; the first dimension runs over the
+            points
+        grid_shape
+            Shape of the grid of setpoints
+        flat_index
+            Flat index in the grid of each of the measured points, as
+            returned by `grid_indices`
+        out
+            Array to place the values into, e.g. a memory-mapped file; its
+            shape should be `grid_shape` plus the trailing shape of `values`
+
+    Returns:
+        The grid with the values, points that have not been measured are NaN
+    """
+    values = np.asarray(values)
+    shape = tuple(grid_shape) + values.shape[1:]
+    if out is None:
+        out = np.empty(shape, dtype=np.result_type(values, float))
+    out.fill(np.nan)
+    out.reshape((-1,) + values.shape[1:])[flat_index] = values
+    return out
+
+
+def _cache_dir_for_run(path_to_db: str, run_id: int) -> str:
+    db_base = os.path.splitext(os.path.abspath(path_to_db))[0]
+    return os.path.join(db_base + '_grid_cache', f'run_{run_id}')
+
+
+def _last_row_id(dataset: DataSet) -> int:
+    cursor = dataset.conn.execute(
+        f'SELECT MAX(rowid) FROM "{dataset.table_name}"')
+    last_row_id = cursor.fetchone()[0]
+    return 0 if last_row_id is None else last_row_id
+
+
+def _read_columns(dataset: DataSet,
+                  name: str,
+                  setpoint_names: Sequence[str]
+                  ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Read the values of the given dependent parameter and its setpoints from
+    the database straight into numpy arrays, bypassing the per-row
+    processing of `DataSet.get_data`.
+    """
+    columns = list(setpoint_names) + [name]
+    cursor = dataset.conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(f'SELECT {", ".join(columns)} '
+                   f'FROM "{dataset.table_name}" '
+                   f'WHERE {name} IS NOT NULL')
+    rows = cursor.fetchall()
+
+    if dataset.paramspecs[name].type == 'numeric':
+        table = np.array(rows, dtype=float).reshape(len(rows), len(columns))
+        return table[:, :-1].T, table[:, -1]
+
+    setpoints = np.array([row[:-1] for row in rows], dtype=float)
+    values = np.stack([row[-1] for row in rows]) if rows else np.empty(0)
+    return setpoints.reshape(len(rows), len(setpoint_names)).T, values
+
+
+def _load_cached(cache_dir: str,
+                 last_row_id: int,
+                 decimals: Optional[int]) -> Optional[GriddedParameter]:
+    try:
+        with open(os.path.join(cache_dir, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+
+    if (meta['last_row_id'], meta['decimals']) != (last_row_id, decimals):
+        return None
+
+    setpoint_names = tuple(meta['setpoint_names'])
+    axes = tuple(np.load(os.path.join(cache_dir, f'axis_{i}.npy'))
+                 for i in range(len(setpoint_names)))
+    data = np.load(os.path.join(cache_dir, 'data.npy'), mmap_mode='r')
+    return GriddedParameter(meta['name'], data, setpoint_names, axes)
+
+
+def _grid_to_cache(cache_dir: str,
+                   last_row_id: int,
+                   name: str,
+                   setpoint_names: Tuple[str, ...],
+                   setpoints: np.ndarray,
+                   values: np.ndarray,
+                   decimals: Optional[int]) -> None:
+    tmp_dir = cache_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    axes, flat_index = grid_indices(setpoints, decimals)
+    grid_shape = tuple(len(axis) for axis in axes)
+    data = np.lib.format.open_memmap(
+        os.path.join(tmp_dir, 'data.npy'), mode='w+',
+        dtype=np.result_type(values, float),
+        shape=grid_shape + values.shape[1:])
+    grid_values(values, grid_shape, flat_index, out=data)
+    data.flush()
+    del data
+
+    for i, axis in enumerate(axes):
+        np.save(os.path.join(tmp_dir, f'axis_{i}.npy'), axis)
+
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as meta_file:
+        json.dump({'name': name,
+                   'setpoint_names': list(setpoint_names),
+                   'last_row_id': last_row_id,
+                   'decimals': decimals}, meta_file)
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+
+def load_gridded_run(run_id: int,
+                     parameters: Optional[Sequence[str]] = None,
+                     use_cache: bool = True,
+                     decimals: Optional[int] = None
+                     ) -> Dict[str, GriddedParameter]:
+    """
+    Load the dependent parameters of a run as dense N-D arrays on the grid
+    of their setpoints.
+
+    With `use_cache`, the gridded arrays are stored as `.npy` files in a
+    "<database name>_grid_cache" directory next to the database file, and
+    are memory-mapped (not loaded into memory) when the same run is loaded
+    again. The cache is rebuilt if rows have been added to the run since the
+    cache was written, or if it was written with different `decimals`.
+
+    Args:
+        run_id
+            ID of the run in the database that QCoDeS refers to
+        parameters
+            Names of the dependent parameters to load; by default, all the
+            dependent parameters of the run are loaded
+        use_cache
+            Whether to read from and write to the on-disk cache
+        decimals
+            If given, setpoint values are rounded to this number of decimals
+            before inferring the grid (see `grid_indices`)
+
+    Returns:
+        Gridded data per dependent parameter name
+    """
+    dataset = load_by_id(run_id)
+    paramspecs = dataset.paramspecs
+
+    if parameters is None:
+        parameters = [name for name, spec in paramspecs.items()
+                      if spec.depends_on != '']
+
+    last_row_id = _last_row_id(dataset) if use_cache else None
+
+    gridded = {}
+    for name in parameters:
+        if paramspecs[name].depends_on == '':
+            raise ValueError(f'Parameter {name} has no setpoints.')
+        setpoint_names = tuple(paramspecs[name].depends_on.split(', '))
+
+        if use_cache:
+            cache_dir = os.path.join(
+                _cache_dir_for_run(dataset.path_to_db, run_id), name)
+            cached = _load_cached(cache_dir, last_row_id, decimals)
+            if cached is None:
+                setpoints, values = _read_columns(dataset, name,
+                                                  setpoint_names)
+                _grid_to_cache(cache_dir, last_row_id, name, setpoint_names,
+                               setpoints, values, decimals)
+                cached = _load_cached(cache_dir, last_row_id, decimals)
+            gridded[name] = cached
+        else:
+            setpoints, values = _read_columns(dataset, name, setpoint_names)
+            axes, flat_index = grid_indices(setpoints, decimals)
+            data = grid_values(values, tuple(len(axis) for axis in axes),
+                               flat_index)
+            gridded[name] = GriddedParameter(name, data, setpoint_names,
+                                             axes)
+
+    return gridded
@@ -3,9 +3,161 @@ THis module shall contain the infrastructure needed in order to implement
 hardware sweeps.
 """
 
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+import numpy as np
+from qcodes.utils.validators import Numbers
+
 from .qcodes_tools import VirtualInstrument
 
 
+class HardwareSweepDetector(VirtualInstrument):
+    """
+    This is a base class for detectors that are used within hardware sweeps.
+
+    A detector is first armed to acquire a given number of points, then the
+    hardware sweep triggers the measurement, and finally the detector waits
+    until all the points are acquired and fetches them from the instrument.
+    The fetched data is available through the `data` parameter of the
+    detector.
+
+    Subclasses shall implement `arm` and `fetch` methods. The `fetch` method
+    is called from a worker thread, hence it should not rely on any state
+    that is shared with other detectors.
+
+    Args:
+        name
+            Name of the detector
+    """
+
+    def __init__(self, name: str, **kwargs):
+        super().__init__(name, **kwargs)
+
+        self._data = None
+
+        self.add_parameter(name='data',
+                           label='Fetched data',
+                           get_cmd=self._get_data,
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Data that has been fetched from the "
+                                     "detector during the last acquisition"
+                           )
+
+    def _get_data(self):
+        return self._data
+
+    def arm(self, n_points: int) -> None:
+        raise NotImplementedError("Subclasses of HardwareSweepDetector "
+                                  "should implement arm method")
+
+    def fetch(self, n_points: int) -> np.ndarray:
+        raise NotImplementedError("Subclasses of HardwareSweepDetector "
+                                  "should implement fetch method")
+
+    def acquire(self, n_points: int) -> np.ndarray:
+        """
+        Wait until the armed detector has acquired the given number of points,
+        fetch them and make them available via `data` parameter.
+        """
+        self._data = self.fetch(n_points)
+        return self._data
+
+
+class LockInBufferDetector(HardwareSweepDetector):
+    """
+    Detector that captures one variable of an SR86x lock-in amplifier into
+    its buffer on every trigger.
+
+    Args:
+        name
+            Name of the detector
+        lockin
+            SR86x lock-in amplifier instrument
+        capture_variable_name
+            Name of the variable to capture, e.g. "X"
+    """
+
+    def __init__(self,
+                 name: str,
+                 lockin,
+                 capture_variable_name: str = "X",
+                 **kwargs):
+        super().__init__(name, **kwargs)
+
+        self._lockin = lockin
+        self._capture_variable_name = capture_variable_name
+
+        self._lockin.buffer.capture_config(self._capture_variable_name)
+
+    @property
+    def lockin(self):
+        return self._lockin
+
+    def arm(self, n_points: int) -> None:
+        self.lockin.buffer.set_capture_length_to_fit_samples(n_points)
+        self.lockin.buffer.start_capture("ONE", "SAMP")
+
+    def fetch(self, n_points: int) -> np.ndarray:
+        self.lockin.buffer.wait_until_samples_captured(n_points)
+        self.lockin.buffer.stop_capture()
+        capture_data = self.lockin.buffer.get_capture_data(n_points)
+        return capture_data[self._capture_variable_name]
+
+
+class MockDetector(HardwareSweepDetector):
+    """
+    Detector that does not talk to any hardware. Fetching data from it takes
+    `fetch_latency` seconds (during which the thread sleeps, the same way it
+    would be waiting for I/O of a real instrument), and returns data generated
+    by the given signal function.
+
+    This is useful for testing hardware sweeps without hardware.
+
+    Args:
+        name
+            Name of the detector
+        signal
+            Function that takes the number of points and returns an array of
+            that many data points; if None, normally distributed random
+            numbers are returned
+    """
+
+    def __init__(self,
+                 name: str,
+                 signal: Optional[Callable[[int], np.ndarray]] = None,
+                 **kwargs):
+        super().__init__(name, **kwargs)
+
+        self._signal = signal or np.random.standard_normal
+        self._armed_n_points = None
+
+        self.add_parameter(name='fetch_latency',
+                           label='Fetch latency',
+                           unit='s',
+                           get_cmd=None,
+                           set_cmd=None,
+                           initial_value=0,
+                           vals=Numbers(min_value=0),
+                           docstring="Time that fetching of the data takes"
+                           )
+
+    def arm(self, n_points: int) -> None:
+        self._armed_n_points = n_points
+
+    def fetch(self, n_points: int) -> np.ndarray:
+        if self._armed_n_points != n_points:
+            raise RuntimeError(f"Detector {self.name} has been armed for "
+                               f"{self._armed_n_points} points, but "
+                               f"{n_points} points are requested.")
+        self._armed_n_points = None
+        time.sleep(self.fetch_latency())
+        return np.asarray(self._signal(n_points))
+
+
 class HardwareSweep(VirtualInstrument):
     """
     This is a base class for all the hardware sweeps.
@@ -20,9 +172,145 @@ class HardwareSweep(VirtualInstrument):
     object attributes which are linked to the get methods of corresponding
     parameters.
 
+    Detectors (see `HardwareSweepDetector`) that are registered via
+    `add_detector` are handled by the `acquire` method: they are all armed,
+    the measurement is triggered via `trigger` method, and then the data of
+    all the detectors is fetched concurrently on a thread pool, so that the
+    acquisition takes as long as the slowest detector and not as long as
+    all of them together. The time each detector took to deliver its data
+    is available via `detector_timings`.
+
     Note: this is work-in-progress.
     """
 
+    def __init__(self, name: str, **kwargs):
+        super().__init__(name, **kwargs)
+
+        self._detectors = OrderedDict()
+        self._detector_timings = OrderedDict()
+
+    @property
+    def detectors(self) -> Dict[str, HardwareSweepDetector]:
+        return self._detectors
+
+    @property
+    def detector_timings(self) -> Dict[str, float]:
+        """
+        Time in seconds from the trigger until the data of a detector was
+        fetched, for each detector in the last acquisition
+        """
+        return OrderedDict(self._detector_timings)
+
+    def add_detector(self,
+                     name: str,
+                     detector: HardwareSweepDetector) -> None:
+        """
+        Register a detector to be used in the acquisition, and add it as a
+        submodule of this hardware sweep.
+
+        Args:
+            name
+                Name of the submodule for the detector
+            detector
+                The detector object
+        """
+        self.add_submodule(name=name, submodule=detector)
+        self._detectors[name] = detector
+
+    def trigger(self) -> None:
+        """
+        Start the measurement after all the detectors are armed (for example,
+        start playing the AWG sequence).
+        """
+        raise NotImplementedError("Subclasses of HardwareSweep should "
+                                  "implement trigger method in order to "
+                                  "use acquire method")
+
+    def stop(self) -> None:
+        """
+        Stop the measurement after all the data is fetched or when the
+        acquisition fails (for example, stop the AWG). Does nothing by
+        default.
+        """
+        pass
+
+    def acquire(self, n_points: int) -> Dict[str, np.ndarray]:
+        """
+        Arm all the registered detectors, trigger the measurement, and fetch
+        the data of all the detectors concurrently.
+
+        Args:
+            n_points
+                Number of points (triggers) that each detector acquires
+
+        Returns:
+            Dictionary of fetched data per detector name
+        """
+        if len(self._detectors) == 0:
+            raise RuntimeError(f"No detectors are registered in "
+                               f"{self.name}.")
+
+        self._detector_timings.clear()
+
+        def acquire_and_time(name, detector):
+            detector.acquire(n_points)
+            self._detector_timings[name] = time.perf_counter() - t_trigger
+
+        try:
+            for detector in self._detectors.values():
+                detector.arm(n_points)
+
+            t_trigger = time.perf_counter()
+            self.trigger()
+
+            with ThreadPoolExecutor(
+                    max_workers=len(self._detectors)) as executor:
+                futures = [executor.submit(acquire_and_time, name, detector)
+                           for name, detector in self._detectors.items()]
+                for future in futures:
+                    future.result()
+        finally:
+            self.stop()
+
+        return OrderedDict((name, detector.data())
+                           for name, detector in self._detectors.items())
+
     def run(self):
         raise NotImplementedError("Subclasses of HardwareSweep should "
                                   "implement run method")
+
+
+class MockHardwareSweep(HardwareSweep):
+    """
+    Hardware sweep with a trigger that does nothing, and which acquires
+    `n_points` points from its detectors on `run`. Together with
+    `MockDetector` this is useful for testing the acquisition without
+    hardware.
+
+    Args:
+        name
+            Name of the hardware sweep
+    """
+
+    def __init__(self, name: str, **kwargs):
+        super().__init__(name, **kwargs)
+
+        self.n_triggers = 0
+
+        self.add_parameter(name='n_points',
+                           label='Number of points to acquire',
+                           unit='#',
+                           get_cmd=None,
+                           set_cmd=None,
+                           get_parser=int,
+                           initial_value=1,
+                           vals=Numbers(min_value=1),
+                           docstring="Number of points (triggers) that each "
+                                     "detector acquires"
+                           )
+
+    def trigger(self) -> None:
+        self.n_triggers += 1
+
+    def run(self):
+        return self.acquire(self.n_points())
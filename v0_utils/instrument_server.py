@@ -0,0 +1,513 @@
+"""
+This module contains a server that owns the connections to instruments in
+one long-lived process, and a client that gives other processes (e.g.
+notebooks) lightweight proxies of those instruments.
+
+The server listens on a local socket (`multiprocessing.connection`, with an
+authentication key). The parameters of a proxy instrument forward `get` and
+`set` to the server, hence a new notebook does not reconnect to the
+instruments and does not initialize their drivers. Sets can be queued and
+sent together with the next request (`InstrumentServerClient.batch`), and
+several parameters can be read in one round trip (`get_many`). The server
+serializes the access to each instrument, and a client can hold the lock of
+an instrument for a sequence of requests (`InstrumentServerClient.lock`).
+
+Example (in the server process):
+    server = InstrumentServer(authkey=b'some secret key', port=5555)
+    server.add_instrument(instrument_factory(Keysight_34465A, 'dmm1', ...))
+    server.serve_forever()
+
+Example (in a notebook):
+    client = InstrumentServerClient(authkey=b'some secret key', port=5555)
+    dmm1 = instrument_factory(Keysight_34465A, 'dmm1', ...,
+                              instrument_server=client)
+    dmm1.volt()
+"""
+
+import logging
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from multiprocessing.connection import Client, Listener
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from qcodes import Instrument, Parameter
+from qcodes.instrument.base import InstrumentBase
+
+from .qcodes_tools import VirtualInstrument, instrument_factory
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 5555
+AUTHKEY_VARIABLE = 'V0_INSTRUMENT_SERVER_AUTHKEY'
+
+
+class InstrumentServerError(RuntimeError):
+    """Error that has been raised on the server while handling a request"""
+
+
+def describe_instrument(instrument: InstrumentBase) -> Dict:
+    """
+    Description of the parameters and submodules of an instrument, from
+    which a client builds its proxy.
+    """
+    parameters = OrderedDict()
+    for name, parameter in instrument.parameters.items():
+        parameters[name] = {'label': parameter.label,
+                            'unit': parameter.unit,
+                            'gettable': hasattr(parameter, 'get'),
+                            'settable': hasattr(parameter, 'set'),
+                            'snapshot_value': parameter._snapshot_value}
+    submodules = OrderedDict(
+        (name, describe_instrument(submodule))
+        for name, submodule in instrument.submodules.items()
+        if isinstance(submodule, InstrumentBase))
+    return {'parameters': parameters, 'submodules': submodules}
+
+
+class InstrumentServer:
+    """
+    Server of instruments over a local socket.
+
+    A request is a list of operations, and the reply is the list of their
+    outcomes, `('ok', result)` or `('error', message)`. The operations are:
+
+        ('get', instrument name, parameter path)
+        ('set', instrument name, parameter path, value)
+        ('call', instrument name, method path, args, kwargs)
+        ('describe', instrument name)
+        ('create', instrument class, instrument name, args, kwargs)
+        ('lock', instrument name) / ('unlock', instrument name)
+
+    where a path is relative to the instrument, e.g. 'ch1.voltage'; paths
+    with private attributes (starting with '_') are refused. Every
+    operation holds the lock of its instrument; a client that has locked
+    an instrument (possibly several times) holds it until it unlocks it as
+    many times or disconnects.
+
+    Since the clients can call methods of the instruments, the
+    authentication key has to be kept secret.
+
+    Args:
+        authkey
+            Authentication key that the clients have to present
+        host
+            Host name to listen on; by default, only local connections are
+            accepted
+        port
+            Port to listen on
+    """
+
+    def __init__(self,
+                 authkey: bytes,
+                 host: str = 'localhost',
+                 port: int = DEFAULT_PORT) -> None:
+        if not authkey:
+            raise ValueError("An authentication key is required.")
+        self._listener = Listener((host, port), authkey=authkey)
+        self._instruments = OrderedDict()
+        self._locks = {}
+        self._registry_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._listener.address
+
+    @property
+    def instruments(self) -> Dict[str, InstrumentBase]:
+        return OrderedDict(self._instruments)
+
+    def add_instrument(self, instrument: InstrumentBase) -> None:
+        """Serve the given instrument"""
+        with self._registry_lock:
+            self._instruments[instrument.name] = instrument
+            self._locks.setdefault(instrument.name, threading.RLock())
+
+    def _create(self, instrument_class: type, name: str, args: Sequence,
+                kwargs: Dict) -> None:
+        with self._registry_lock:
+            if name in self._instruments:
+                return
+        if issubclass(instrument_class, Instrument):
+            instrument = instrument_factory(instrument_class, name, *args,
+                                            **kwargs)
+        else:
+            instrument = instrument_class(name, *args, **kwargs)
+        self.add_instrument(instrument)
+
+    def _instrument(self, name: str) -> InstrumentBase:
+        try:
+            return self._instruments[name]
+        except KeyError:
+            raise KeyError(f"Instrument {name} is not served.") from None
+
+    @staticmethod
+    def _resolve(instrument: InstrumentBase, path: str) -> Any:
+        target = instrument
+        for part in path.split('.'):
+            if part.startswith('_'):
+                raise AttributeError(f"Private attribute {part!r} cannot "
+                                     f"be accessed.")
+            target = getattr(target, part)
+        return target
+
+    def _execute(self, operation: Tuple, held_locks: Counter) -> Any:
+        kind, *arguments = operation
+        if kind == 'create':
+            self._create(*arguments)
+            return None
+        if kind == 'instruments':
+            return list(self._instruments)
+
+        name = arguments[0]
+        instrument = self._instrument(name)
+        lock = self._locks[name]
+        if kind == 'lock':
+            lock.acquire()
+            held_locks[name] += 1
+            return None
+        if kind == 'unlock':
+            if held_locks[name] > 0:
+                held_locks[name] -= 1
+                lock.release()
+            return None
+
+        with lock:
+            if kind == 'describe':
+                return describe_instrument(instrument)
+            if kind == 'get':
+                return self._resolve(instrument, arguments[1]).get()
+            if kind == 'set':
+                self._resolve(instrument, arguments[1]).set(arguments[2])
+                return None
+            if kind == 'call':
+                path, args, kwargs = arguments[1:]
+                return self._resolve(instrument, path)(*args, **kwargs)
+        raise ValueError(f"Unknown operation {kind!r}.")
+
+    def _handle(self, connection) -> None:
+        held_locks = Counter()  # number of times each lock is held
+        try:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    break
+                reply = []
+                for operation in request:
+                    try:
+                        reply.append(('ok', self._execute(operation,
+                                                          held_locks)))
+                    except Exception as exception:
+                        reply.append(('error', repr(exception)))
+                connection.send(reply)
+        finally:
+            # a client that disconnects releases its locks
+            for name, depth in held_locks.items():
+                for _ in range(depth):
+                    self._locks[name].release()
+            connection.close()
+
+    def serve_forever(self) -> None:
+        """
+        Accept clients until the server is closed; every client is served
+        by its own thread.
+        """
+        while not self._closed:
+            try:
+                connection = self._listener.accept()
+            except (OSError, EOFError):
+                if self._closed:
+                    break
+                log.warning("Failed to accept a client", exc_info=True)
+                continue
+            threading.Thread(target=self._handle, args=(connection,),
+                             daemon=True).start()
+
+    def start(self) -> None:
+        """Serve from a background thread of this process"""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='InstrumentServer', daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._closed = True
+        self._listener.close()
+
+
+class InstrumentServerClient:
+    """
+    Client of an `InstrumentServer`. A client can be shared by the threads
+    of a process; its requests are serialized.
+
+    Args:
+        authkey
+            Authentication key of the server
+        host
+            Host name of the server
+        port
+            Port of the server
+    """
+
+    def __init__(self,
+                 authkey: bytes,
+                 host: str = 'localhost',
+                 port: int = DEFAULT_PORT) -> None:
+        self._connection = Client((host, port), authkey=authkey)
+        self._connection_lock = threading.Lock()
+        self._queued = []
+        self._batching = 0
+        self._proxies = {}
+        self.n_requests = 0
+
+    def request(self, operations: Sequence[Tuple]) -> List[Any]:
+        """
+        Send the queued sets and the given operations in one request, and
+        return the results of the given operations.
+
+        Raises:
+            InstrumentServerError if any of the operations failed
+        """
+        with self._connection_lock:
+            operations = self._queued + list(operations)
+            n_queued = len(self._queued)
+            self._queued = []
+            self._connection.send(operations)
+            reply = self._connection.recv()
+            self.n_requests += 1
+        errors = [f"{operation[:3]}: {result}"
+                  for operation, (status, result) in zip(operations, reply)
+                  if status == 'error']
+        if errors:
+            raise InstrumentServerError('; '.join(errors))
+        return [result for _, result in reply[n_queued:]]
+
+    def flush(self) -> None:
+        """Send the queued sets"""
+        if self._queued:
+            self.request([])
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """
+        Within this context, sets are queued instead of being sent one by
+        one. The queue is sent on exit, or together with the next get.
+        """
+        self._batching += 1
+        try:
+            yield
+        finally:
+            self._batching -= 1
+            if not self._batching:
+                self.flush()
+
+    @contextmanager
+    def lock(self, instrument_name: str) -> Iterator[None]:
+        """
+        Hold the lock of the instrument on the server within this context,
+        so that other clients cannot access the instrument in between the
+        requests of this client.
+        """
+        self.request([('lock', instrument_name)])
+        try:
+            yield
+        finally:
+            self.request([('unlock', instrument_name)])
+
+    def get(self, instrument_name: str, path: str) -> Any:
+        return self.request([('get', instrument_name, path)])[0]
+
+    def set(self, instrument_name: str, path: str, value: Any) -> None:
+        operation = ('set', instrument_name, path, value)
+        if self._batching:
+            with self._connection_lock:
+                self._queued.append(operation)
+        else:
+            self.request([operation])
+
+    def get_many(self, parameters: Sequence['ProxyParameter']) -> List[Any]:
+        """Get the values of the given proxy parameters in one request"""
+        values = self.request([('get', parameter.instrument_name,
+                                parameter.path)
+                               for parameter in parameters])
+        for parameter, value in zip(parameters, values):
+            parameter.cache_value(value)
+        return values
+
+    def call(self, instrument_name: str, path: str, *args, **kwargs) -> Any:
+        """Call a method of an instrument, e.g. `call('dmm1', 'reset')`"""
+        return self.request([('call', instrument_name, path, args,
+                              kwargs)])[0]
+
+    def instruments(self) -> List[str]:
+        """Names of the instruments that the server serves"""
+        return self.request([('instruments',)])[0]
+
+    def instrument(self, name: str) -> 'InstrumentProxy':
+        """Proxy of an instrument of the server"""
+        if name not in self._proxies:
+            description = self.request([('describe', name)])[0]
+            self._proxies[name] = InstrumentProxy(self, name, description)
+        return self._proxies[name]
+
+    def get_or_create(self,
+                      instrument_class: type,
+                      name: str,
+                      *args, **kwargs) -> 'InstrumentProxy':
+        """
+        Proxy of an instrument of the server, which is created on the
+        server (with `instrument_factory`) if it does not exist yet. The
+        class and the arguments have to be picklable.
+        """
+        if name not in self._proxies:
+            self.request([('create', instrument_class, name, args, kwargs)])
+        return self.instrument(name)
+
+    def close(self) -> None:
+        self.flush()
+        self._connection.close()
+
+
+class ProxyParameter(Parameter):
+    """
+    Parameter that gets and sets the value of a parameter of an instrument
+    of an `InstrumentServer`.
+
+    Args:
+        name
+            Name of the parameter
+        client
+            Client of the server
+        instrument_name
+            Name of the instrument on the server
+        path
+            Path of the parameter relative to the instrument,
+            e.g. 'ch1.voltage'
+        gettable
+            Whether the parameter of the server can be gotten
+        settable
+            Whether the parameter of the server can be set
+    """
+
+    def __init__(self,
+                 name: str,
+                 client: InstrumentServerClient,
+                 instrument_name: str,
+                 path: str,
+                 gettable: bool = True,
+                 settable: bool = True,
+                 **kwargs) -> None:
+        self.client = client
+        self.instrument_name = instrument_name
+        self.path = path
+        super().__init__(name,
+                         get_cmd=self._get_from_server if gettable else False,
+                         set_cmd=self._set_on_server if settable else False,
+                         **kwargs)
+
+    def cache_value(self, value: Any) -> None:
+        """Record a value that has been gotten from the server"""
+        self._save_val(value)
+
+    def _get_from_server(self) -> Any:
+        return self.client.get(self.instrument_name, self.path)
+
+    def _set_on_server(self, value: Any) -> None:
+        self.client.set(self.instrument_name, self.path, value)
+
+
+class InstrumentProxy(VirtualInstrument):
+    """
+    Proxy of an instrument of an `InstrumentServer`, with the parameters
+    and the submodules of that instrument. Methods of the instrument can be
+    called via `call`.
+
+    Args:
+        client
+            Client of the server
+        name
+            Name of the instrument on the server
+        description
+            Description of the instrument (see `describe_instrument`)
+        path
+            Path of this (sub)module relative to the instrument
+    """
+
+    def __init__(self,
+                 client: InstrumentServerClient,
+                 name: str,
+                 description: Dict,
+                 path: Optional[str] = None) -> None:
+        super().__init__(name if path is None else path.split('.')[-1])
+        self.client = client
+        self.instrument_name = name
+        self.path = path
+
+        for parameter_name, info in description['parameters'].items():
+            self.add_parameter(
+                parameter_name,
+                parameter_class=ProxyParameter,
+                client=client,
+                instrument_name=name,
+                path=self._path_of(parameter_name),
+                gettable=info['gettable'],
+                settable=info['settable'],
+                label=info['label'],
+                unit=info['unit'],
+                snapshot_value=info['snapshot_value'])
+
+        for submodule_name, submodule in description['submodules'].items():
+            self.add_submodule(submodule_name,
+                               InstrumentProxy(client, name, submodule,
+                                               self._path_of(submodule_name)))
+
+    def _path_of(self, name: str) -> str:
+        return name if self.path is None else f'{self.path}.{name}'
+
+    def call(self, method: str, *args, **kwargs) -> Any:
+        """Call a method of the (sub)module on the server"""
+        return self.client.call(self.instrument_name, self._path_of(method),
+                                *args, **kwargs)
+
+
+def run_instrument_server(authkey: bytes,
+                          host: str = 'localhost',
+                          port: int = DEFAULT_PORT) -> None:
+    """
+    Run an instrument server in this process until it is interrupted.
+    Instruments are created on the server by the clients, see
+    `InstrumentServerClient.get_or_create` and `instrument_factory`.
+    """
+    server = InstrumentServer(authkey, host, port)
+    log.info(f"Serving instruments on {server.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        for instrument in server.instruments.values():
+            if isinstance(instrument, Instrument):
+                instrument.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(description=run_instrument_server.
+                                     __doc__)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    # the key is taken from the environment by default, so that it does
+    # not show up in the list of processes
+    parser.add_argument('--authkey',
+                        default=os.environ.get(AUTHKEY_VARIABLE))
+    arguments = parser.parse_args()
+    if not arguments.authkey:
+        parser.error(f"An authentication key is required, via --authkey "
+                     f"or the {AUTHKEY_VARIABLE} environment variable.")
+    run_instrument_server(arguments.authkey.encode(), arguments.host,
+                          arguments.port)
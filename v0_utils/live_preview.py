@@ -0,0 +1,353 @@
+"""
+This module contains live previews of running measurements that update on
+a time budget instead of on every point.
+
+A preview subscribes to the dataset of a run and receives the new rows
+incrementally (without re-reading the run). The rows are reduced on
+arrival into min/max-decimated arrays of a fixed size, which are allocated
+once, and the plot is refreshed at most every `refresh_interval` seconds.
+All this happens in the thread of the dataset subscriber, hence the
+measurement loop only pays for queueing the rows.
+
+Example:
+    with meas.run() as datasaver:
+        preview = LiveTracePreview(dc_setup.DC_didv_bias,
+                                   dc_setup.i_measurement)
+        preview.subscribe(datasaver.dataset)
+        preview.plot()
+        for b in bias_values:
+            ...
+"""
+
+import threading
+import time
+from typing import Any, Callable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from qcodes import Parameter
+
+ParameterOrName = Union[Parameter, str]
+
+
+class _LivePreview:
+    """
+    Base class of live previews: handles the subscription to a dataset, the
+    selection of the columns of the preview from the rows, and the
+    throttling of the updates. Subclasses implement `_add` (which reduces
+    the new rows into the preview arrays), `_create_artists` and
+    `_update_artists`.
+    """
+
+    def __init__(self,
+                 parameters: Sequence[ParameterOrName],
+                 refresh_interval: float = 0.5,
+                 on_update: Optional[Callable[['_LivePreview'], Any]] = None
+                 ) -> None:
+        self.names = [str(parameter) for parameter in parameters]
+        self.refresh_interval = refresh_interval
+        self.on_update = on_update
+
+        self._lock = threading.Lock()
+        self._columns = None
+        self._last_update = 0.
+        self._has_new_data = False
+        self._figure = None
+
+        self.n_rows = 0
+        self.n_updates = 0
+        self.callback_time = 0.
+
+    @property
+    def has_new_data(self) -> bool:
+        """Whether rows have arrived since the last update"""
+        return self._has_new_data
+
+    def subscribe(self, dataset) -> str:
+        """
+        Subscribe to the given dataset, typically `datasaver.dataset` of a
+        running measurement, and return the ID of the subscriber.
+
+        The subscriber thread of QCoDeS passes the queued rows every
+        `refresh_interval` (`Measurement.add_subscriber` would make it do
+        so after every insert).
+        """
+        names = [parameter.name for parameter in dataset.get_parameters()]
+        missing = [name for name in self.names if name not in names]
+        if missing:
+            raise ValueError(f"Parameters {missing} are not in the dataset "
+                             f"{dataset.run_id}.")
+        # the rows that the subscriber passes contain the values of all the
+        # parameters of the dataset in this order
+        self._columns = [names.index(name) for name in self.names]
+        return dataset.subscribe(self,
+                                 min_wait=int(1000 * self.refresh_interval),
+                                 min_count=1)
+
+    def __call__(self, results: List[Tuple], length: int, state: Any) -> None:
+        """
+        Callback of the dataset subscriber. An update is made if the last
+        one is older than `refresh_interval`, or if the call brings no rows
+        (which is how the subscriber reports the end of the run).
+        """
+        t_start = time.perf_counter()
+        if results:
+            # values of parameters that are not in a row are None (NaN)
+            data = np.array([[row[column] for column in self._columns]
+                             for row in results], dtype=float)
+            data = data[~np.isnan(data).any(axis=1)]
+            if len(data):
+                with self._lock:
+                    self._add(*data.T)
+                    self.n_rows += len(data)
+                    self._has_new_data = True
+
+        if self._has_new_data and (
+                not results
+                or t_start - self._last_update >= self.refresh_interval):
+            self.update()
+        self.callback_time += time.perf_counter() - t_start
+
+    def update(self) -> None:
+        """
+        Update the plot (if `plot` has been called) and call `on_update`.
+        """
+        self._last_update = time.perf_counter()
+        self._has_new_data = False
+        self.n_updates += 1
+        if self._figure is not None:
+            with self._lock:
+                self._update_artists()
+            self._figure.canvas.draw_idle()
+        if self.on_update is not None:
+            self.on_update(self)
+
+    def plot(self, ax=None):
+        """
+        Create the plot of the preview on the given matplotlib axes (or on
+        new ones), which is then refreshed on every update.
+
+        Note that the updates are drawn from the subscriber thread; with a
+        GUI backend that requires drawing from the main thread, call
+        `update` from a timer of the GUI when `has_new_data` instead.
+        """
+        import matplotlib.pyplot as plt
+
+        if ax is None:
+            _, ax = plt.subplots()
+        with self._lock:
+            self._create_artists(ax)
+            self._update_artists()
+        self._figure = ax.figure
+        return ax
+
+    def _add(self, *columns: np.ndarray) -> None:
+        raise NotImplementedError
+
+    def _create_artists(self, ax) -> None:
+        raise NotImplementedError
+
+    def _update_artists(self) -> None:
+        raise NotImplementedError
+
+
+def _bin_indices(values: np.ndarray,
+                 value_range: Tuple[float, float],
+                 n_bins: int) -> np.ndarray:
+    start, stop = value_range
+    indices = np.floor((values - start) / (stop - start) * n_bins)
+    return np.clip(indices, 0, n_bins - 1).astype(int)
+
+
+class LiveTracePreview(_LivePreview):
+    """
+    Live preview of a 1D trace, decimated into `n_bins` bins that keep the
+    minimum and the maximum of the values that fall into them, so that
+    spikes stay visible however long the trace is.
+
+    If `x_range` is given, the bins are equal intervals of the x values in
+    that range (values outside of it go into the outermost bins). Otherwise
+    the bins are consecutive groups of rows: when the rows do not fit any
+    more, neighbouring bins are merged and the groups become twice as long.
+
+    Args:
+        x
+            Parameter (or its name in the dataset) of the x values
+        y
+            Parameter (or its name in the dataset) of the y values
+        n_bins
+            Number of bins of the preview (an even number)
+        x_range
+            Range of the x values
+        refresh_interval
+            Minimal time between updates in seconds
+        on_update
+            Function that is called with the preview on every update
+    """
+
+    def __init__(self,
+                 x: ParameterOrName,
+                 y: ParameterOrName,
+                 n_bins: int = 2000,
+                 x_range: Optional[Tuple[float, float]] = None,
+                 refresh_interval: float = 0.5,
+                 on_update: Optional[Callable[['_LivePreview'], Any]] = None
+                 ) -> None:
+        super().__init__((x, y), refresh_interval, on_update)
+        if n_bins < 2 or n_bins % 2:
+            raise ValueError(f"The number of bins should be a positive even "
+                             f"number, not {n_bins}.")
+        self.x_range = x_range
+        self._rows_per_bin = 1
+        self._min = np.full(n_bins, np.inf)
+        self._max = np.full(n_bins, -np.inf)
+        if x_range is None:
+            self._x = np.full(n_bins, np.nan)  # x of the first row of a bin
+        else:
+            width = (x_range[1] - x_range[0]) / n_bins
+            self._x = x_range[0] + width * (np.arange(n_bins) + 0.5)
+        self._line = None
+
+    def _merge_bins(self) -> None:
+        half = len(self._min) // 2
+        self._min[:half] = np.minimum(self._min[0::2], self._min[1::2])
+        self._max[:half] = np.maximum(self._max[0::2], self._max[1::2])
+        self._x[:half] = self._x[0::2]
+        self._min[half:] = np.inf
+        self._max[half:] = -np.inf
+        self._x[half:] = np.nan
+        self._rows_per_bin *= 2
+
+    def _add(self, x: np.ndarray, y: np.ndarray) -> None:
+        n_bins = len(self._min)
+        if self.x_range is not None:
+            bins = _bin_indices(x, self.x_range, n_bins)
+        else:
+            rows = np.arange(self.n_rows, self.n_rows + len(y))
+            while rows[-1] >= n_bins * self._rows_per_bin:
+                self._merge_bins()
+            bins = rows // self._rows_per_bin
+            first_in_bin = rows % self._rows_per_bin == 0
+            self._x[bins[first_in_bin]] = x[first_in_bin]
+        np.minimum.at(self._min, bins, y)
+        np.maximum.at(self._max, bins, y)
+
+    def data(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Copies of the x values, the minima and the maxima of the bins that
+        contain data
+        """
+        with self._lock:
+            filled = np.isfinite(self._min)
+            return (self._x[filled].copy(), self._min[filled].copy(),
+                    self._max[filled].copy())
+
+    def _create_artists(self, ax) -> None:
+        self._line, = ax.plot([], [])
+        ax.set_xlabel(self.names[0])
+        ax.set_ylabel(self.names[1])
+
+    def _update_artists(self) -> None:
+        filled = np.isfinite(self._min)
+        if not filled.any():
+            return
+        # the line goes through the minimum and the maximum of every bin
+        x = np.repeat(self._x[filled], 2)
+        y = np.stack((self._min[filled], self._max[filled]),
+                     axis=1).reshape(-1)
+        self._line.set_data(x, y)
+        self._line.axes.relim()
+        self._line.axes.autoscale_view()
+
+
+class LiveMapPreview(_LivePreview):
+    """
+    Live preview of a 2D map on a regular grid of pixels, which keeps the
+    mean, the minimum and the maximum of the values that fall into each
+    pixel. Points outside of the ranges go into the outermost pixels.
+
+    Args:
+        x
+            Parameter (or its name in the dataset) of the horizontal axis
+        y
+            Parameter (or its name in the dataset) of the vertical axis
+        z
+            Parameter (or its name in the dataset) of the values
+        x_range
+            Range of the x values
+        y_range
+            Range of the y values
+        shape
+            Number of pixels along y and along x
+        statistic
+            What is shown: 'mean', 'min' or 'max'
+        refresh_interval
+            Minimal time between updates in seconds
+        on_update
+            Function that is called with the preview on every update
+    """
+
+    def __init__(self,
+                 x: ParameterOrName,
+                 y: ParameterOrName,
+                 z: ParameterOrName,
+                 x_range: Tuple[float, float],
+                 y_range: Tuple[float, float],
+                 shape: Tuple[int, int] = (200, 200),
+                 statistic: str = 'mean',
+                 refresh_interval: float = 0.5,
+                 on_update: Optional[Callable[['_LivePreview'], Any]] = None
+                 ) -> None:
+        super().__init__((x, y, z), refresh_interval, on_update)
+        if statistic not in ('mean', 'min', 'max'):
+            raise ValueError(f"Unknown statistic {statistic!r}, should be "
+                             f"'mean', 'min' or 'max'.")
+        self.x_range = x_range
+        self.y_range = y_range
+        self.statistic = statistic
+        self._sum = np.zeros(shape)
+        self._count = np.zeros(shape, dtype=int)
+        self._min = np.full(shape, np.inf)
+        self._max = np.full(shape, -np.inf)
+        self._image = None
+
+    def _add(self, x: np.ndarray, y: np.ndarray, z: np.ndarray) -> None:
+        n_rows, n_columns = self._sum.shape
+        pixels = (_bin_indices(y, self.y_range, n_rows),
+                  _bin_indices(x, self.x_range, n_columns))
+        np.add.at(self._sum, pixels, z)
+        np.add.at(self._count, pixels, 1)
+        np.minimum.at(self._min, pixels, z)
+        np.maximum.at(self._max, pixels, z)
+
+    def _image_data(self) -> np.ndarray:
+        image = np.full(self._sum.shape, np.nan)
+        filled = self._count > 0
+        if self.statistic == 'mean':
+            image[filled] = self._sum[filled] / self._count[filled]
+        elif self.statistic == 'min':
+            image[filled] = self._min[filled]
+        else:
+            image[filled] = self._max[filled]
+        return image
+
+    def data(self) -> np.ndarray:
+        """
+        Image of the chosen statistic, with NaN in the pixels without data
+        """
+        with self._lock:
+            return self._image_data()
+
+    def _create_artists(self, ax) -> None:
+        self._image = ax.imshow(
+            self._image_data(), origin='lower', aspect='auto',
+            interpolation='nearest',
+            extent=(*self.x_range, *self.y_range))
+        ax.figure.colorbar(self._image, ax=ax, label=self.names[2])
+        ax.set_xlabel(self.names[0])
+        ax.set_ylabel(self.names[1])
+
+    def _update_artists(self) -> None:
+        image = self._image_data()
+        self._image.set_data(image)
+        if np.isfinite(image).any():
+            self._image.set_clim(np.nanmin(image), np.nanmax(image))
@@ -0,0 +1,562 @@
+"""
+This module contains image pyramids of gridded runs, for fast rendering and
+interactive browsing of large 2D maps and slices of 3D cubes.
+
+A pyramid holds the data of a parameter at full resolution and at a number
+of levels that are down-sampled by a constant factor (reducing blocks of
+pixels to their mean, or to their minimum and maximum, ignoring NaNs). The
+levels are cached as `.npy` files next to the database file, the same way
+as the gridded data of `load_gridded_run` (whose cache file is linked as
+the full-resolution level), and are memory-mapped when they are loaded
+again. A viewer picks the level that matches the resolution of the current
+view and renders it with `imshow`, which assumes regular grids.
+
+Example:
+    pyramid = load_pyramid(run_id, 'lockin_R')
+    viewer = PyramidViewer(pyramid, slice_index=(10,))
+    viewer.set_slice((11,))  # next slice of the cube
+"""
+
+import json
+import os
+import shutil
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from qcodes.dataset.data_set import load_by_id
+
+from .gridded_data import _last_row_id, load_gridded_run
+
+REDUCTIONS = {'mean': ('mean',), 'minmax': ('min', 'max')}
+
+
+class PyramidLevel(NamedTuple):
+    """
+    Level of an image pyramid: arrays of the reduced data per statistic
+    ('mean', or 'min' and 'max'), with the last two dimensions down-sampled,
+    and the (block-averaged) values of the setpoints along those two
+    dimensions.
+    """
+    data: Dict[str, np.ndarray]
+    row_axis: np.ndarray
+    column_axis: np.ndarray
+
+
+def _pad_blocks(data: np.ndarray, factor: int, fill: float) -> np.ndarray:
+    """
+    Pad the last two dimensions of the data to multiples of the factor, and
+    reshape them into blocks of shape (factor, factor).
+    """
+    n_rows, n_columns = data.shape[-2:]
+    pad_rows, pad_columns = -n_rows % factor, -n_columns % factor
+    if pad_rows or pad_columns:
+        data = np.pad(data, [(0, 0)] * (data.ndim - 2)
+                      + [(0, pad_rows), (0, pad_columns)],
+                      mode='constant', constant_values=fill)
+    return data.reshape(data.shape[:-2]
+                        + ((n_rows + pad_rows) // factor, factor,
+                           (n_columns + pad_columns) // factor, factor))
+
+
+def _reduce_axis(axis: np.ndarray, factor: int) -> np.ndarray:
+    axis = np.asarray(axis, dtype=float)
+    padded = np.pad(axis, (0, -len(axis) % factor), mode='constant',
+                    constant_values=np.nan)
+    blocks = padded.reshape(-1, factor)
+    return np.nansum(blocks, axis=1) / np.sum(~np.isnan(blocks), axis=1)
+
+
+def reduce_image(data: np.ndarray,
+                 factor: int = 2,
+                 reduction: str = 'mean') -> Dict[str, np.ndarray]:
+    """
+    Down-sample the last two dimensions of the data by the given factor,
+    reducing blocks of factor x factor pixels (partial blocks at the edges
+    included) and ignoring NaNs. Blocks with only NaNs are NaN.
+
+    Args:
+        data
+            Array with at least two dimensions
+        factor
+            Down-sampling factor
+        reduction
+            'mean' or 'minmax'
+
+    Returns:
+        Reduced arrays per statistic: 'mean', or 'min' and 'max'
+    """
+    if reduction not in REDUCTIONS:
+        raise ValueError(f"Unknown reduction {reduction!r}, should be one "
+                         f"of {tuple(REDUCTIONS)}.")
+    data = np.asarray(data, dtype=float)
+    if reduction == 'minmax':
+        blocks = _pad_blocks(data, factor, np.nan)
+        return {'min': np.fmin.reduce(np.fmin.reduce(blocks, axis=-1),
+                                      axis=-2),
+                'max': np.fmax.reduce(np.fmax.reduce(blocks, axis=-1),
+                                      axis=-2)}
+
+    valid = ~np.isnan(data)
+    sums = _pad_blocks(np.where(valid, data, 0.), factor, 0.)
+    counts = _pad_blocks(valid, factor, False)
+    sums = sums.sum(axis=-1).sum(axis=-2)
+    counts = counts.sum(axis=-1).sum(axis=-2)
+    mean = np.full(sums.shape, np.nan)
+    np.divide(sums, counts, out=mean, where=counts > 0)
+    return {'mean': mean}
+
+
+class ImagePyramid:
+    """
+    Image pyramid of a gridded parameter: level 0 is the full-resolution
+    data, and every next level is down-sampled along the last two
+    dimensions (the rows and the columns of the image) by `factor`. The
+    other (leading) dimensions, e.g. the slices of a 3D cube, are kept.
+
+    Args:
+        levels
+            The levels, from full resolution to the coarsest
+        factor
+            Down-sampling factor between consecutive levels
+        reduction
+            'mean' or 'minmax'
+        name
+            Name of the parameter
+        axis_names
+            Names of the setpoints, one per dimension of the data
+        leading_axes
+            Values of the setpoints along the leading dimensions
+    """
+
+    def __init__(self,
+                 levels: List[PyramidLevel],
+                 factor: int,
+                 reduction: str,
+                 name: str = '',
+                 axis_names: Sequence[str] = (),
+                 leading_axes: Sequence[np.ndarray] = ()) -> None:
+        self.levels = levels
+        self.factor = factor
+        self.reduction = reduction
+        self.name = name
+        self.axis_names = tuple(axis_names)
+        self.leading_axes = tuple(leading_axes)
+
+    @property
+    def statistics(self) -> Tuple[str, ...]:
+        return REDUCTIONS[self.reduction]
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        """Shape of the full-resolution data"""
+        return next(iter(self.levels[0].data.values())).shape
+
+    def level_for(self,
+                  n_rows: float,
+                  n_columns: float,
+                  height_pixels: float,
+                  width_pixels: float) -> int:
+        """
+        Index of the coarsest level that still has at least one data point
+        per screen pixel, for a view of `n_rows` x `n_columns` points of
+        the full-resolution data drawn on `height_pixels` x `width_pixels`
+        screen pixels.
+        """
+        points_per_pixel = min(n_rows / max(height_pixels, 1),
+                               n_columns / max(width_pixels, 1))
+        if points_per_pixel <= 1:
+            return 0
+        level = int(np.floor(np.log(points_per_pixel)
+                             / np.log(self.factor)))
+        return min(level, len(self.levels) - 1)
+
+
+def build_pyramid(data: np.ndarray,
+                  row_axis: Optional[np.ndarray] = None,
+                  column_axis: Optional[np.ndarray] = None,
+                  factor: int = 2,
+                  reduction: str = 'mean',
+                  min_size: int = 64) -> ImagePyramid:
+    """
+    Build an image pyramid in memory; levels are added until both image
+    dimensions are at most `min_size`.
+
+    Args:
+        data
+            Array whose last two dimensions are the rows and the columns of
+            the image
+        row_axis
+            Setpoint values along the rows; by default, the indices
+        column_axis
+            Setpoint values along the columns; by default, the indices
+        factor
+            Down-sampling factor between consecutive levels
+        reduction
+            'mean' or 'minmax'
+        min_size
+            Size of the image below which no further levels are added
+    """
+    data = np.asarray(data)
+    if data.ndim < 2:
+        raise ValueError(f"Image pyramids need at least 2D data, not "
+                         f"{data.ndim}D.")
+    n_rows, n_columns = data.shape[-2:]
+    row_axis = np.arange(n_rows) if row_axis is None else row_axis
+    column_axis = np.arange(n_columns) if column_axis is None \
+        else column_axis
+    # the viewer looks up the visible part of the axes with searchsorted,
+    # hence descending axes are flipped (with the data)
+    data, row_axis = _ascending(data, row_axis, -2)
+    data, column_axis = _ascending(data, column_axis, -1)
+
+    levels = [PyramidLevel({statistic: data
+                            for statistic in REDUCTIONS[reduction]},
+                           np.asarray(row_axis, dtype=float),
+                           np.asarray(column_axis, dtype=float))]
+    for level_data, level_rows, level_columns in _iter_levels(
+            data, row_axis, column_axis, factor, reduction, min_size):
+        levels.append(PyramidLevel(level_data, level_rows, level_columns))
+    return ImagePyramid(levels, factor, reduction)
+
+
+def _ascending(data: np.ndarray,
+               axis: np.ndarray,
+               dimension: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Flip the data along the dimension if the setpoints along it are
+    descending; the setpoints must be monotonic.
+    """
+    axis = np.asarray(axis, dtype=float)
+    if len(axis) != data.shape[dimension]:
+        raise ValueError(f"The axis has {len(axis)} values, but the data "
+                         f"has {data.shape[dimension]} along dimension "
+                         f"{dimension}.")
+    steps = np.diff(axis)
+    if np.all(steps < 0):
+        return np.flip(data, dimension), axis[::-1]
+    if not np.all(steps > 0):
+        raise ValueError("The setpoints of the rows and the columns of an "
+                         "image pyramid must be monotonic.")
+    return data, axis
+
+
+def _iter_levels(data: np.ndarray,
+                 row_axis: np.ndarray,
+                 column_axis: np.ndarray,
+                 factor: int,
+                 reduction: str,
+                 min_size: int):
+    """
+    Iterate over the down-sampled levels of the data, each reduced from the
+    previous one (for the mean, by weighting with the number of valid
+    points, so that the result is the mean over the full resolution).
+    """
+    if reduction == 'mean':
+        valid = ~np.isnan(data)
+        sums = np.where(valid, data, 0.)
+        counts = valid.astype(float)
+    else:
+        current = reduce_image(data, 1, reduction)
+
+    while max(data.shape[-2:]) > min_size:
+        row_axis = _reduce_axis(row_axis, factor)
+        column_axis = _reduce_axis(column_axis, factor)
+        if reduction == 'mean':
+            sums = _pad_blocks(sums, factor, 0.).sum(axis=-1).sum(axis=-2)
+            counts = _pad_blocks(counts, factor, 0.).sum(axis=-1) \
+                .sum(axis=-2)
+            mean = np.full(sums.shape, np.nan)
+            np.divide(sums, counts, out=mean, where=counts > 0)
+            current = {'mean': mean}
+        else:
+            current = {'min': reduce_image(current['min'], factor,
+                                           'minmax')['min'],
+                       'max': reduce_image(current['max'], factor,
+                                           'minmax')['max']}
+        data = next(iter(current.values()))
+        yield current, row_axis, column_axis
+
+
+def _pyramid_dir(path_to_db: str, run_id: int, name: str) -> str:
+    db_base = os.path.splitext(os.path.abspath(path_to_db))[0]
+    return os.path.join(db_base + '_pyramid_cache', f'run_{run_id}', name)
+
+
+def _load_cached_pyramid(cache_dir: str, key: Dict) -> Optional[ImagePyramid]:
+    try:
+        with open(os.path.join(cache_dir, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+    if meta['key'] != key or 'level_0_shape' not in meta:
+        return None
+
+    levels = []
+    for i in range(meta['n_levels']):
+        def path(suffix):
+            return os.path.join(cache_dir, f'level_{i}_{suffix}.npy')
+        rows, columns = np.load(path('rows')), np.load(path('columns'))
+        if i == 0:
+            # level 0 is the gridded data, which all the statistics share
+            try:
+                data = np.load(path('data'), mmap_mode='r')
+            except OSError:
+                return None
+            if list(data.shape) != meta['level_0_shape'] \
+                    or data.shape[-2:] != (len(rows), len(columns)):
+                return None
+            level_data = {statistic: data
+                          for statistic in REDUCTIONS[key['reduction']]}
+        else:
+            level_data = {statistic: np.load(path(statistic), mmap_mode='r')
+                          for statistic in REDUCTIONS[key['reduction']]}
+        levels.append(PyramidLevel(level_data, rows, columns))
+    leading_axes = [np.load(os.path.join(cache_dir, f'axis_{i}.npy'))
+                    for i in range(meta['n_leading_axes'])]
+    return ImagePyramid(levels, key['factor'], key['reduction'],
+                        meta['name'], meta['axis_names'], leading_axes)
+
+
+def _pyramid_to_cache(cache_dir: str,
+                      key: Dict,
+                      gridded,
+                      min_size: int) -> None:
+    tmp_dir = cache_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    data = gridded.data
+    axes = gridded.axes
+    factor, reduction = key['factor'], key['reduction']
+    n_leading = data.ndim - 2
+
+    def path(level, suffix):
+        return os.path.join(tmp_dir, f'level_{level}_{suffix}.npy')
+
+    # level 0 is the gridded data itself: the file of the grid cache is
+    # hard-linked, so that it does not take disk space twice, and stays
+    # valid when the grid cache is rebuilt (e.g. with other decimals); it
+    # is copied if it cannot be linked, and saved if it is not in a file
+    filename = getattr(data, 'filename', None)
+    if filename is not None and os.path.exists(filename):
+        try:
+            os.link(filename, path(0, 'data'))
+        except OSError:
+            shutil.copyfile(filename, path(0, 'data'))
+    else:
+        np.save(path(0, 'data'), data)
+    n_levels = 1
+    outputs = {}
+    # the leading dimensions (e.g. slices of a cube) are processed one
+    # slice at a time, so that only one slice is in memory
+    for index in np.ndindex(*data.shape[:n_leading]):
+        image = np.asarray(data[index], dtype=float)
+        levels = _iter_levels(image, axes[-2], axes[-1], factor, reduction,
+                              min_size)
+        for level, (level_data, rows, columns) in enumerate(levels, 1):
+            for statistic, reduced in level_data.items():
+                if (level, statistic) not in outputs:
+                    outputs[level, statistic] = np.lib.format.open_memmap(
+                        path(level, statistic), mode='w+', dtype=float,
+                        shape=data.shape[:n_leading] + reduced.shape)
+                    np.save(path(level, 'rows'), rows)
+                    np.save(path(level, 'columns'), columns)
+                outputs[level, statistic][index] = reduced
+            n_levels = max(n_levels, level + 1)
+    for output in outputs.values():
+        output.flush()
+    outputs.clear()
+    np.save(path(0, 'rows'), np.asarray(axes[-2], dtype=float))
+    np.save(path(0, 'columns'), np.asarray(axes[-1], dtype=float))
+    for i, axis in enumerate(axes[:n_leading]):
+        np.save(os.path.join(tmp_dir, f'axis_{i}.npy'), axis)
+
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as meta_file:
+        json.dump({'key': key,
+                   'name': gridded.name,
+                   'axis_names': list(gridded.setpoint_names),
+                   'n_levels': n_levels,
+                   'n_leading_axes': n_leading,
+                   'level_0_shape': list(data.shape)}, meta_file)
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+
+def load_pyramid(run_id: int,
+                 name: str,
+                 factor: int = 2,
+                 reduction: str = 'mean',
+                 min_size: int = 64,
+                 decimals: Optional[int] = None) -> ImagePyramid:
+    """
+    Load the image pyramid of a dependent parameter of a run, building it
+    from the gridded data (see `load_gridded_run`) and caching it in a
+    "<database name>_pyramid_cache" directory next to the database file if
+    it is not cached yet. The cache is rebuilt if rows have been added to
+    the run since, or if it was built with different settings.
+
+    The last two setpoints of the parameter are the rows and the columns of
+    the images; the other setpoints are leading dimensions (slices).
+
+    Args:
+        run_id
+            ID of the run in the database that QCoDeS refers to
+        name
+            Name of the dependent parameter, with at least two setpoints
+        factor
+            Down-sampling factor between consecutive levels
+        reduction
+            'mean' or 'minmax'
+        min_size
+            Size of the image below which no further levels are added
+        decimals
+            Passed to `load_gridded_run`
+    """
+    if reduction not in REDUCTIONS:
+        raise ValueError(f"Unknown reduction {reduction!r}, should be one "
+                         f"of {tuple(REDUCTIONS)}.")
+    dataset = load_by_id(run_id)
+    key = {'last_row_id': _last_row_id(dataset),
+           'factor': factor,
+           'reduction': reduction,
+           'min_size': min_size,
+           'decimals': decimals}
+    cache_dir = _pyramid_dir(dataset.path_to_db, run_id, name)
+
+    pyramid = _load_cached_pyramid(cache_dir, key)
+    if pyramid is None:
+        gridded = load_gridded_run(run_id, [name], decimals=decimals)[name]
+        if gridded.data.ndim < 2:
+            raise ValueError(f"Parameter {name} is not gridded in at least "
+                             f"2 dimensions.")
+        _pyramid_to_cache(cache_dir, key, gridded, min_size)
+        pyramid = _load_cached_pyramid(cache_dir, key)
+    return pyramid
+
+
+def _extent(axis: np.ndarray) -> Tuple[float, float]:
+    """Edges of the pixels at the ends of a regular axis"""
+    if len(axis) < 2:
+        return axis[0] - 0.5, axis[0] + 0.5
+    step = (axis[-1] - axis[0]) / (len(axis) - 1)
+    return axis[0] - step / 2, axis[-1] + step / 2
+
+
+def _visible_range(axis: np.ndarray,
+                   limits: Tuple[float, float]) -> Tuple[int, int]:
+    """Range of indices of a sorted axis within the limits (plus margin)"""
+    low, high = sorted(limits)
+    start = max(int(np.searchsorted(axis, low)) - 1, 0)
+    stop = min(int(np.searchsorted(axis, high)) + 1, len(axis))
+    return start, max(stop, start + 1)
+
+
+class PyramidViewer:
+    """
+    Viewer of an image pyramid on matplotlib axes. After every zoom or pan,
+    the part of the level that matches the resolution of the view is drawn
+    with `imshow`; slices of the leading dimensions are chosen with
+    `set_slice`. Only the visible part of a level is read from the
+    (memory-mapped) cache.
+
+    Args:
+        pyramid
+            The image pyramid
+        ax
+            Matplotlib axes; by default, new ones are created
+        slice_index
+            Indices along the leading dimensions of the data; by default,
+            the first slice
+        statistic
+            Statistic to show ('mean', 'min' or 'max'); by default, the
+            first one of the pyramid
+        **imshow_kwargs
+            Passed to `imshow`, e.g. `cmap`, `vmin`, `vmax`
+    """
+
+    def __init__(self,
+                 pyramid: ImagePyramid,
+                 ax=None,
+                 slice_index: Optional[Tuple[int, ...]] = None,
+                 statistic: Optional[str] = None,
+                 **imshow_kwargs) -> None:
+        import matplotlib.pyplot as plt
+
+        self.pyramid = pyramid
+        self.statistic = statistic or pyramid.statistics[0]
+        self.slice_index = self._check_slice(
+            (0,) * (len(pyramid.shape) - 2) if slice_index is None
+            else slice_index)
+        self.level = None
+        self.ax = ax if ax is not None else plt.subplots()[1]
+
+        level = pyramid.levels[-1]
+        self._image = self.ax.imshow(
+            self._slice(level)[...],
+            origin='lower', aspect='auto', interpolation='nearest',
+            extent=_extent(level.column_axis) + _extent(level.row_axis),
+            **imshow_kwargs)
+        axis_names = pyramid.axis_names
+        if len(axis_names) >= 2:
+            self.ax.set_ylabel(axis_names[-2])
+            self.ax.set_xlabel(axis_names[-1])
+        self.ax.set_title(pyramid.name)
+        self._updating = False
+        self.ax.callbacks.connect('xlim_changed', self._on_limits_changed)
+        self.ax.callbacks.connect('ylim_changed', self._on_limits_changed)
+        self.update()
+
+    def _slice(self, level: PyramidLevel) -> np.ndarray:
+        return level.data[self.statistic][self.slice_index]
+
+    def _check_slice(self, slice_index: Tuple[int, ...]) -> Tuple[int, ...]:
+        slice_index = tuple(slice_index)
+        n_leading = len(self.pyramid.shape) - 2
+        if len(slice_index) != n_leading:
+            raise ValueError(f"The slice needs {n_leading} indices (one per "
+                             f"leading dimension), not {len(slice_index)}.")
+        return slice_index
+
+    def set_slice(self, slice_index: Tuple[int, ...]) -> None:
+        """Show the given slice of the leading dimensions"""
+        self.slice_index = self._check_slice(slice_index)
+        self.update()
+
+    def _on_limits_changed(self, ax) -> None:
+        if not self._updating:
+            self.update()
+
+    def update(self) -> None:
+        """
+        Pick the level for the current view, and draw its visible part.
+        """
+        full = self.pyramid.levels[0]
+        x_limits = self.ax.get_xlim()
+        y_limits = self.ax.get_ylim()
+        n_rows = np.subtract(*_visible_range(full.row_axis, y_limits)[::-1])
+        n_columns = np.subtract(
+            *_visible_range(full.column_axis, x_limits)[::-1])
+        window = self.ax.get_window_extent()
+        self.level = self.pyramid.level_for(n_rows, n_columns,
+                                            window.height, window.width)
+
+        level = self.pyramid.levels[self.level]
+        row_start, row_stop = _visible_range(level.row_axis, y_limits)
+        column_start, column_stop = _visible_range(level.column_axis,
+                                                   x_limits)
+        image = np.asarray(self._slice(level)[row_start:row_stop,
+                                              column_start:column_stop])
+
+        # setting the extent of the image must not change the view
+        self._updating = True
+        try:
+            self._image.set_data(image)
+            self._image.set_extent(
+                _extent(level.column_axis[column_start:column_stop])
+                + _extent(level.row_axis[row_start:row_stop]))
+            self.ax.set_xlim(x_limits)
+            self.ax.set_ylim(y_limits)
+        finally:
+            self._updating = False
+        self.ax.figure.canvas.draw_idle()
@@ -6,8 +6,19 @@ The members of this module might be candidates for integration into QCoDeS
 codebase.
 """
 
-from typing import Type, Sequence
-
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Type
+
+import numpy as np
 import qcodes
 from qcodes import Instrument, Parameter
 from qcodes.dataset.database import initialise_database
@@ -51,7 +62,9 @@ class VirtualInstrument(InstrumentBase):
 
 def instrument_factory(instrument_class: type,
                        name: str,
-                       *args, **kwargs
+                       *args,
+                       instrument_server=None,
+                       **kwargs
                        ) -> Type[Instrument]:
     """
     Find an instrument with the given name of a given class, or create one if
@@ -65,10 +78,17 @@ def instrument_factory(instrument_class: type,
             Class of the instrument to find or create
         name
             Name of the instrument to find or create
+        instrument_server
+            Client of an instrument server (see `instrument_server` module);
+            if given, the instrument is found or created in the process of
+            the server, and a proxy of it is returned
 
     Returns:
         The found or created instrument
     """
+    if instrument_server is not None:
+        return instrument_server.get_or_create(instrument_class, name,
+                                               *args, **kwargs)
     try:
         instrument = Instrument.find_instrument(
             name, instrument_class=instrument_class)
@@ -95,6 +115,28 @@ def init_or_create_database(db_file_with_abs_path: str) -> None:
     initialise_database()
 
 
+@contextmanager
+def temporary_database() -> Iterator[str]:
+    """
+    Let QCoDeS refer to a new database in a temporary directory, e.g. for
+    benchmarks, and restore the database that it referred to afterwards.
+
+    Yields:
+        Path of the temporary database file
+    """
+    old_db_location = qcodes.config.core.db_location
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'benchmark.db')
+        init_or_create_database(path)
+        yield path
+    finally:
+        qcodes.config.core.db_location = old_db_location
+        # the datasets keep their connections open, hence the database
+        # file may not be removable on Windows
+        shutil.rmtree(directory, ignore_errors=True)
+
+
 def load_or_create_experiment(experiment_name: str,
                               sample_name: str
                               ) -> Experiment:
@@ -141,6 +183,270 @@ def add_parameter_to_instrument(parameter: Type[Parameter],
     instrument.parameters.update(
         {parameter.name: parameter}
     )
+    instrument_latency(parameter)
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies (in seconds) on logarithmic bins, with the exact
+    count, total and maximum. Percentiles are given with the resolution of
+    the bins, which is about 5%.
+    """
+
+    bins_per_decade = 50
+    min_latency = 1e-7  # seconds
+    n_decades = 10
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self._counts = np.zeros(self.bins_per_decade * self.n_decades + 1,
+                                dtype=np.int64)
+
+    def record(self, latency: float) -> None:
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+        if latency > self.min_latency:
+            index = int(math.log10(latency / self.min_latency)
+                        * self.bins_per_decade) + 1
+            index = min(index, len(self._counts) - 1)
+        else:
+            index = 0
+        self._counts[index] += 1
+
+    def percentile(self, q: float) -> float:
+        """
+        Latency below which `q` percent of the recorded latencies are (the
+        upper edge of the bin where that happens, limited by the maximum)
+        """
+        if self.count == 0:
+            return float('nan')
+        index = int(np.searchsorted(np.cumsum(self._counts),
+                                    q / 100 * self.count))
+        upper_edge = self.min_latency * 10 ** (index / self.bins_per_decade)
+        return min(upper_edge, self.max)
+
+    def summary(self) -> Dict[str, float]:
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else 0.,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'max': self.max}
+
+
+class LatencyRecorder:
+    """
+    Recorder of the latencies of `get` and `set` calls of parameters, per
+    parameter and operation. Parameters report to the recorder if they are
+    instrumented (see `instrument_latency`), which is the case for all
+    `DelegateParameter`s and for parameters added to an instrument with
+    `add_parameter_to_instrument`.
+
+    The recorder is off by default; then an instrumented call costs only a
+    check of the `enabled` flag. Switch it on for a measurement and look at
+    the latencies live, or save them with the run:
+
+        with latency_recorder.recording():
+            with meas.run() as datasaver:
+                ...
+                latency_recorder.add_to_metadata(datasaver)
+        latency_recorder.print_summary()
+    """
+
+    metadata_tag = 'parameter_latencies'
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self.histograms = {}
+
+    @contextmanager
+    def recording(self, reset: bool = True) -> Iterator['LatencyRecorder']:
+        """
+        Context manager that enables the recorder (and clears the previous
+        records if `reset` is True) and disables it afterwards
+        """
+        if reset:
+            self.reset()
+        self.enable()
+        try:
+            yield self
+        finally:
+            self.disable()
+
+    def record(self, parameter: Parameter, operation: str,
+               latency: float) -> None:
+        key = (parameter.full_name, operation)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.record(latency)
+
+    def summary(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """
+        Statistics of the latencies (count, total, mean, p50, p95, p99 and
+        max, in seconds) per parameter name and operation ('get' or 'set')
+        """
+        summary = {}
+        with self._lock:
+            for (name, operation), histogram in self.histograms.items():
+                summary.setdefault(name, {})[operation] = histogram.summary()
+        return summary
+
+    def print_summary(self) -> None:
+        """
+        Print the statistics of the latencies in milliseconds, the
+        parameters with the largest total time first
+        """
+        rows = [(name, operation, stats)
+                for name, operations in self.summary().items()
+                for operation, stats in operations.items()]
+        rows.sort(key=lambda row: -row[2]['total'])
+        print(f"{'parameter':<30} {'op':<4} {'count':>8} {'total':>10} "
+              f"{'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+        for name, operation, stats in rows:
+            print(f"{name:<30} {operation:<4} {stats['count']:>8} "
+                  f"{1e3 * stats['total']:>10.1f} "
+                  + ' '.join(f"{1e3 * stats[key]:>8.3f}"
+                             for key in ('p50', 'p95', 'p99', 'max')))
+
+    def dump(self, path: str) -> None:
+        """
+        Write the statistics of the latencies (in seconds) to a JSON file
+        """
+        with open(path, 'w') as file:
+            json.dump(self.summary(), file, indent=2)
+
+    def add_to_metadata(self, datasaver, tag: str = None) -> None:
+        """
+        Add the statistics of the latencies (in seconds) to the metadata of
+        the run of the given datasaver, as JSON
+        """
+        datasaver.dataset.add_metadata(tag or self.metadata_tag,
+                                       json.dumps(self.summary()))
+
+
+latency_recorder = LatencyRecorder()
+
+
+def instrument_latency(parameter: Parameter) -> None:
+    """
+    Make the `get` and `set` calls of the given parameter report their
+    latencies to `latency_recorder` when it is enabled. Instrumenting a
+    parameter again does nothing.
+    """
+    if getattr(parameter, '_latency_instrumented', False):
+        return
+
+    def instrument(operation: str, function):
+        @wraps(function)
+        def timed(*args, **kwargs):
+            if not latency_recorder.enabled:
+                return function(*args, **kwargs)
+            t_start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                latency_recorder.record(parameter, operation,
+                                        time.perf_counter() - t_start)
+        return timed
+
+    for operation in ('get', 'set'):
+        # `get` and `set` of gettable and settable parameters are wrapped
+        # functions that QCoDeS assigns to the instance
+        if operation in vars(parameter):
+            setattr(parameter, operation,
+                    instrument(operation, getattr(parameter, operation)))
+    parameter._latency_instrumented = True
+
+
+class SnapshotCache(threading.local):
+    """
+    Cache that is used while a snapshot is being taken (see
+    `v0_utils.snapshots.SnapshotStation`), so that every parameter is
+    queried at most once per snapshot.
+
+    The state of the cache is per thread: a session affects only the
+    parameters that are gotten in the thread that takes the snapshot.
+
+    Within a session, parameters that have been marked as refreshed are not
+    queried again: a `DelegateParameter` whose source has been refreshed
+    takes the latest value of the source instead of getting it. Optionally,
+    the snapshot of a source parameter that is shared by several
+    `DelegateParameter`s is included only in the snapshot of the first of
+    them, and the others refer to it by its full name.
+
+    Outside of a session the cache does nothing.
+    """
+
+    def __init__(self) -> None:
+        self.active = False
+        self.deduplicate = False
+        self._refreshed = set()
+        self._source_owners = {}
+
+    @contextmanager
+    def session(self, deduplicate: bool = True) -> Iterator[None]:
+        """
+        Context manager for taking one snapshot with the cache.
+
+        Args:
+            deduplicate
+                Whether to include the snapshot of a shared source parameter
+                only once
+        """
+        if self.active:
+            raise RuntimeError("A snapshot session is already active.")
+        self.active = True
+        self.deduplicate = deduplicate
+        try:
+            yield
+        finally:
+            self.active = False
+            self._refreshed.clear()
+            self._source_owners.clear()
+
+    def mark_refreshed(self, parameter: Parameter) -> None:
+        if self.active:
+            self._refreshed.add(id(parameter))
+
+    def is_refreshed(self, parameter: Parameter) -> bool:
+        return self.active and id(parameter) in self._refreshed
+
+    def source_snapshot(self, delegate: 'DelegateParameter',
+                        update: bool) -> Dict:
+        """
+        Snapshot of the source parameter of the given delegate, or a
+        reference to the delegate whose snapshot already includes it.
+        """
+        source = delegate.source
+        if self.active and self.deduplicate:
+            owner = self._source_owners.setdefault(id(source),
+                                                   delegate.full_name)
+            if owner != delegate.full_name:
+                return {'full_name': source.full_name,
+                        'included_in': owner}
+        update = update and not self.is_refreshed(source)
+        return source.snapshot(update=update)
+
+
+snapshot_cache = SnapshotCache()
 
 
 class DelegateParameter(Parameter):
@@ -163,7 +469,10 @@ class DelegateParameter(Parameter):
     done.
 
     Importantly enough, the metadata of the `DelegateParameter` includes
-    the metadata of the source parameter.
+    the metadata of the source parameter. While a snapshot is taken with
+    `snapshot_cache` active, a source that is shared by several delegates
+    is included only once (see `SnapshotCache`). The latencies of its `get`
+    and `set` calls are recorded by `latency_recorder` when it is enabled.
 
     The `DelegateParameter` attributes like unit and label will be the same
     as of the source parameter, unless explicitly specified.
@@ -198,12 +507,16 @@ class DelegateParameter(Parameter):
                            'parameter is supposed to be used.')
 
         super().__init__(name=name, *args, **kwargs)
+        instrument_latency(self)
 
     @property
     def source(self):
         return self._source_parameter
 
     def get_raw(self, *args, **kwargs):
+        if snapshot_cache.active and not args and not kwargs \
+                and snapshot_cache.is_refreshed(self.source):
+            return self.source.get_latest()
         return self.source.get(*args, **kwargs)
 
     def set_raw(self, *args, **kwargs):
@@ -217,6 +530,231 @@ class DelegateParameter(Parameter):
             params_to_skip_update=params_to_skip_update
         )
         snapshot.update(
-            {'source_parameter': self._source_parameter.snapshot(update=update)}
+            {'source_parameter': snapshot_cache.source_snapshot(self, update)}
         )
         return snapshot
+
+
+class BatchedReadGroup:
+    """
+    Group of parameters whose values are read from an instrument in a
+    single batched read, e.g. X, Y, R and theta of a lock-in with one
+    `SNAP?` query (see `sr86x_snap_read`) or the buffered readings of a
+    DMM.
+
+    The members of the group are `DelegateParameter`s of the source
+    parameters (see `add`) and parameters that are derived from the values
+    of the sources (see `add_derived`). The first get of a member performs
+    the batched read, and the other members are answered from its result.
+    A new read is performed when a member is gotten for the second time
+    since the last read, or after a set of one of the parameters that the
+    group is invalidated on (e.g. the parameter that is swept). Hence, in a
+    sweep, every point gets the values of all the members from one read.
+
+    The values of the read are also stored as the latest values of the
+    source parameters.
+
+    Example:
+        lockin_read = BatchedReadGroup(
+            'lockin1_read',
+            read=sr86x_snap_read(lockin1, 'X', 'Y'),
+            sources=[lockin1.X, lockin1.Y],
+            invalidate_on=[dc_setup.DC_didv_bias])
+        x = lockin_read.add('didv_x', lockin1.X)
+        y = lockin_read.add('didv_y', lockin1.Y)
+        g = lockin_read.add_derived(
+            'g_measurement', lambda x: x / v_ac, [lockin1.X],
+            unit='S')
+
+    Args:
+        name
+            Name of the group
+        read
+            Function without arguments that returns the values of the
+            source parameters, in the order of `sources`
+        sources
+            Source parameters of the values that `read` returns
+        invalidate_on
+            Parameters after a set of which the values are read again
+    """
+
+    def __init__(self,
+                 name: str,
+                 read: Callable[[], Sequence[Any]],
+                 sources: Sequence[Parameter],
+                 invalidate_on: Sequence[Parameter] = ()) -> None:
+        self.name = name
+        self.sources = list(sources)
+        self.parameters = OrderedDict()
+        self.n_reads = 0
+
+        self._read = read
+        self._lock = threading.RLock()
+        self._values = None
+        self._answered = set()
+
+        for parameter in invalidate_on:
+            self.invalidate_on(parameter)
+
+    def _index_of(self, source: Parameter) -> int:
+        for index, parameter in enumerate(self.sources):
+            if parameter is source:
+                return index
+        raise ValueError(f"Parameter {source.full_name} is not a source of "
+                         f"the group {self.name}.")
+
+    def add(self, name: str, source: Parameter,
+            **kwargs) -> 'GroupedDelegateParameter':
+        """
+        Add a `DelegateParameter` of one of the sources to the group.
+        Keyword arguments are passed to the `DelegateParameter`.
+        """
+        parameter = GroupedDelegateParameter(name, source, self, **kwargs)
+        self.parameters[name] = parameter
+        return parameter
+
+    def add_derived(self,
+                    name: str,
+                    function: Callable[..., Any],
+                    inputs: Sequence[Parameter],
+                    **kwargs) -> 'GroupedDerivedParameter':
+        """
+        Add a parameter whose value is computed by `function` from the
+        values of the given sources (passed in the order of `inputs`).
+        Keyword arguments are passed to the `Parameter`, e.g. `unit`.
+        """
+        parameter = GroupedDerivedParameter(name, function, inputs, self,
+                                            **kwargs)
+        self.parameters[name] = parameter
+        return parameter
+
+    def read(self) -> List[Any]:
+        """Perform the batched read and return the values of the sources"""
+        with self._lock:
+            values = list(self._read())
+            if len(values) != len(self.sources):
+                raise ValueError(f"The read of the group {self.name} "
+                                 f"returned {len(values)} values instead of "
+                                 f"{len(self.sources)}.")
+            for source, value in zip(self.sources, values):
+                source._save_val(value)
+            self._values = values
+            self._answered.clear()
+            self.n_reads += 1
+            return values
+
+    def invalidate(self) -> None:
+        """Make the next get of any member perform a new read"""
+        with self._lock:
+            self._values = None
+
+    def invalidate_on(self, parameter: Parameter) -> None:
+        """Invalidate the values of the group after every set of `parameter`"""
+        if 'set' not in vars(parameter):
+            raise ValueError(f"Parameter {parameter.full_name} cannot be "
+                             f"set.")
+        set_function = parameter.set
+
+        @wraps(set_function)
+        def set_and_invalidate(*args, **kwargs):
+            try:
+                return set_function(*args, **kwargs)
+            finally:
+                self.invalidate()
+
+        parameter.set = set_and_invalidate
+
+    def values_for(self, member: Parameter,
+                   sources: Sequence[Parameter]) -> List[Any]:
+        """
+        Values of the given sources for a get of the given member, from the
+        last read if it is still valid for that member
+        """
+        indices = [self._index_of(source) for source in sources]
+        with self._lock:
+            if self._values is None or id(member) in self._answered:
+                self.read()
+            self._answered.add(id(member))
+            return [self._values[index] for index in indices]
+
+
+class GroupedDelegateParameter(DelegateParameter):
+    """
+    `DelegateParameter` that is a member of a `BatchedReadGroup`: its value
+    comes from the batched read of the group. A set of this parameter sets
+    the source and invalidates the values of the group.
+    """
+
+    def __init__(self, name: str, source: Parameter,
+                 group: BatchedReadGroup, *args, **kwargs):
+        group._index_of(source)
+        self.group = group
+        super().__init__(name, source, *args, **kwargs)
+
+    def get_raw(self, *args, **kwargs):
+        if args or kwargs:
+            return super().get_raw(*args, **kwargs)
+        return self.group.values_for(self, [self.source])[0]
+
+    def set_raw(self, *args, **kwargs):
+        try:
+            super().set_raw(*args, **kwargs)
+        finally:
+            self.group.invalidate()
+
+
+class GroupedDerivedParameter(Parameter):
+    """
+    Parameter of a `BatchedReadGroup` whose value is computed from the
+    values of sources of the group, e.g. the conductance from the voltage
+    and the current.
+    """
+
+    def __init__(self, name: str,
+                 function: Callable[..., Any],
+                 inputs: Sequence[Parameter],
+                 group: BatchedReadGroup,
+                 **kwargs):
+        for source in inputs:
+            group._index_of(source)
+        self.function = function
+        self.inputs = list(inputs)
+        self.group = group
+        super().__init__(name, **kwargs)
+        instrument_latency(self)
+
+    def get_raw(self):
+        return self.function(*self.group.values_for(self, self.inputs))
+
+
+_SR86X_SNAP_CODES = {'X': 0, 'Y': 1, 'R': 2, 'P': 3}
+
+
+def sr86x_snap_read(lockin: Instrument,
+                    *names: str) -> Callable[[], List[float]]:
+    """
+    Batched read for a `BatchedReadGroup` of an SR86x lock-in: the values
+    of two or three of 'X', 'Y', 'R' and 'P' (theta) from one `SNAP?`
+    query, which samples them at the same time.
+
+    Args:
+        lockin
+            The lock-in amplifier
+        names
+            Names of the lock-in parameters to read, in the order of the
+            sources of the group
+    """
+    if not 2 <= len(names) <= 3:
+        raise ValueError(f"SNAP? reads two or three values, not "
+                         f"{len(names)}.")
+    unknown = [name for name in names if name not in _SR86X_SNAP_CODES]
+    if unknown:
+        raise ValueError(f"Unknown values {unknown}, should be some of "
+                         f"{list(_SR86X_SNAP_CODES)}.")
+    command = 'SNAP? ' + ','.join(str(_SR86X_SNAP_CODES[name])
+                                  for name in names)
+
+    def read() -> List[float]:
+        return [float(value) for value in lockin.ask(command).split(',')]
+
+    return read
@@ -1,5 +1,8 @@
+import time
+from typing import Callable, Dict, Hashable, Iterator, Optional, Tuple
+
 import numpy as np
-from qcodes.utils.validators import Numbers
+from qcodes.utils.validators import Enum, Numbers
 
 from .qcodes_tools import VirtualInstrument
 
@@ -9,6 +12,12 @@ class StaircaseRamp(VirtualInstrument):
     Encapsulates parameters of a staircase ramp of a parameter, assumes volts
     as the unit.
 
+    The setpoint vectors are built once per set of ramp settings and cached.
+    Setting any of the parameters that define the ramp drops the cache. The
+    vectors are returned as read-only views of the cached arrays, hence no
+    copying takes place when they are read repeatedly (for example, via a
+    `DelegateParameter` on every save of a hardware sweep point).
+
     Args:
         name
             Name of the staircase ramp instrument, useful for referring to in
@@ -20,12 +29,14 @@ class StaircaseRamp(VirtualInstrument):
                  **kwargs):
         super().__init__(name, **kwargs)
 
+        self._setpoints_cache = {}
+
         # Generic sweep definition parameters
         self.add_parameter(name='start_ramp_voltage',
                            label='Voltage at the ramp beginning',
                            unit='V',
                            get_cmd=None,
-                           set_cmd=None,
+                           set_cmd=self._drop_setpoints_cache,
                            get_parser=float,
                            initial_value=0,
                            vals=Numbers(),
@@ -37,7 +48,7 @@ class StaircaseRamp(VirtualInstrument):
                            label='Voltage at the ramp end',
                            unit='V',
                            get_cmd=None,
-                           set_cmd=None,
+                           set_cmd=self._drop_setpoints_cache,
                            get_parser=float,
                            initial_value=0,
                            vals=Numbers(),
@@ -49,7 +60,7 @@ class StaircaseRamp(VirtualInstrument):
                            label='Number of steps in staircase ramp',
                            unit='#',
                            get_cmd=None,
-                           set_cmd=None,
+                           set_cmd=self._drop_setpoints_cache,
                            get_parser=int,
                            initial_value=1,
                            vals=Numbers(min_value=1),
@@ -69,11 +80,43 @@ class StaircaseRamp(VirtualInstrument):
                                      "referred to in Measurement."
                            )
 
+    def _drop_setpoints_cache(self, *args) -> None:
+        """
+        Forget all the cached setpoint vectors. This is used as `set_cmd` of
+        the parameters that define the ramp, hence the (ignored) arguments.
+        """
+        self._setpoints_cache.clear()
+
+    def _get_cached_setpoints(self,
+                              key: Hashable,
+                              build: Callable[[], np.ndarray]
+                              ) -> np.ndarray:
+        """
+        Return a read-only view of the setpoint vector stored under the given
+        key, building (and caching) it first if it is not there yet.
+
+        Args:
+            key
+                Key of the setpoint vector in the cache
+            build
+                Function without arguments that builds the setpoint vector
+        """
+        try:
+            vector = self._setpoints_cache[key]
+        except KeyError:
+            vector = build()
+            vector.flags.writeable = False
+            self._setpoints_cache[key] = vector
+        return vector.view()
+
     def _get_staircase_values_vector(self):
-        return np.linspace(
-            self.start_ramp_voltage(),
-            self.finish_ramp_voltage(),
-            self.n_steps()
+        return self._get_cached_setpoints(
+            'values_vector',
+            lambda: np.linspace(
+                self.start_ramp_voltage(),
+                self.finish_ramp_voltage(),
+                self.n_steps()
+            )
         )
 
 
@@ -91,7 +134,7 @@ class RepeatingStaircaseRamp(StaircaseRamp):
                            label='Number of ramp repetitions',
                            unit='#',
                            get_cmd=None,
-                           set_cmd=None,
+                           set_cmd=self._drop_setpoints_cache,
                            get_parser=int,
                            initial_value=1,
                            vals=Numbers(min_value=1),
@@ -142,18 +185,362 @@ class RepeatingStaircaseRamp(StaircaseRamp):
                            )
 
     def _get_values_with_repetitions_vector(self):
-        values_with_repetitions_vector = \
-            np.tile(self.values_vector(), self.n_repetitions())
-        return values_with_repetitions_vector
+        return self._get_cached_setpoints(
+            'values_with_repetitions_vector',
+            lambda: np.tile(self.values_vector(), self.n_repetitions())
+        )
 
     def _get_all_repetitions_vector(self):
-        n_steps_grid, n_repetitions_grid = np.meshgrid(
-            np.arange(0, self.n_steps(), 1),
-            np.arange(0, self.n_repetitions(), 1),
-            indexing='xy'
+        return self._get_cached_setpoints(
+            'all_repetitions_vector',
+            lambda: np.repeat(np.arange(self.n_repetitions()),
+                              self.n_steps())
         )
-        all_repetitions_vector = np.reshape(n_repetitions_grid, -1)
-        return all_repetitions_vector
+
+    def iter_setpoint_chunks(self,
+                             chunk_size: int
+                             ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Iterate over the repeated staircase ramp in chunks, so that very
+        long repeated ramps do not need to be fully materialized in memory.
+
+        Concatenating all the chunks gives the `values_with_repetitions_vector`
+        and `all_repetitions_vector`.
+
+        Args:
+            chunk_size
+                Maximal number of points in one chunk
+
+        Yields:
+            Tuple of a chunk of values of the repeated staircase ramp, and
+            a chunk of the corresponding repetition indices
+        """
+        if chunk_size < 1:
+            raise ValueError(f"Chunk size should be a positive integer, "
+                             f"not {chunk_size}.")
+
+        values = self.values_vector()
+        n_steps = len(values)
+        n_all_steps = self.n_all_steps()
+
+        for chunk_start in range(0, n_all_steps, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, n_all_steps)
+            repetitions, steps = np.divmod(
+                np.arange(chunk_start, chunk_stop), n_steps)
+            yield values[steps], repetitions
 
     def _get_n_all_steps(self):
         return self.n_repetitions() * self.n_steps()
+
+
+class AdaptiveStaircaseRamp(StaircaseRamp):
+    """
+    Staircase ramp that refines itself where the measured signal changes.
+
+    The ramp starts as the uniform staircase of `n_steps` points between the
+    start and the finish voltages (the coarse grid). After the signal has
+    been measured at the points of `values_vector` and passed to
+    `add_measurements`, `values_vector` holds the next batch of points: the
+    midpoints of the intervals between measured points where the signal
+    changes most. This is repeated until the budget of points is used up,
+    or until all the intervals are narrower than `min_step`.
+
+    Example:
+        ramp.reset()
+        while not ramp.done:
+            setpoints = ramp.values_vector()
+            ramp.add_measurements(setpoints, measure(setpoints))
+        x, y = ramp.measured_setpoints(), ramp.measured_values()
+
+    or simply `ramp.run(measure)`, where `measure` is a function that
+    measures the signal for an array of setpoints (e.g. a hardware sweep
+    whose setpoints refer to `values_vector`).
+
+    Setting any of the parameters that define the coarse grid resets the
+    measurements; setting any of the parameters of the refinement makes
+    `values_vector` the next batch according to the new settings.
+
+    Args:
+        name
+            Name of the ramp instrument
+    """
+
+    def __init__(self,
+                 name: str,
+                 **kwargs):
+        self._measured_setpoints = np.empty(0)
+        self._measured_values = np.empty(0)
+
+        super().__init__(name, **kwargs)
+
+        self.add_parameter(name='max_n_points',
+                           label='Maximal number of points',
+                           unit='#',
+                           get_cmd=None,
+                           set_cmd=self._drop_next_setpoints,
+                           get_parser=int,
+                           initial_value=1000,
+                           vals=Numbers(min_value=1),
+                           docstring="Budget of points to measure, "
+                                     "including the coarse grid"
+                           )
+        self.add_parameter(name='n_points_per_refinement',
+                           label='Number of points per refinement',
+                           unit='#',
+                           get_cmd=None,
+                           set_cmd=self._drop_next_setpoints,
+                           get_parser=int,
+                           initial_value=10,
+                           vals=Numbers(min_value=1),
+                           docstring="Maximal number of points that are "
+                                     "added in one refinement"
+                           )
+        self.add_parameter(name='min_step',
+                           label='Minimal step',
+                           unit='V',
+                           get_cmd=None,
+                           set_cmd=self._drop_next_setpoints,
+                           get_parser=float,
+                           initial_value=0,
+                           vals=Numbers(min_value=0),
+                           docstring="Intervals between measured points "
+                                     "are not split further once they are "
+                                     "narrower than twice this step"
+                           )
+        self.add_parameter(name='criterion',
+                           label='Refinement criterion',
+                           get_cmd=None,
+                           set_cmd=self._drop_next_setpoints,
+                           initial_value='gradient',
+                           vals=Enum('gradient', 'curvature'),
+                           docstring="'gradient' refines intervals where "
+                                     "the signal changes most (largest "
+                                     "length of the normalized curve), "
+                                     "'curvature' refines intervals next to "
+                                     "points where the slope changes most"
+                           )
+
+        self.add_parameter(name='measured_setpoints',
+                           label='Voltage',
+                           unit='V',
+                           get_cmd=lambda: self._measured_setpoints.view(),
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Sorted setpoints of all the "
+                                     "measurements so far"
+                           )
+        self.add_parameter(name='measured_values',
+                           label='Signal',
+                           get_cmd=lambda: self._measured_values.view(),
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Measured values at "
+                                     "`measured_setpoints`"
+                           )
+
+    @property
+    def n_measured(self) -> int:
+        return len(self._measured_setpoints)
+
+    @property
+    def done(self) -> bool:
+        return len(self.values_vector()) == 0
+
+    def reset(self) -> None:
+        """
+        Forget all the measurements, so that `values_vector` is the coarse
+        grid again.
+        """
+        self._measured_setpoints = np.empty(0)
+        self._measured_values = np.empty(0)
+        self._setpoints_cache.clear()
+
+    def _drop_setpoints_cache(self, *args) -> None:
+        self.reset()
+
+    def _drop_next_setpoints(self, *args) -> None:
+        """
+        Forget the cached next batch of points, but keep the measurements.
+        This is used as `set_cmd` of the parameters of the refinement.
+        """
+        self._setpoints_cache.clear()
+
+    def add_measurements(self,
+                         setpoints: np.ndarray,
+                         values: np.ndarray) -> None:
+        """
+        Add measured values of the signal, after which `values_vector`
+        holds the next batch of points to measure.
+
+        Args:
+            setpoints
+                Setpoints at which the signal has been measured, usually
+                the last `values_vector`
+            values
+                Measured values of the signal at the setpoints
+        """
+        setpoints = np.asarray(setpoints, dtype=float).reshape(-1)
+        values = np.asarray(values, dtype=float).reshape(-1)
+        if setpoints.shape != values.shape:
+            raise ValueError("The number of setpoints and values should be "
+                             "the same.")
+
+        all_setpoints = np.concatenate((self._measured_setpoints, setpoints))
+        all_values = np.concatenate((self._measured_values, values))
+        order = np.argsort(all_setpoints, kind='mergesort')
+        self._measured_setpoints = all_setpoints[order]
+        self._measured_values = all_values[order]
+        self._setpoints_cache.clear()
+
+    def _get_staircase_values_vector(self):
+        if self.n_measured == 0:
+            return super()._get_staircase_values_vector()
+        return self._get_cached_setpoints('values_vector',
+                                          self._next_setpoints)
+
+    def _interval_losses(self) -> np.ndarray:
+        """
+        Compute how much each interval between neighbouring measured points
+        needs refinement, with the setpoints and the values normalized to
+        their ranges.
+        """
+        x = self._measured_setpoints
+        y = self._measured_values
+        x_range = abs(self.finish_ramp_voltage() - self.start_ramp_voltage())
+        y_range = np.ptp(y)
+        dx = np.diff(x) / (x_range or 1)
+        dy = np.diff(y) / (y_range or 1)
+
+        if self.criterion() == 'gradient':
+            return np.hypot(dx, dy)
+
+        # Area of the triangle that each point forms with its neighbours,
+        # which is zero where the signal is linear
+        areas = np.abs(dx[:-1] * dy[1:] - dx[1:] * dy[:-1]) / 2
+        point_losses = np.concatenate(([0], areas, [0]))
+        return np.maximum(point_losses[:-1], point_losses[1:])
+
+    def _next_setpoints(self) -> np.ndarray:
+        x = self._measured_setpoints
+        n_new = min(self.n_points_per_refinement(),
+                    self.max_n_points() - self.n_measured)
+        if n_new <= 0 or len(x) < 2:
+            return np.empty(0)
+
+        losses = self._interval_losses()
+        splittable = np.diff(x) >= max(2 * self.min_step(), 1e-12)
+        losses = np.where(splittable & np.isfinite(losses), losses, -1)
+        n_new = min(n_new, int(np.count_nonzero(losses >= 0)))
+        if n_new == 0:
+            return np.empty(0)
+
+        intervals = np.argpartition(-losses, n_new - 1)[:n_new]
+        intervals = np.sort(intervals)
+        return (x[intervals] + x[intervals + 1]) / 2
+
+    def run(self,
+            measure: Callable[[np.ndarray], np.ndarray],
+            max_duration: Optional[float] = None
+            ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Measure the coarse grid and refine it until the budget of points
+        (or of time) is used up.
+
+        Args:
+            measure
+                Function that measures the signal at an array of setpoints
+                and returns the array of values
+            max_duration
+                Time budget in seconds; no new batch is started after it is
+                exceeded
+
+        Returns:
+            Tuple of all the measured setpoints (sorted) and the values
+        """
+        self.reset()
+        t_start = time.perf_counter()
+        while not self.done:
+            if max_duration is not None \
+                    and time.perf_counter() - t_start > max_duration:
+                break
+            setpoints = self.values_vector()
+            self.add_measurements(setpoints, measure(setpoints))
+        return self.measured_setpoints(), self.measured_values()
+
+
+def _lorentzian_device(center: float,
+                       width: float
+                       ) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Simulated device whose conductance is a Lorentzian peak (e.g. a Coulomb
+    resonance) on top of a constant background.
+    """
+    def measure(setpoints):
+        return 0.1 + 1 / (1 + ((np.asarray(setpoints) - center)
+                               / width) ** 2)
+    return measure
+
+
+def _max_interpolation_error(x: np.ndarray,
+                             y: np.ndarray,
+                             measure: Callable[[np.ndarray], np.ndarray],
+                             start: float,
+                             finish: float) -> float:
+    dense = np.linspace(start, finish, 100001)
+    return float(np.max(np.abs(np.interp(dense, x, y) - measure(dense))))
+
+
+def benchmark_adaptive_ramp(tolerance: float = 0.01,
+                            center: float = 0.0123,
+                            width: float = 0.002,
+                            start: float = -0.5,
+                            finish: float = 0.5,
+                            criterion: str = 'gradient'
+                            ) -> Dict[str, int]:
+    """
+    Compare the number of points that a uniform and an adaptive staircase
+    ramp need to resolve a narrow peak of a simulated device: the signal
+    interpolated linearly between the measured points has to be within the
+    given tolerance of the true signal everywhere.
+
+    Returns:
+        Dictionary with the numbers of points of the 'uniform' and the
+        'adaptive' ramps
+    """
+    measure = _lorentzian_device(center, width)
+
+    def error(x, y):
+        return _max_interpolation_error(x, y, measure, start, finish)
+
+    # smallest uniform grid that resolves the peak, found by bisection
+    low, high = 2, 2
+    while True:
+        x = np.linspace(start, finish, high)
+        if error(x, measure(x)) <= tolerance:
+            break
+        low, high = high, 2 * high
+    while high - low > 1:
+        middle = (low + high) // 2
+        x = np.linspace(start, finish, middle)
+        if error(x, measure(x)) <= tolerance:
+            high = middle
+        else:
+            low = middle
+    n_uniform = high
+
+    ramp = AdaptiveStaircaseRamp('adaptive_benchmark_ramp')
+    ramp.start_ramp_voltage(start)
+    ramp.finish_ramp_voltage(finish)
+    ramp.n_steps(21)
+    ramp.max_n_points(n_uniform)
+    ramp.n_points_per_refinement(5)
+    ramp.criterion(criterion)
+    while not ramp.done:
+        setpoints = ramp.values_vector()
+        ramp.add_measurements(setpoints, measure(setpoints))
+        if error(ramp.measured_setpoints(), ramp.measured_values()) \
+                <= tolerance:
+            break
+    n_adaptive = ramp.n_measured
+
+    return {'uniform': n_uniform, 'adaptive': n_adaptive}
@@ -0,0 +1,247 @@
+"""
+This module contains the calibration for converting RF reflectometry
+magnitude into conductance.
+
+The calibration is built once from a calibration run where both the RF
+magnitude and the lock-in dI/dV have been measured: both are smoothed, the
+conductance is made monotonic in the RF magnitude, and the result is stored
+as a lookup table that converts whole arrays of RF data in one vectorized
+call. Tables built from runs are saved next to the database, keyed by the
+calibration run ID, so that later conversions reuse them.
+"""
+
+import os
+from typing import Optional, Union
+
+import numpy as np
+from qcodes.dataset.data_set import load_by_id
+
+from .gridded_data import load_gridded_run
+from .slicing import nearest_indices
+from .smoothing import smooth
+
+
+def monotonic_fit(x: np.ndarray,
+                  y: np.ndarray,
+                  increasing: Optional[bool] = None) -> np.ndarray:
+    """
+    Find the monotonic sequence that is closest (in the least-squares sense)
+    to `y` as a function of `x` (isotonic regression, computed with the
+    pool-adjacent-violators algorithm).
+
+    Args:
+        x
+            Values of the independent variable
+        y
+            Values to fit
+        increasing
+            Whether the fit should be increasing or decreasing; if None, the
+            direction is taken from the sign of the correlation of x and y
+
+    Returns:
+        Monotonic values, in the order of `x` sorted ascending
+    """
+    order = np.argsort(x, kind='mergesort')
+    y = np.asarray(y, dtype=float)[order]
+
+    if increasing is None:
+        increasing = np.corrcoef(np.asarray(x)[order], y)[0, 1] >= 0
+    if not increasing:
+        y = -y
+
+    # blocks of pooled values: their means, weights and lengths
+    means = []
+    weights = []
+    for value in y:
+        means.append(value)
+        weights.append(1)
+        while len(means) > 1 and means[-2] > means[-1]:
+            weight = weights[-2] + weights[-1]
+            mean = (means[-2] * weights[-2] + means[-1] * weights[-1]) / weight
+            del means[-1], weights[-1]
+            means[-1] = mean
+            weights[-1] = weight
+
+    fit = np.repeat(means, weights)
+    return fit if increasing else -fit
+
+
+class RFConductanceCalibration:
+    """
+    Conversion from RF magnitude to conductance.
+
+    Use `from_arrays` to build the calibration from measured RF magnitude and
+    dI/dV, or `from_run` to build it from (or load it for) a calibration run.
+
+    Args:
+        rf_table
+            Strictly increasing RF magnitude values of the lookup table
+        g_table
+            Monotonic conductance values corresponding to `rf_table`
+    """
+
+    def __init__(self, rf_table: np.ndarray, g_table: np.ndarray) -> None:
+        self.rf_table = np.asarray(rf_table, dtype=float)
+        self.g_table = np.asarray(g_table, dtype=float)
+
+        if self.rf_table.shape != self.g_table.shape \
+                or self.rf_table.ndim != 1:
+            raise ValueError("rf_table and g_table should be 1D arrays of "
+                             "the same length.")
+        if np.any(np.diff(self.rf_table) <= 0):
+            raise ValueError("rf_table should be strictly increasing.")
+
+    @classmethod
+    def from_arrays(cls,
+                    rf: np.ndarray,
+                    g: np.ndarray,
+                    window_size: int = 11,
+                    order: int = 1) -> 'RFConductanceCalibration':
+        """
+        Build the calibration from measured RF magnitude and conductance
+        (e.g. lock-in dI/dV) of a calibration sweep.
+
+        Both are smoothed with a Savitzky-Golay filter (see
+        `v0_utils.smoothing.smooth`), and the conductance is made monotonic
+        in the RF magnitude, so that the conversion is unambiguous.
+
+        Args:
+            rf
+                RF magnitude values
+            g
+                Conductance values
+            window_size
+                Window size of the smoothing filter; if 1, no smoothing is
+                done
+            order
+                Polynomial order of the smoothing filter
+        """
+        rf = np.asarray(rf, dtype=float).reshape(-1)
+        g = np.asarray(g, dtype=float).reshape(-1)
+        measured = np.isfinite(rf) & np.isfinite(g)
+        rf, g = rf[measured], g[measured]
+
+        if window_size > 1:
+            rf = smooth(rf, window_size, order)
+            g = smooth(g, window_size, order)
+
+        g_fit = monotonic_fit(rf, g)
+        rf_sorted = np.sort(rf, kind='mergesort')
+
+        # average conductance values of equal RF magnitudes
+        rf_table, first_indices, counts = np.unique(
+            rf_sorted, return_index=True, return_counts=True)
+        g_table = np.add.reduceat(g_fit, first_indices) / counts
+
+        return cls(rf_table, g_table)
+
+    @classmethod
+    def from_run(cls,
+                 run_id: int,
+                 rf_parameter: str,
+                 g_parameter: str,
+                 points: slice = slice(None),
+                 window_size: int = 11,
+                 order: int = 1,
+                 use_cache: bool = True) -> 'RFConductanceCalibration':
+        """
+        Build the calibration from a calibration run (see `from_arrays`), or
+        load it if it has already been built with the same arguments.
+
+        The calibration tables are stored in a "<database name>_rf_cal"
+        directory next to the database file.
+
+        Args:
+            run_id
+                ID of the calibration run in the database that QCoDeS refers
+                to
+            rf_parameter
+                Name of the RF magnitude parameter of the run
+            g_parameter
+                Name of the conductance parameter of the run
+            points
+                Slice of the points of the calibration sweep to use, e.g. to
+                select one monotonic branch of a bias sweep
+            window_size
+                Window size of the smoothing filter
+            order
+                Polynomial order of the smoothing filter
+            use_cache
+                Whether to load the calibration from, and save it to, disk
+        """
+        path = None
+        if use_cache:
+            path_to_db = load_by_id(run_id).path_to_db
+            path = _calibration_path(path_to_db, run_id, rf_parameter,
+                                     g_parameter, points, window_size, order)
+            if os.path.exists(path):
+                return cls.load(path)
+
+        gridded = load_gridded_run(run_id, [rf_parameter, g_parameter],
+                                   use_cache=False)
+        rf = np.asarray(gridded[rf_parameter].data).reshape(-1)[points]
+        g = np.asarray(gridded[g_parameter].data).reshape(-1)[points]
+        calibration = cls.from_arrays(rf, g, window_size, order)
+
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            calibration.save(path)
+        return calibration
+
+    def convert(self,
+                rf_data: Union[float, np.ndarray],
+                method: str = 'linear') -> np.ndarray:
+        """
+        Convert RF magnitude data of any shape into conductance.
+
+        Args:
+            rf_data
+                RF magnitude data
+            method
+                'linear' to interpolate linearly between the points of the
+                calibration table, or 'nearest' to take the conductance of
+                the nearest point (as the `convert_to_g` of the notebooks
+                does); data outside of the range of the calibration gets
+                the conductance of the nearest end of the table
+
+        Returns:
+            Conductance data of the same shape as `rf_data`
+        """
+        rf_data = np.asarray(rf_data, dtype=float)
+        if method == 'linear':
+            return np.interp(rf_data, self.rf_table, self.g_table)
+        elif method == 'nearest':
+            return self.g_table[nearest_indices(self.rf_table, rf_data)]
+        else:
+            raise ValueError(f"Unknown conversion method {method!r}, "
+                             f"should be 'linear' or 'nearest'.")
+
+    __call__ = convert
+
+    def save(self, path: str) -> None:
+        """
+        Save the calibration table to an `.npz` file.
+        """
+        np.savez(path, rf_table=self.rf_table, g_table=self.g_table)
+
+    @classmethod
+    def load(cls, path: str) -> 'RFConductanceCalibration':
+        """
+        Load the calibration table from an `.npz` file.
+        """
+        with np.load(path) as tables:
+            return cls(tables['rf_table'], tables['g_table'])
+
+
+def _calibration_path(path_to_db: str,
+                      run_id: int,
+                      rf_parameter: str,
+                      g_parameter: str,
+                      points: slice,
+                      window_size: int,
+                      order: int) -> str:
+    db_base = os.path.splitext(os.path.abspath(path_to_db))[0]
+    file_name = (f'run_{run_id}_{rf_parameter}_{g_parameter}'
+                 f'_{points.start}_{points.stop}_{points.step}'
+                 f'_sg{window_size}_{order}.npz')
+    return os.path.join(db_base + '_rf_cal', file_name)
@@ -0,0 +1,236 @@
+"""
+This module contains functions for cutting N-D gridded data (for example,
+as loaded by `v0_utils.gridded_data.load_gridded_run`) along its axes and
+along arbitrary straight lines and polylines.
+
+All the functions expect sorted axis vectors, and look up nearest indices
+with `np.searchsorted` in one batch call instead of looping over the
+requested values. They work on memory-mapped arrays: axis-aligned cuts are
+views, and line cuts read only the grid points that are needed.
+"""
+
+from typing import NamedTuple, Sequence, Tuple, Union
+
+import numpy as np
+
+
+class LineCut(NamedTuple):
+    """
+    Data along a line through two axes of a grid.
+
+    Attributes:
+        data
+            Values along the line; the first dimension runs over the points
+            of the line, and the rest are the remaining axes of the grid
+        coordinates
+            Coordinates of the points of the line, of shape (n_points, 2)
+        distance
+            Distance of the points from the start of the line, in the units
+            of the axes
+    """
+    data: np.ndarray
+    coordinates: np.ndarray
+    distance: np.ndarray
+
+
+def nearest_indices(axis: np.ndarray,
+                    values: Union[float, Sequence[float], np.ndarray]
+                    ) -> Union[int, np.ndarray]:
+    """
+    Find indices of the points of a sorted axis that are nearest to the
+    given values.
+
+    Args:
+        axis
+            Sorted (ascending) vector of axis values
+        values
+            A value or an array of values to look up
+
+    Returns:
+        Index (or array of indices of the same shape as `values`)
+    """
+    axis = np.asarray(axis)
+    values = np.asarray(values)
+
+    right = np.clip(np.searchsorted(axis, values), 1, len(axis) - 1)
+    left = right - 1
+    indices = np.where(values - axis[left] <= axis[right] - values,
+                       left, right)
+    if len(axis) == 1:
+        indices = np.zeros_like(indices)
+
+    if indices.ndim == 0:
+        return int(indices)
+    return indices
+
+
+def fractional_indices(axis: np.ndarray,
+                       values: Union[Sequence[float], np.ndarray]
+                       ) -> np.ndarray:
+    """
+    Convert values into (fractional) positions on a sorted axis, by linear
+    interpolation between the axis points. Values outside of the axis range
+    are clipped to the first or last index.
+    """
+    axis = np.asarray(axis)
+    return np.interp(values, axis, np.arange(len(axis), dtype=float))
+
+
+def cut_at(data: np.ndarray,
+           axes: Sequence[np.ndarray],
+           axis: int,
+           value: float) -> Tuple[np.ndarray, Tuple[np.ndarray, ...]]:
+    """
+    Take the slice of the data at the point of the given axis that is
+    nearest to the given value.
+
+    Args:
+        data
+            N-D gridded data
+        axes
+            Sorted axis vectors, one per (leading) dimension of the data
+        axis
+            Index of the axis to cut through
+        value
+            Value on the axis to cut at
+
+    Returns:
+        Tuple of the slice (a view of the data), and the axis vectors of the
+        remaining dimensions
+    """
+    index = nearest_indices(axes[axis], value)
+    selection = (slice(None),) * axis + (index,)
+    remaining_axes = tuple(axes[:axis]) + tuple(axes[axis + 1:])
+    return data[selection], remaining_axes
+
+
+def cuts_at(data: np.ndarray,
+            axes: Sequence[np.ndarray],
+            axis: int,
+            values: Union[Sequence[float], np.ndarray]
+            ) -> Tuple[np.ndarray, Tuple[np.ndarray, ...]]:
+    """
+    Take a stack of slices of the data at the points of the given axis that
+    are nearest to the given values.
+
+    Returns:
+        Tuple of the stack of slices (the first dimension runs over
+        `values`), and the axis vectors of the remaining dimensions
+    """
+    indices = nearest_indices(axes[axis], np.atleast_1d(values))
+    stack = np.moveaxis(data, axis, 0)[indices]
+    remaining_axes = tuple(axes[:axis]) + tuple(axes[axis + 1:])
+    return stack, remaining_axes
+
+
+def sample_polyline(vertices: Union[Sequence[Tuple[float, float]],
+                                    np.ndarray],
+                    n_points: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sample points evenly (by distance) along a polyline.
+
+    Args:
+        vertices
+            Coordinates of the vertices of the polyline, of shape
+            (n_vertices, 2); two vertices define a straight line
+        n_points
+            Number of points to sample, including both ends
+
+    Returns:
+        Tuple of the coordinates of the points, of shape (n_points, 2), and
+        their distance from the start of the polyline
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    if vertices.ndim != 2 or vertices.shape[0] < 2:
+        raise ValueError("At least two vertices of shape (2,) are needed "
+                         "to define a line.")
+
+    segment_lengths = np.hypot(*np.diff(vertices, axis=0).T)
+    vertex_distance = np.concatenate(([0], np.cumsum(segment_lengths)))
+    distance = np.linspace(0, vertex_distance[-1], n_points)
+
+    coordinates = np.stack([np.interp(distance, vertex_distance, vertex)
+                            for vertex in vertices.T], axis=-1)
+    return coordinates, distance
+
+
+def line_cut(data: np.ndarray,
+             axes: Sequence[np.ndarray],
+             line_axes: Tuple[int, int],
+             vertices: Union[Sequence[Tuple[float, float]], np.ndarray],
+             n_points: int,
+             interpolate: bool = False) -> LineCut:
+    """
+    Cut the data along a straight line or a polyline through two of its axes,
+    for example, along a "chemical potential" line across plunger and cutter
+    gate voltages.
+
+    Args:
+        data
+            N-D gridded data
+        axes
+            Sorted axis vectors, one per (leading) dimension of the data
+        line_axes
+            Indices of the two axes that the line goes through; the
+            coordinates of the vertices are given in this order
+        vertices
+            Coordinates of the vertices of the line, of shape (n_vertices, 2)
+        n_points
+            Number of points along the line
+        interpolate
+            If False, the value of the nearest grid point is taken for each
+            point of the line; if True, the values are linearly interpolated
+            between the four surrounding grid points
+
+    Returns:
+        The line cut
+    """
+    axis_a, axis_b = line_axes
+    coordinates, distance = sample_polyline(vertices, n_points)
+    moved = np.moveaxis(data, (axis_a, axis_b), (0, 1))
+
+    if not interpolate:
+        index_a = nearest_indices(axes[axis_a], coordinates[:, 0])
+        index_b = nearest_indices(axes[axis_b], coordinates[:, 1])
+        return LineCut(moved[index_a, index_b], coordinates, distance)
+
+    position_a = fractional_indices(axes[axis_a], coordinates[:, 0])
+    position_b = fractional_indices(axes[axis_b], coordinates[:, 1])
+
+    low_a = np.minimum(np.floor(position_a).astype(int), moved.shape[0] - 2)
+    low_b = np.minimum(np.floor(position_b).astype(int), moved.shape[1] - 2)
+    low_a = np.maximum(low_a, 0)
+    low_b = np.maximum(low_b, 0)
+    high_a = np.minimum(low_a + 1, moved.shape[0] - 1)
+    high_b = np.minimum(low_b + 1, moved.shape[1] - 1)
+
+    trailing = (slice(None),) + (np.newaxis,) * (moved.ndim - 2)
+    weight_a = (position_a - low_a)[trailing]
+    weight_b = (position_b - low_b)[trailing]
+
+    values = (moved[low_a, low_b] * (1 - weight_a) * (1 - weight_b)
+              + moved[high_a, low_b] * weight_a * (1 - weight_b)
+              + moved[low_a, high_b] * (1 - weight_a) * weight_b
+              + moved[high_a, high_b] * weight_a * weight_b)
+    return LineCut(values, coordinates, distance)
+
+
+def line_cuts(data: np.ndarray,
+              axes: Sequence[np.ndarray],
+              line_axes: Tuple[int, int],
+              lines: Sequence[Union[Sequence[Tuple[float, float]],
+                                    np.ndarray]],
+              n_points: int,
+              interpolate: bool = False) -> np.ndarray:
+    """
+    Cut the data along several lines through the same two axes (see
+    `line_cut`), and return the cuts as a stack, e.g. a stack of 2D slices
+    for 3D data.
+
+    Returns:
+        Array where the first dimension runs over the lines, the second over
+        the points along each line, and the rest are the remaining axes
+    """
+    return np.stack([line_cut(data, axes, line_axes, vertices, n_points,
+                              interpolate=interpolate).data
+                     for vertices in lines])
@@ -0,0 +1,91 @@
+"""
+This module contains smoothing and differentiation filters for measured
+data.
+"""
+
+from math import factorial
+
+import numpy as np
+
+
+def savitzky_golay_coefficients(window_size: int,
+                                order: int,
+                                deriv: int = 0,
+                                rate: float = 1) -> np.ndarray:
+    """
+    Compute the convolution coefficients of a Savitzky-Golay filter.
+
+    Args:
+        window_size
+            Length of the filter window, a positive odd number
+        order
+            Order of the polynomial that is fitted within the window
+        deriv
+            Order of the derivative to compute (0 means only smoothing)
+        rate
+            Sampling rate (inverse of the spacing between the points), used
+            to scale the derivative
+    """
+    window_size = abs(int(window_size))
+    order = abs(int(order))
+    if window_size % 2 != 1 or window_size < 1:
+        raise ValueError("window_size size must be a positive odd number")
+    if window_size < order + 2:
+        raise ValueError("window_size is too small for the polynomials order")
+
+    half_window = (window_size - 1) // 2
+    offsets = np.arange(-half_window, half_window + 1)
+    b = offsets[:, np.newaxis] ** np.arange(order + 1)
+    return np.linalg.pinv(b)[deriv] * rate ** deriv * factorial(deriv)
+
+
+def smooth(y: np.ndarray,
+           window_size: int,
+           order: int,
+           deriv: int = 0,
+           rate: float = 1,
+           axis: int = -1) -> np.ndarray:
+    """
+    Smooth (and possibly differentiate) data with a Savitzky-Golay filter
+    along the given axis.
+
+    The signal is padded at the extremes with values taken from the signal
+    itself (mirrored around the end points), so that the result has the same
+    shape as the input. For 1D data this is the same as the `smooth`
+    function that is used in the analysis notebooks, but it works on N-D
+    arrays without looping over the other axes.
+
+    Args:
+        y
+            Data to smooth
+        window_size
+            Length of the filter window, a positive odd number
+        order
+            Order of the polynomial that is fitted within the window
+        deriv
+            Order of the derivative to compute (0 means only smoothing)
+        rate
+            Sampling rate (inverse of the spacing between the points), used
+            to scale the derivative
+        axis
+            Axis along which to filter
+
+    Returns:
+        Filtered data of the same shape as `y`
+    """
+    coefficients = savitzky_golay_coefficients(window_size, order, deriv,
+                                               rate)
+    half_window = (len(coefficients) - 1) // 2
+
+    y = np.moveaxis(np.asarray(y, dtype=float), axis, -1)
+    first = y[..., :1]
+    last = y[..., -1:]
+    first_values = first - np.abs(y[..., half_window:0:-1] - first)
+    last_values = last + np.abs(y[..., -2:-half_window - 2:-1] - last)
+    padded = np.concatenate((first_values, y, last_values), axis=-1)
+
+    n_points = y.shape[-1]
+    filtered = np.zeros_like(y)
+    for k, coefficient in enumerate(coefficients):
+        filtered += coefficient * padded[..., k:k + n_points]
+    return np.moveaxis(filtered, -1, axis)
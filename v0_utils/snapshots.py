@@ -0,0 +1,275 @@
+"""
+This module contains a station that takes snapshots faster and smaller than
+`qcodes.Station`, and functions to store snapshots as differences against
+the snapshot of the previous run.
+
+`Measurement` saves the snapshot of the station with every run. With
+`SnapshotStation`, every parameter is queried at most once per snapshot
+(and not at all if its value has been read within a staleness window), the
+snapshots of source parameters shared by several `DelegateParameter`s are
+included once, and optionally only the difference against the previous
+snapshot is stored. `load_station_snapshot` restores the full snapshot of a
+run in any case.
+"""
+
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import qcodes
+from qcodes import Instrument, Parameter
+from qcodes.dataset.data_set import load_by_id
+from qcodes.dataset.sqlite_base import connect
+
+from .qcodes_tools import DelegateParameter, snapshot_cache
+
+log = logging.getLogger(__name__)
+
+DIFF_KEY = 'diff_against_run_id'
+_REMOVED = {'__removed_from_snapshot__': True}
+
+
+def snapshot_diff(old: Dict, new: Dict) -> Dict:
+    """
+    Difference between two snapshots: the nested dictionary of the entries
+    of `new` that are not in `old` or that have changed, with entries of
+    `old` that are not in `new` marked as removed.
+    """
+    diff = {}
+    for key, value in new.items():
+        if key not in old:
+            diff[key] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            nested_diff = snapshot_diff(old[key], value)
+            if nested_diff:
+                diff[key] = nested_diff
+        elif value != old[key]:
+            diff[key] = value
+    for key in old:
+        if key not in new:
+            diff[key] = _REMOVED
+    return diff
+
+
+def apply_snapshot_diff(old: Dict, diff: Dict) -> Dict:
+    """
+    Restore a snapshot from the snapshot that a difference (see
+    `snapshot_diff`) has been taken against, and the difference.
+    """
+    new = dict(old)
+    for key, value in diff.items():
+        if value == _REMOVED:
+            new.pop(key, None)
+        elif isinstance(value, dict) and isinstance(new.get(key), dict):
+            new[key] = apply_snapshot_diff(new[key], value)
+        else:
+            new[key] = value
+    return new
+
+
+def _snapshot_hash(snapshot: Dict) -> str:
+    return hashlib.sha1(
+        json.dumps(snapshot, sort_keys=True).encode()).hexdigest()
+
+
+def _latest_run() -> Tuple[Optional[int], bool]:
+    """
+    ID of the latest run in the database that QCoDeS refers to (None if
+    there are no runs), and whether a snapshot has been stored with it
+    """
+    connection = connect(qcodes.config.core.db_location)
+    try:
+        cursor = connection.execute(
+            'SELECT * FROM runs ORDER BY run_id DESC LIMIT 1')
+        row = cursor.fetchone()
+        if row is None:
+            return None, False
+        columns = [column[0] for column in cursor.description]
+        has_snapshot = 'snapshot' in columns \
+            and row[columns.index('snapshot')] is not None
+        return row[columns.index('run_id')], has_snapshot
+    finally:
+        connection.close()
+
+
+def _iter_parameters(component: Any) -> Iterator[Parameter]:
+    """
+    Iterate over the parameters of an instrument, its submodules and
+    channels, or over the parameter itself if the component is one.
+    """
+    if isinstance(component, Parameter):
+        yield component
+        return
+    yield from getattr(component, 'parameters', {}).values()
+    for submodule in getattr(component, 'submodules', {}).values():
+        yield from _iter_parameters(submodule)
+    for channel in getattr(component, '_channels', ()):
+        yield from _iter_parameters(channel)
+
+
+class SnapshotStation(qcodes.Station):
+    """
+    Station whose snapshots (e.g. those saved by `Measurement` with every
+    run) query each parameter at most once, reuse values that have been
+    read recently, and can be stored as differences.
+
+    When a snapshot is taken, the gettable parameters of all the components
+    are refreshed first (unless their value is younger than `max_age`), and
+    the snapshot is then built from the values in memory. The time this
+    takes per component is available in `snapshot_timings`.
+
+    Args:
+        components
+            Components of the station, as for `qcodes.Station`
+        update
+            Whether the snapshots refresh the values of the parameters even
+            if they are requested without update (which is what
+            `Measurement` does)
+        max_age
+            Values that have been read (or set) less than this number of
+            seconds ago are not read again
+        deduplicate
+            Whether to include the snapshot of a source parameter shared by
+            several `DelegateParameter`s only once
+        diff_mode
+            If True, the snapshot of a run stores only the difference
+            against the snapshot of the previous run of this station, and
+            the ID of that run; snapshots that are not taken for a new run
+            are always full
+        full_snapshot_every
+            In the diff mode, every this many snapshots a full snapshot is
+            stored, so that restoring a snapshot does not need to go through
+            a long chain of runs
+    """
+
+    def __init__(self,
+                 *components,
+                 update: bool = True,
+                 max_age: float = 0.,
+                 deduplicate: bool = True,
+                 diff_mode: bool = False,
+                 full_snapshot_every: int = 10,
+                 **kwargs) -> None:
+        self.update = update
+        self.max_age = max_age
+        self.deduplicate = deduplicate
+        self.diff_mode = diff_mode
+        self.full_snapshot_every = full_snapshot_every
+        self.snapshot_timings = OrderedDict()
+
+        self._previous_snapshot = None
+        self._previous_run_id = None
+        self._n_diffs = 0
+
+        super().__init__(*components, **kwargs)
+
+    def _refresh(self, parameter: Parameter, now: datetime) -> None:
+        if snapshot_cache.is_refreshed(parameter):
+            return
+        if isinstance(parameter, DelegateParameter):
+            # the delegate takes the value of the refreshed source
+            self._refresh(parameter.source, now)
+            is_fresh = False
+        else:
+            timestamp = parameter._latest.get('ts')
+            is_fresh = isinstance(timestamp, datetime) \
+                and (now - timestamp).total_seconds() <= self.max_age
+
+        if not is_fresh and hasattr(parameter, 'get') \
+                and parameter._snapshot_get and parameter._snapshot_value:
+            try:
+                parameter.get()
+            except Exception:
+                log.warning(f"Snapshot: Could not update parameter: "
+                            f"{parameter.full_name}")
+        snapshot_cache.mark_refreshed(parameter)
+
+    def _full_snapshot(self, update: bool) -> Dict:
+        snapshot = {'instruments': {},
+                    'parameters': {},
+                    'components': {},
+                    'default_measurement': [
+                        action.snapshot(update=False)
+                        if hasattr(action, 'snapshot') else repr(action)
+                        for action in self.default_measurement]}
+        self.snapshot_timings.clear()
+
+        with snapshot_cache.session(self.deduplicate):
+            now = datetime.now()
+            for name, component in self.components.items():
+                t_start = time.perf_counter()
+                if update:
+                    for parameter in _iter_parameters(component):
+                        self._refresh(parameter, now)
+
+                if isinstance(component, Instrument):
+                    group = 'instruments'
+                elif isinstance(component, Parameter):
+                    group = 'parameters'
+                else:
+                    group = 'components'
+                snapshot[group][name] = component.snapshot(update=False)
+                self.snapshot_timings[name] = time.perf_counter() - t_start
+
+        # round trip through JSON, so that the snapshot is the same as the
+        # one loaded from the database
+        return json.loads(json.dumps(snapshot))
+
+    def snapshot_base(self,
+                      update: bool = False,
+                      params_to_skip_update=None) -> Dict:
+        snapshot = self._full_snapshot(update or self.update)
+        if not self.diff_mode:
+            return snapshot
+
+        # `Measurement` creates the run before it takes the snapshot and
+        # stores the snapshot afterwards; any other snapshot (e.g. one taken
+        # by hand between runs) is not stored with a run, hence it is not
+        # used as the base of the differences
+        run_id, has_snapshot = _latest_run()
+        if run_id is None or run_id == self._previous_run_id \
+                or has_snapshot:
+            return snapshot
+
+        previous_snapshot = self._previous_snapshot
+        previous_run_id = self._previous_run_id
+        self._previous_snapshot = snapshot
+        self._previous_run_id = run_id
+
+        if previous_snapshot is None \
+                or self._n_diffs >= self.full_snapshot_every - 1:
+            self._n_diffs = 0
+            return snapshot
+        self._n_diffs += 1
+        return {DIFF_KEY: previous_run_id,
+                'base_hash': _snapshot_hash(previous_snapshot),
+                'diff': snapshot_diff(previous_snapshot, snapshot)}
+
+    def print_snapshot_timings(self) -> None:
+        for name, duration in sorted(self.snapshot_timings.items(),
+                                     key=lambda item: -item[1]):
+            print(f"{name}: {1e3 * duration:.1f} ms")
+
+
+def load_station_snapshot(run_id: int) -> Dict:
+    """
+    Load the snapshot of the station of a run from the database that QCoDeS
+    refers to, restoring it from the snapshots of previous runs if it has
+    been stored as a difference (see `SnapshotStation`).
+    """
+    dataset = load_by_id(run_id)
+    snapshot = json.loads(dataset.get_metadata('snapshot'))['station']
+    if DIFF_KEY not in snapshot:
+        return snapshot
+
+    base = load_station_snapshot(snapshot[DIFF_KEY])
+    if _snapshot_hash(base) != snapshot['base_hash']:
+        raise ValueError(f"The snapshot of run {run_id} is stored as a "
+                         f"difference against the one of run "
+                         f"{snapshot[DIFF_KEY]}, but that snapshot does "
+                         f"not match.")
+    return apply_snapshot_diff(base, snapshot['diff'])
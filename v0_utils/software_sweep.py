@@ -0,0 +1,249 @@
+"""
+This module contains a runner for software sweeps, where a parameter is set
+point by point and, after each set, parameters of several instruments are
+read at the same time.
+
+The readout parameters are grouped by the physical instrument they are read
+from. Parameters of the same instrument are read one after another, while
+different instruments are read concurrently on a pool of threads, so the
+time per point is that of the slowest instrument instead of the sum of all
+the reads.
+"""
+
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+from qcodes import Parameter
+
+from .qcodes_tools import DelegateParameter
+
+
+# attributes of parameters that convert the value of another parameter,
+# e.g. `src_param` of the `ConversionParameter`s of the measurement notebooks
+SOURCE_ATTRIBUTES = ('src_param',)
+
+
+def _source_of(parameter: Parameter) -> Optional[Parameter]:
+    if isinstance(parameter, DelegateParameter):
+        return parameter.source
+    for attribute in SOURCE_ATTRIBUTES:
+        source = getattr(parameter, attribute, None)
+        if isinstance(source, Parameter):
+            return source
+    return None
+
+
+def physical_instrument_name(parameter: Parameter) -> str:
+    """
+    Find the name of the physical instrument that the parameter is read
+    from, following the sources of `DelegateParameter`s and of parameters
+    that convert another parameter (see `SOURCE_ATTRIBUTES`), and the
+    parents of instrument channels. If the parameter is not attached to an
+    instrument, the name of the parameter itself is returned.
+    """
+    visited = set()
+    source = _source_of(parameter)
+    while source is not None and id(parameter) not in visited:
+        visited.add(id(parameter))
+        parameter = source
+        source = _source_of(parameter)
+
+    instrument = getattr(parameter, '_instrument', None)
+    if instrument is None:
+        return parameter.name
+    while getattr(instrument, '_parent', None) is not None:
+        instrument = instrument._parent
+    return instrument.name
+
+
+def group_by_instrument(parameters: Sequence[Parameter]
+                        ) -> Dict[str, List[Parameter]]:
+    """
+    Group parameters by the physical instrument they are read from (see
+    `physical_instrument_name`), keeping the order of the parameters.
+    """
+    groups = OrderedDict()
+    for parameter in parameters:
+        groups.setdefault(physical_instrument_name(parameter),
+                          []).append(parameter)
+    return groups
+
+
+class SweepReport(NamedTuple):
+    """
+    Timing of a software sweep: the number of points, the total duration,
+    and the mean durations per point in seconds of setting the setter, of
+    the settling, of reading all the instruments, and of reading each
+    instrument.
+    """
+    n_points: int
+    duration: float
+    set_time: float
+    settle_time: float
+    read_time: float
+    instrument_read_times: Dict[str, float]
+
+    @property
+    def points_per_second(self) -> float:
+        return self.n_points / self.duration if self.duration else 0.
+
+    def __str__(self) -> str:
+        lines = [f"{self.n_points} points in {self.duration:.2f} s "
+                 f"({self.points_per_second:.2f} points/s)",
+                 f"  set:    {1e3 * self.set_time:8.2f} ms/point",
+                 f"  settle: {1e3 * self.settle_time:8.2f} ms/point",
+                 f"  read:   {1e3 * self.read_time:8.2f} ms/point"]
+        width = max(map(len, self.instrument_read_times), default=0) + 1
+        lines += [f"    {name + ':':{width}} {1e3 * read_time:8.2f} ms/point"
+                  for name, read_time in self.instrument_read_times.items()]
+        return '\n'.join(lines)
+
+
+class SoftwareSweep:
+    """
+    Software sweep of one parameter with concurrent readout of several
+    instruments.
+
+    Example:
+        sweep = SoftwareSweep(dc_setup.DC_didv_bias,
+                              [dc_setup.i_measurement,
+                               dc_setup.v_measurement,
+                               dc_setup.g_measurement],
+                              settle_time=0.01)
+
+        meas = Measurement(exp=exp)
+        sweep.register_parameters(meas)
+        with meas.run() as datasaver:
+            report = sweep.run(np.linspace(-1e-3, 1e-3, 101), datasaver)
+        print(report)
+
+    Here the readouts are grouped by the DMMs and the lock-in that their
+    `src_param`s belong to. The grouping can also be given explicitly:
+
+        sweep = SoftwareSweep(dc_setup.DC_didv_bias,
+                              {'DMM1': [dc_setup.i_measurement],
+                               'DMM2': [dc_setup.v_measurement],
+                               'lockin1': [dc_setup.g_measurement]},
+                              settle_time=0.01)
+
+    Args:
+        setter
+            Parameter to sweep
+        readouts
+            Parameters to read after each set; either a sequence of
+            parameters, which are grouped by physical instrument with
+            `group_by_instrument`, or a mapping from instrument names to
+            the parameters that are read from that instrument
+        settle_time
+            Time to wait after each set before reading, in seconds
+        first_settle_time
+            Time to wait after setting the first point, e.g. to let the
+            setup settle after a big jump; by default, `settle_time`
+        max_workers
+            Number of threads for the readout; by default, one per
+            instrument
+    """
+
+    def __init__(self,
+                 setter: Parameter,
+                 readouts,
+                 settle_time: float = 0.,
+                 first_settle_time: Optional[float] = None,
+                 max_workers: Optional[int] = None) -> None:
+        self.setter = setter
+        if isinstance(readouts, dict):
+            self.groups = OrderedDict(
+                (name, list(parameters))
+                for name, parameters in readouts.items())
+        else:
+            self.groups = group_by_instrument(readouts)
+        self.settle_time = settle_time
+        self.first_settle_time = settle_time if first_settle_time is None \
+            else first_settle_time
+        self.max_workers = max_workers or len(self.groups)
+
+    @property
+    def readouts(self) -> List[Parameter]:
+        return [parameter for parameters in self.groups.values()
+                for parameter in parameters]
+
+    def register_parameters(self, measurement) -> None:
+        """
+        Register the setter and the readout parameters (with the setter as
+        setpoints) in the given `Measurement`.
+        """
+        measurement.register_parameter(self.setter)
+        for parameter in self.readouts:
+            measurement.register_parameter(parameter,
+                                           setpoints=[self.setter])
+
+    @staticmethod
+    def _read_group(parameters: Sequence[Parameter]):
+        t_start = time.perf_counter()
+        values = [parameter.get() for parameter in parameters]
+        return values, time.perf_counter() - t_start
+
+    def run(self, values: Sequence[float], datasaver) -> SweepReport:
+        """
+        Sweep the setter over the given values, and add a row with the
+        setpoint and all the readout values to the datasaver for each of
+        them.
+
+        Args:
+            values
+                Values of the setter
+            datasaver
+                DataSaver of a running measurement whose parameters have
+                been registered with `register_parameters`
+
+        Returns:
+            The timing report of the sweep
+        """
+        n_points = len(values)
+        groups = list(self.groups.items())
+        set_times = np.zeros(n_points)
+        settle_times = np.zeros(n_points)
+        read_times = np.zeros(n_points)
+        group_read_times = np.zeros((len(groups), n_points))
+
+        t_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for i, value in enumerate(values):
+                t_set = time.perf_counter()
+                self.setter.set(value)
+                t_settle = time.perf_counter()
+                time.sleep(self.first_settle_time if i == 0
+                           else self.settle_time)
+                t_read = time.perf_counter()
+
+                futures = [executor.submit(self._read_group, parameters)
+                           for _, parameters in groups]
+                row = [(self.setter, value)]
+                for j, ((_, parameters), future) in enumerate(
+                        zip(groups, futures)):
+                    group_values, group_read_times[j, i] = future.result()
+                    row += list(zip(parameters, group_values))
+                t_done = time.perf_counter()
+
+                datasaver.add_result(*row)
+
+                set_times[i] = t_settle - t_set
+                settle_times[i] = t_read - t_settle
+                read_times[i] = t_done - t_read
+        duration = time.perf_counter() - t_start
+
+        def mean(times):
+            return float(np.mean(times)) if n_points else 0.
+
+        return SweepReport(
+            n_points=n_points,
+            duration=duration,
+            set_time=mean(set_times),
+            settle_time=mean(settle_times),
+            read_time=mean(read_times),
+            instrument_read_times=OrderedDict(
+                (name, mean(group_read_times[j]))
+                for j, (name, _) in enumerate(groups)))
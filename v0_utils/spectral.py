@@ -0,0 +1,206 @@
+"""
+This module contains a streaming estimator of power spectral density for
+noise measurements with a scope, an Alazar digitizer or a lock-in buffer.
+"""
+
+from typing import Callable
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+class StreamingWelchPSD:
+    """
+    Welch's estimate of the power spectral density that is updated trace by
+    trace.
+
+    Each trace is split into (overlapping) segments, each segment is
+    windowed and Fourier transformed, and the periodograms are added to a
+    running sum. Only the running sum is kept in memory, hence any number of
+    samples can be averaged. The segments of a trace are processed in blocks
+    of at most `block_size` segments in preallocated buffers.
+
+    The result is available as a one-sided power spectral density (`psd`),
+    or as the amplitude spectral density (`asd`) divided by the gain of the
+    amplifier, which for a trans-impedance amplifier gives the current noise
+    in A/sqrt(Hz).
+
+    Args:
+        sample_rate
+            Sample rate of the traces in Hz
+        segment_length
+            Number of samples in a segment, which sets the frequency
+            resolution to `sample_rate / segment_length`
+        overlap
+            Fraction of a segment that overlaps with the next one
+        window
+            Name of a numpy window function ('hanning', 'hamming',
+            'blackman', 'bartlett'), or 'boxcar' for no windowing
+        detrend
+            Whether to subtract the mean of each segment
+        gain
+            Gain of the amplifier in front of the digitizer, e.g. in V/A for
+            a trans-impedance amplifier; `asd` is divided by it
+        contiguous
+            If True, consecutive traces are treated as one continuous
+            signal, so that segments may span the boundary between traces
+            (e.g. for consecutive chunks of a lock-in buffer); if False,
+            every trace is segmented on its own and the samples at its end
+            that do not fill a segment are dropped (e.g. for separate scope
+            captures)
+        block_size
+            Maximal number of segments that are transformed at once
+    """
+
+    def __init__(self,
+                 sample_rate: float,
+                 segment_length: int,
+                 overlap: float = 0.5,
+                 window: str = 'hanning',
+                 detrend: bool = True,
+                 gain: float = 1.,
+                 contiguous: bool = False,
+                 block_size: int = 256) -> None:
+        if not 0 <= overlap < 1:
+            raise ValueError(f"Overlap should be in [0, 1), not {overlap}.")
+
+        self.sample_rate = sample_rate
+        self.segment_length = segment_length
+        self.step = max(1, int(round(segment_length * (1 - overlap))))
+        self.detrend = detrend
+        self.gain = gain
+        self.contiguous = contiguous
+        self.block_size = block_size
+
+        if window == 'boxcar':
+            self.window = np.ones(segment_length)
+        else:
+            # periodic window, as used for spectral analysis
+            self.window = getattr(np, window)(segment_length + 1)[:-1]
+        self._scale = 1 / (sample_rate * np.sum(self.window ** 2))
+
+        self._sum = np.zeros(segment_length // 2 + 1)
+        self._block = np.empty((block_size, segment_length))
+        self._carry = np.empty(2 * segment_length)
+        self._n_carry = 0
+        self.n_segments = 0
+        self.n_samples = 0
+
+    @property
+    def frequencies(self) -> np.ndarray:
+        return np.fft.rfftfreq(self.segment_length, 1 / self.sample_rate)
+
+    @property
+    def psd(self) -> np.ndarray:
+        """
+        One-sided power spectral density of the signal, in units of the
+        signal squared per Hz
+        """
+        if self.n_segments == 0:
+            raise RuntimeError("No segments have been added yet.")
+        psd = self._sum * self._scale / self.n_segments
+        psd[1:] *= 2
+        if self.segment_length % 2 == 0:
+            psd[-1] /= 2  # the Nyquist frequency bin is not doubled
+        return psd
+
+    @property
+    def asd(self) -> np.ndarray:
+        """
+        Amplitude spectral density divided by the gain, e.g. in A/sqrt(Hz)
+        for a trans-impedance amplifier with the gain given in V/A
+        """
+        return np.sqrt(self.psd) / self.gain
+
+    def reset(self) -> None:
+        self._sum[:] = 0
+        self._n_carry = 0
+        self.n_segments = 0
+        self.n_samples = 0
+
+    def _add_segments(self, samples: np.ndarray) -> int:
+        """
+        Add all the full segments of the given samples to the running sum,
+        and return the number of samples that have been consumed.
+        """
+        n_segments = max(0, (len(samples) - self.segment_length)
+                         // self.step + 1)
+        if n_segments == 0:
+            return 0
+
+        stride = samples.strides[0]
+        segments = as_strided(samples,
+                              shape=(n_segments, self.segment_length),
+                              strides=(self.step * stride, stride),
+                              writeable=False)
+
+        for start in range(0, n_segments, self.block_size):
+            stop = min(start + self.block_size, n_segments)
+            block = self._block[:stop - start]
+            block[:] = segments[start:stop]
+            if self.detrend:
+                block -= block.mean(axis=1, keepdims=True)
+            block *= self.window
+            spectra = np.fft.rfft(block, axis=1)
+            self._sum += np.sum(spectra.real ** 2 + spectra.imag ** 2,
+                                axis=0)
+
+        self.n_segments += n_segments
+        return n_segments * self.step
+
+    def add_trace(self, trace: np.ndarray) -> None:
+        """
+        Add the segments of a trace to the estimate.
+
+        Args:
+            trace
+                1D array of samples
+        """
+        trace = np.ascontiguousarray(trace, dtype=float).reshape(-1)
+        self.n_samples += len(trace)
+
+        if not self.contiguous:
+            self._add_segments(trace)
+            return
+
+        if self._n_carry:
+            # The segments that start in the samples left over from the
+            # previous trace are completed with the beginning of this trace
+            n_boundary = -(-self._n_carry // self.step)
+            n_joined = (n_boundary - 1) * self.step + self.segment_length
+            n_head = n_joined - self._n_carry
+            if len(trace) < n_head:
+                n_joined = self._n_carry + len(trace)
+                self._carry[self._n_carry:n_joined] = trace
+                self._keep_leftover(self._carry[:n_joined])
+                return
+            self._carry[self._n_carry:n_joined] = trace[:n_head]
+            self._add_segments(self._carry[:n_joined])
+            trace = trace[n_boundary * self.step - self._n_carry:]
+
+        self._keep_leftover(trace)
+
+    def _keep_leftover(self, samples: np.ndarray) -> None:
+        """
+        Add the full segments of the samples, and keep the rest for the
+        next trace.
+        """
+        consumed = self._add_segments(samples)
+        leftover = samples[consumed:]
+        # leftover may overlap with the carry buffer, hence the copy
+        self._carry[:len(leftover)] = leftover.copy()
+        self._n_carry = len(leftover)
+
+    def acquire(self,
+                get_trace: Callable[[], np.ndarray],
+                n_traces: int) -> np.ndarray:
+        """
+        Acquire the given number of traces (e.g. with
+        `scope.ch1.trace.get`) and add them to the estimate.
+
+        Returns:
+            The amplitude spectral density after all the traces are added
+        """
+        for _ in range(n_traces):
+            self.add_trace(get_trace())
+        return self.asd
@@ -0,0 +1,292 @@
+"""
+This module contains a wrapper for the Stanford Research SR760 FFT spectrum
+analyzer that is used for current noise measurements.
+
+The wrapper talks to the instrument via a pyvisa resource (or the
+`SimulatedSR760Resource` for testing without hardware). The frequencies of
+the bins are computed locally from the span and the start frequency, and
+the spectra are fetched in one bulk transfer (binary, if requested) that is
+parsed straight into numpy arrays.
+"""
+
+import time
+from typing import Optional
+
+import numpy as np
+from qcodes.utils.validators import Enum, Numbers
+
+from .qcodes_tools import VirtualInstrument
+
+N_BINS = 400
+
+# Frequency spans in Hz, the index in this list is the value of "SPAN"
+# command of the SR760
+SPANS = [100e3 / 2 ** (19 - i) for i in range(20)]
+
+
+def _span_index(span: float) -> int:
+    return int(np.argmin(np.abs(np.log(SPANS) - np.log(span))))
+
+
+class SR760(VirtualInstrument):
+    """
+    Stanford Research SR760 FFT spectrum analyzer.
+
+    Args:
+        name
+            Name of the instrument
+        resource
+            Opened pyvisa resource of the instrument, e.g.
+            `visa.ResourceManager().open_resource('GPIB0::10::INSTR')`, or a
+            `SimulatedSR760Resource`
+        trace
+            Trace of the instrument (0 or 1) to measure and read from
+    """
+
+    def __init__(self,
+                 name: str,
+                 resource,
+                 trace: int = 1,
+                 **kwargs):
+        super().__init__(name, **kwargs)
+
+        self._resource = resource
+        self._trace = trace
+
+        self.add_parameter(name='span',
+                           label='Frequency span',
+                           unit='Hz',
+                           get_cmd=lambda: self._query_int('SPAN?'),
+                           set_cmd=lambda index: self._write(f'SPAN {index}'),
+                           get_parser=lambda index: SPANS[index],
+                           set_parser=_span_index,
+                           vals=Numbers(SPANS[0], SPANS[-1]),
+                           docstring="Frequency span; the instrument "
+                                     "supports only the spans listed in "
+                                     "`SPANS`, hence the nearest of those "
+                                     "is set"
+                           )
+        self.add_parameter(name='start_frequency',
+                           label='Start frequency',
+                           unit='Hz',
+                           get_cmd=lambda: float(self._query('STRF?')),
+                           set_cmd=lambda value: self._write(f'STRF {value}'),
+                           vals=Numbers(0, 102.4e3),
+                           docstring="Frequency of the first bin"
+                           )
+        self.add_parameter(name='units',
+                           label='Units of the trace',
+                           get_cmd=lambda: self._query_int(
+                               f'UNIT? {self._trace}'),
+                           set_cmd=lambda index: self._write(
+                               f'UNIT {self._trace},{index}'),
+                           val_mapping={'Vpk': 0, 'Vrms': 1, 'dBV': 2,
+                                        'dBVrms': 3},
+                           docstring="Units of the spectrum values"
+                           )
+        self.add_parameter(name='bin_width',
+                           label='Width of a frequency bin',
+                           unit='Hz',
+                           get_cmd=lambda: self.span() / N_BINS,
+                           set_cmd=False,
+                           docstring="Computed locally from the span"
+                           )
+        self.add_parameter(name='frequencies',
+                           label='Frequency',
+                           unit='Hz',
+                           get_cmd=self._get_frequencies,
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Frequencies of the bins, computed "
+                                     "locally from the span and the start "
+                                     "frequency"
+                           )
+        self.add_parameter(name='binary_transfer',
+                           label='Use binary transfer of spectra',
+                           get_cmd=None,
+                           set_cmd=None,
+                           initial_value=True,
+                           vals=Enum(True, False),
+                           docstring="If True, spectra are fetched with "
+                                     "'SPEB?' as 4-byte floats, otherwise "
+                                     "with 'SPEC?' as ASCII"
+                           )
+        self.add_parameter(name='spectrum',
+                           label='Spectrum',
+                           get_cmd=self.fetch_spectrum,
+                           set_cmd=False,
+                           snapshot_value=False,
+                           docstring="Spectrum of the trace, fetched in "
+                                     "one transfer"
+                           )
+
+    @property
+    def resource(self):
+        return self._resource
+
+    def _write(self, command: str) -> None:
+        self._resource.write(command)
+
+    def _query(self, command: str) -> str:
+        return self._resource.query(command).strip()
+
+    def _query_int(self, command: str) -> int:
+        return int(self._query(command))
+
+    def _get_frequencies(self) -> np.ndarray:
+        return self.start_frequency() + np.arange(N_BINS) * self.bin_width()
+
+    def time_record_length(self) -> float:
+        """
+        Duration of the time record of one spectrum in seconds (the inverse
+        of the width of a frequency bin)
+        """
+        return 1 / self.bin_width()
+
+    def start_measurement(self) -> None:
+        self._write('STRT')
+
+    def fetch_spectrum(self, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Fetch the spectrum of the trace in one transfer.
+
+        Args:
+            out
+                Preallocated array of `N_BINS` float64 values to write the
+                spectrum into
+
+        Returns:
+            The spectrum (the `out` array if given)
+        """
+        if out is None:
+            out = np.empty(N_BINS)
+
+        if self.binary_transfer():
+            self._write(f'SPEB? {self._trace}')
+            raw = self._resource.read_bytes(4 * N_BINS)
+            out[:] = np.frombuffer(raw, dtype='<f4', count=N_BINS)
+        else:
+            reply = self._resource.query(f'SPEC? {self._trace}')
+            out[:] = np.fromstring(reply.strip().rstrip(','), sep=',',
+                                   count=N_BINS)
+        return out
+
+    def average_spectra(self,
+                        n_spectra: int,
+                        wait: bool = True,
+                        out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Acquire the given number of spectra and average them on the host.
+
+        The spectra are amplitude spectra, hence their powers are averaged
+        (the root of the mean of the squares), which is what the averaging
+        of the instrument does too; averaging the amplitudes would bias
+        noise estimates low. Spectra in dB units are converted to powers
+        for averaging, and the average is returned in the same dB units.
+
+        The spectra are accumulated into a preallocated buffer, hence the
+        memory use does not depend on the number of spectra.
+
+        Args:
+            n_spectra
+                Number of spectra to average
+            wait
+                If True, a new measurement is started before fetching each
+                spectrum, and fetching waits for the time record to be
+                acquired
+            out
+                Preallocated array of `N_BINS` float64 values to write the
+                average into
+
+        Returns:
+            The averaged spectrum (the `out` array if given)
+        """
+        if out is None:
+            out = np.empty(N_BINS)
+        out[:] = 0
+        spectrum = np.empty(N_BINS)
+        record_length = self.time_record_length() if wait else 0
+        in_db = self.units().startswith('dB')
+
+        for _ in range(n_spectra):
+            if wait:
+                self.start_measurement()
+                time.sleep(record_length)
+            self.fetch_spectrum(out=spectrum)
+            if in_db:
+                out += 10 ** (spectrum / 10)
+            else:
+                out += np.square(spectrum, out=spectrum)
+
+        out /= n_spectra
+        if in_db:
+            np.log10(out, out=out)
+            out *= 10
+        else:
+            np.sqrt(out, out=out)
+        return out
+
+
+class SimulatedSR760Resource:
+    """
+    Stand-in for the pyvisa resource of an SR760 for testing without
+    hardware. It understands the commands used by `SR760`, and returns
+    spectra of white noise with the given amplitude density plus a line at
+    the given frequency. The number of transfers is counted in
+    `n_transfers`.
+
+    Args:
+        noise_density
+            Amplitude spectral density of the white noise in V/sqrt(Hz)
+        line_frequency
+            Frequency of a sinusoidal line in the spectrum in Hz
+        line_amplitude
+            RMS amplitude of the line in V
+    """
+
+    def __init__(self,
+                 noise_density: float = 1e-8,
+                 line_frequency: float = 50.,
+                 line_amplitude: float = 1e-6):
+        self.noise_density = noise_density
+        self.line_frequency = line_frequency
+        self.line_amplitude = line_amplitude
+
+        self.n_transfers = 0
+        self._settings = {'SPAN': '19', 'STRF': '0.0', 'UNIT': '1'}
+        self._pending = b''
+        self._rng = np.random.RandomState()
+
+    def _spectrum(self) -> np.ndarray:
+        span = SPANS[int(self._settings['SPAN'])]
+        bin_width = span / N_BINS
+        frequencies = float(self._settings['STRF']) \
+            + np.arange(N_BINS) * bin_width
+        noise = self.noise_density * np.sqrt(bin_width) \
+            * np.abs(self._rng.standard_normal(N_BINS))
+        line = np.where(np.abs(frequencies - self.line_frequency)
+                        < bin_width / 2, self.line_amplitude, 0)
+        return np.hypot(noise, line)
+
+    def write(self, command: str) -> None:
+        self.n_transfers += 1
+        command = command.strip()
+        header, _, argument = command.partition(' ')
+        if header in ('SPAN', 'STRF'):
+            self._settings[header] = argument
+        elif header == 'UNIT':
+            self._settings[header] = argument.split(',')[-1]
+        elif header == 'SPEB?':
+            self._pending = self._spectrum().astype('<f4').tobytes()
+
+    def read_bytes(self, count: int) -> bytes:
+        self.n_transfers += 1
+        data, self._pending = self._pending[:count], self._pending[count:]
+        return data
+
+    def query(self, command: str) -> str:
+        self.n_transfers += 1
+        header, _, _ = command.strip().partition(' ')
+        if header == 'SPEC?':
+            return ','.join(f'{value:e}' for value in self._spectrum()) + ','
+        return self._settings[header.rstrip('?')]
@@ -0,0 +1,338 @@
+"""
+This module contains a planner for multi-dimensional sweeps, where a fast
+axis (a `RepeatingStaircaseRamp` played by the AWG) is measured at every
+point of a grid of slow axes (e.g. DAC voltages of IVVI or MDAC channels).
+
+The slow DACs have limited ramp rates, hence the order in which the grid of
+slow setpoints is visited matters: in raster order the slow axes ramp back
+to the start of every line. The plan can visit the grid in snake
+(boustrophedon) order or along a Hilbert-like curve, estimates the run time
+of each order before the measurement, and maps the results back onto the
+regular grid.
+"""
+
+import time
+from typing import (Callable, Dict, Iterator, List, NamedTuple, Optional,
+                    Sequence, Tuple)
+
+import numpy as np
+from qcodes import Parameter
+
+from .ramps import RepeatingStaircaseRamp
+
+ORDERS = ('raster', 'snake', 'hilbert')
+
+
+class SlowAxis(NamedTuple):
+    """
+    Slow axis of a sweep plan: the parameter, its setpoints, its ramp rate
+    in units of the parameter per second, and the time to wait after it has
+    been set.
+    """
+    parameter: Parameter
+    values: Sequence[float]
+    ramp_rate: float
+    settle_time: float = 0.
+
+
+class DurationEstimate(NamedTuple):
+    """
+    Estimated duration of a sweep plan in seconds: the total, and its parts
+    spent on ramping the slow axes, on waiting for them to settle, and on
+    the fast sweeps.
+    """
+    total: float
+    ramp_time: float
+    settle_time: float
+    fast_sweep_time: float
+
+
+def raster_order(shape: Sequence[int]) -> np.ndarray:
+    """
+    Grid indices in raster (row-major) order, as an array of shape
+    (number of points, number of axes); the last axis changes fastest.
+    """
+    if len(shape) == 0:
+        return np.zeros((1, 0), dtype=int)  # the single point of no axes
+    return np.indices(shape).reshape(len(shape), -1).T
+
+
+def snake_order(shape: Sequence[int]) -> np.ndarray:
+    """
+    Grid indices in snake (boustrophedon) order, as an array of shape
+    (number of points, number of axes): like the raster order, but every
+    axis runs backwards in every other pass, so that consecutive points
+    differ by one step along one axis.
+    """
+    shape = tuple(shape)
+    indices = raster_order(shape)
+    flat = np.arange(len(indices))
+    for axis in range(1, len(shape)):
+        # number of the pass along this axis
+        passes = flat // int(np.prod(shape[axis:]))
+        backwards = passes % 2 == 1
+        indices[backwards, axis] = shape[axis] - 1 - indices[backwards, axis]
+    return indices
+
+
+def _sign(value: int) -> int:
+    return (value > 0) - (value < 0)
+
+
+def _generalized_hilbert(x: int, y: int,
+                         ax: int, ay: int,
+                         bx: int, by: int) -> Iterator[Tuple[int, int]]:
+    """
+    Generalized Hilbert curve through the rectangle with the corner at
+    (x, y) and the sides (ax, ay) and (bx, by); the curve starts at the
+    corner and ends at the corner (x + ax, y + ay) side. Works for
+    rectangles of any size.
+    """
+    width = abs(ax + ay)
+    height = abs(bx + by)
+    dax, day = _sign(ax), _sign(ay)
+    dbx, dby = _sign(bx), _sign(by)
+
+    if height == 1:
+        for _ in range(width):
+            yield x, y
+            x, y = x + dax, y + day
+        return
+    if width == 1:
+        for _ in range(height):
+            yield x, y
+            x, y = x + dbx, y + dby
+        return
+
+    ax2, ay2 = ax // 2, ay // 2
+    bx2, by2 = bx // 2, by // 2
+    width2 = abs(ax2 + ay2)
+    height2 = abs(bx2 + by2)
+
+    if 2 * width > 3 * height:
+        # long rectangle: split it into two halves along its length
+        if width2 % 2 and width > 2:
+            ax2, ay2 = ax2 + dax, ay2 + day
+        yield from _generalized_hilbert(x, y, ax2, ay2, bx, by)
+        yield from _generalized_hilbert(x + ax2, y + ay2,
+                                        ax - ax2, ay - ay2, bx, by)
+    else:
+        # standard case: go up, across and down
+        if height2 % 2 and height > 2:
+            bx2, by2 = bx2 + dbx, by2 + dby
+        yield from _generalized_hilbert(x, y, bx2, by2, ax2, ay2)
+        yield from _generalized_hilbert(x + bx2, y + by2,
+                                        ax, ay, bx - bx2, by - by2)
+        yield from _generalized_hilbert(x + (ax - dax) + (bx2 - dbx),
+                                        y + (ay - day) + (by2 - dby),
+                                        -bx2, -by2,
+                                        -(ax - ax2), -(ay - ay2))
+
+
+def hilbert_order(shape: Sequence[int]) -> np.ndarray:
+    """
+    Grid indices along a Hilbert-like curve, as an array of shape
+    (number of points, number of axes). The curve fills the plane of the
+    last two axes (a generalized Hilbert curve, which works for any
+    rectangle); the other axes are traversed in snake order, with the
+    curve run backwards in every other plane.
+    """
+    shape = tuple(shape)
+    if len(shape) < 2:
+        return snake_order(shape)
+
+    n_rows, n_columns = shape[-2:]
+    if n_columns >= n_rows:
+        curve = _generalized_hilbert(0, 0, n_columns, 0, 0, n_rows)
+    else:
+        curve = _generalized_hilbert(0, 0, 0, n_rows, n_columns, 0)
+    plane = np.array([(row, column) for column, row in curve])
+
+    outer = snake_order(shape[:-2])
+    planes = [plane[::-1] if i % 2 else plane for i in range(len(outer))]
+    outer_indices = np.repeat(outer, len(plane), axis=0)
+    return np.hstack((outer_indices, np.vstack(planes)))
+
+
+_ORDER_FUNCTIONS = {'raster': raster_order,
+                    'snake': snake_order,
+                    'hilbert': hilbert_order}
+
+
+class SweepPlan:
+    """
+    Plan of a multi-dimensional sweep: a fast sweep (the repeating staircase
+    ramp) at each point of the grid of the slow axes.
+
+    Example:
+        plan = SweepPlan(ramp,
+                         [SlowAxis(ivvi.dac1, np.linspace(0, 0.5, 51),
+                                   ramp_rate=0.05),
+                          SlowAxis(ivvi.dac2, np.linspace(0, 0.3, 31),
+                                   ramp_rate=0.05, settle_time=0.1)],
+                         fast_sweep_time=0.2,
+                         order='auto')
+        print(plan.estimate_durations())
+        data = plan.run(lambda: sweep.acquire(n_points)['lockin'])
+
+    Args:
+        fast_ramp
+            Repeating staircase ramp of the fast axis
+        slow_axes
+            Slow axes, the first one being the slowest in raster order
+        fast_sweep_time
+            Duration of one fast sweep (all the repetitions of the ramp,
+            including arming and fetching) in seconds
+        order
+            Order in which the grid of slow setpoints is visited: 'raster',
+            'snake', 'hilbert', or 'auto' for the one with the shortest
+            estimated duration
+        start_values
+            Values of the slow parameters before the sweep, used to estimate
+            the time of ramping to the first point; by default, that time
+            is not taken into account
+    """
+
+    def __init__(self,
+                 fast_ramp: RepeatingStaircaseRamp,
+                 slow_axes: Sequence[SlowAxis],
+                 fast_sweep_time: float = 0.,
+                 order: str = 'snake',
+                 start_values: Optional[Sequence[float]] = None) -> None:
+        self.fast_ramp = fast_ramp
+        self.slow_axes = [SlowAxis(*axis) for axis in slow_axes]
+        self.fast_sweep_time = fast_sweep_time
+        self.start_values = start_values
+
+        if order == 'auto':
+            estimates = self.estimate_durations()
+            order = min(estimates, key=lambda name: estimates[name].total)
+        elif order not in ORDERS:
+            raise ValueError(f"Unknown order {order!r}, should be one of "
+                             f"{ORDERS} or 'auto'.")
+        self.order = order
+
+    @property
+    def grid_shape(self) -> Tuple[int, ...]:
+        return tuple(len(axis.values) for axis in self.slow_axes)
+
+    @property
+    def n_slow_points(self) -> int:
+        return int(np.prod(self.grid_shape))
+
+    def grid_indices(self, order: Optional[str] = None) -> np.ndarray:
+        """
+        Indices of the slow setpoints in the order of visiting, as an array
+        of shape (number of slow points, number of slow axes).
+        """
+        return _ORDER_FUNCTIONS[order or self.order](self.grid_shape)
+
+    def slow_setpoints(self, order: Optional[str] = None) -> np.ndarray:
+        """
+        Values of the slow parameters in the order of visiting, as an array
+        of shape (number of slow points, number of slow axes).
+        """
+        indices = self.grid_indices(order)
+        if not self.slow_axes:
+            return np.empty((len(indices), 0))
+        return np.stack([np.asarray(axis.values, dtype=float)[indices[:, i]]
+                         for i, axis in enumerate(self.slow_axes)], axis=1)
+
+    def estimate_duration(self, order: Optional[str] = None
+                          ) -> DurationEstimate:
+        """
+        Estimate the duration of the sweep for the given order (by default,
+        the order of the plan). The slow parameters are assumed to be set
+        one after another, each at its ramp rate; after they are set, the
+        longest settle time of those whose value has changed is waited
+        for.
+        """
+        setpoints = self.slow_setpoints(order)
+        if self.start_values is not None:
+            setpoints = np.vstack((self.start_values, setpoints))
+        steps = np.abs(np.diff(setpoints, axis=0))
+
+        ramp_rates = np.array([axis.ramp_rate for axis in self.slow_axes])
+        settle_times = np.array([axis.settle_time
+                                 for axis in self.slow_axes])
+        ramp_time = float(np.sum(steps / ramp_rates))
+        settle_time = 0.
+        # without slow axes, there is nothing to ramp or to wait for
+        if len(settle_times):
+            if len(steps):
+                settle_time += float(np.sum(
+                    np.max((steps > 0) * settle_times, axis=1)))
+            if self.start_values is None:
+                settle_time += float(np.max(settle_times))  # the first point
+        fast_sweep_time = self.n_slow_points * self.fast_sweep_time
+
+        return DurationEstimate(ramp_time + settle_time + fast_sweep_time,
+                                ramp_time, settle_time, fast_sweep_time)
+
+    def estimate_durations(self) -> Dict[str, DurationEstimate]:
+        """
+        Estimate the duration of the sweep for each of the orders.
+        """
+        return {order: self.estimate_duration(order) for order in ORDERS}
+
+    def iter_points(self) -> Iterator[Tuple[Tuple[int, ...], np.ndarray]]:
+        """
+        Set the slow parameters to each point of the plan in turn, and
+        yield the grid index and the values of the slow parameters. Only
+        the parameters whose value changes are set, and then the longest
+        settle time of those is waited for.
+        """
+        indices = self.grid_indices()
+        setpoints = self.slow_setpoints()
+        previous = None
+        for index, values in zip(indices, setpoints):
+            wait = 0.
+            for i, axis in enumerate(self.slow_axes):
+                if previous is None or values[i] != previous[i]:
+                    axis.parameter.set(values[i])
+                    wait = max(wait, axis.settle_time)
+            time.sleep(wait)
+            previous = values
+            yield tuple(index), values
+
+    def run(self, acquire: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Go through the plan and acquire the fast sweep at each point.
+
+        Args:
+            acquire
+                Function that performs the fast sweep and returns the
+                acquired data (an array, usually over
+                `values_with_repetitions_vector` of the fast ramp)
+
+        Returns:
+            Array of the acquired data on the regular grid, of shape
+            `grid_shape` + shape of the data of one fast sweep
+        """
+        data = None
+        for index, _ in self.iter_points():
+            sweep_data = np.asarray(acquire())
+            if data is None:
+                data = np.full(self.grid_shape + sweep_data.shape, np.nan,
+                               dtype=np.result_type(sweep_data, float))
+            data[index] = sweep_data
+        return data
+
+    def to_grid(self, results: Sequence[np.ndarray]) -> np.ndarray:
+        """
+        Put results that have been collected in the order of the plan onto
+        the regular grid of shape `grid_shape` + shape of one result.
+        """
+        results = np.asarray(results)
+        grid = np.empty(self.grid_shape + results.shape[1:],
+                        dtype=results.dtype)
+        grid[tuple(self.grid_indices().T)] = results
+        return grid
+
+    def grid_axes(self) -> List[np.ndarray]:
+        """
+        Axes of the regular grid: the values of the slow axes and the
+        values of the fast ramp with repetitions.
+        """
+        return [np.asarray(axis.values) for axis in self.slow_axes] \
+            + [self.fast_ramp.values_with_repetitions_vector()]